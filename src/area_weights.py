@@ -0,0 +1,115 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from loguru import logger
+from scipy import sparse
+
+
+class AreaWeights:
+    """Sparse aoi x data matrix of intersection areas as a fraction of each aoi's area.
+
+    Sparse mat-vecs with the matrix give the same results as
+    `geowrangler.area_zonal_stats.create_area_zonal_stats` with the "mean" func, i.e. the
+    mean of the area-apportioned values over the data geometries intersecting each aoi.
+    Once built for an aoi and a fixed set of data geometries (e.g. Ookla tiles),
+    new data values don't need a polygon overlay.
+    """
+
+    def __init__(self, weights, data_keys):
+        weights = sparse.csr_matrix(weights)
+        data_keys = np.asarray(data_keys).astype(str)
+        if weights.shape[1] != len(data_keys):
+            raise ValueError(
+                f"Number of data keys {len(data_keys)} does not match the {weights.shape[1]} columns of weights"
+            )
+
+        # Data keys are kept sorted so that data rows can be matched with a sorted search
+        order = np.argsort(data_keys, kind="stable")
+        data_keys = data_keys[order]
+        if np.any(data_keys[1:] == data_keys[:-1]):
+            raise ValueError("Data keys of the area weights must be unique")
+        self.weights = weights[:, order]
+        self.data_keys = data_keys
+
+    @property
+    def shape(self):
+        return self.weights.shape
+
+    @classmethod
+    def from_geometries(cls, aoi, data, data_key_col, metric_crs="epsg:3123"):
+        "Build the weights by intersecting the aoi with data geometries identified by data_key_col"
+        aoi = gpd.GeoDataFrame(geometry=aoi.geometry.reset_index(drop=True)).to_crs(
+            metric_crs
+        )
+        data = data[[data_key_col, "geometry"]].drop_duplicates(data_key_col)
+        data = data.sort_values(data_key_col).reset_index(drop=True).to_crs(metric_crs)
+
+        aoi["aoi_row"] = np.arange(len(aoi))
+        aoi["aoi_area"] = aoi.geometry.area
+        data["data_col"] = np.arange(len(data))
+
+        logger.info(
+            f"Building area weights for {len(aoi)} aoi and {len(data)} data geometries"
+        )
+        intersect = aoi.overlay(data, keep_geom_type=True)
+        intersect["pct_aoi"] = intersect.geometry.area / intersect["aoi_area"]
+
+        weights = sparse.csr_matrix(
+            (
+                intersect["pct_aoi"].to_numpy(),
+                (intersect["aoi_row"].to_numpy(), intersect["data_col"].to_numpy()),
+            ),
+            shape=(len(aoi), len(data)),
+        )
+        return cls(weights, data[data_key_col].to_numpy())
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            data=self.weights.data,
+            indices=self.weights.indices,
+            indptr=self.weights.indptr,
+            shape=np.array(self.weights.shape),
+            data_keys=self.data_keys,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            weights = sparse.csr_matrix(
+                (npz["data"], npz["indices"], npz["indptr"]), shape=tuple(npz["shape"])
+            )
+            return cls(weights, npz["data_keys"])
+
+    def mean(self, df, data_key_col, columns):
+        """Area-weighted mean of each column in df per aoi row. df should have one row per data key.
+        Aoi rows without any intersecting data in df are NaN."""
+        data_keys = df[data_key_col].to_numpy().astype(str)
+        positions = np.searchsorted(self.data_keys, data_keys)
+        found = positions < len(self.data_keys)
+        found[found] = self.data_keys[positions[found]] == data_keys[found]
+        if not np.all(found):
+            logger.debug(
+                f"Ignoring {np.sum(~found)} rows not covered by the area weights"
+            )
+        positions = positions[found]
+
+        # Each intersecting data geometry with a value counts once towards the mean.
+        # Aoi rows without any are left as NaN, same as an overlay
+        intersects = self.weights.copy()
+        intersects.data[:] = 1.0
+
+        means = {}
+        for column in columns:
+            column_values = df[column].to_numpy(dtype=float)[found]
+            values = np.zeros(len(self.data_keys))
+            values[positions] = np.nan_to_num(column_values, nan=0.0)
+            has_values = np.zeros(len(self.data_keys))
+            has_values[positions] = ~np.isnan(column_values)
+
+            counts = intersects @ has_values
+            with np.errstate(divide="ignore", invalid="ignore"):
+                column_means = (self.weights @ values) / counts
+            column_means[counts == 0] = np.nan
+            means[column] = column_means
+        return pd.DataFrame(means)
@@ -0,0 +1,309 @@
+import contextlib
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import pandas as pd
+from loguru import logger
+
+ASSET_STORE_DIR = "~/.geowrangler"
+ASSET_STORE_FILENAME = "assets.sqlite"
+# Disk budget in bytes of the assets of every store, unlimited if unset
+ASSET_STORE_MAX_BYTES_ENV_VAR = "GEOWRANGLER_CACHE_MAX_BYTES"
+
+
+def file_sha256(path, chunksize=1024 * 1024):
+    "Hex sha256 checksum of a file, read in chunks"
+    m = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunksize), b""):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+class AssetStore:
+    """Manifest of the raw and derived data files cached under a geowrangler cache root.
+
+    Every asset is recorded in root/assets.sqlite with its source (e.g. ookla or
+    nightlights), source url, size, modification time, sha256 checksum and last access
+    time. max_size_bytes defaults to the GEOWRANGLER_CACHE_MAX_BYTES env var. Assets with a
+    url can be downloaded or derived again, so when the unique bytes of the assets exceed
+    max_size_bytes, assets with the same content are deduplicated as hard links to one
+    file and then the least recently used assets with a url are deleted. Assets without
+    a url are never evicted, nor are assets leased by a running process (see `lease`).
+    """
+
+    def __init__(self, root=ASSET_STORE_DIR, max_size_bytes=None):
+        self.root = Path(os.path.expanduser(root))
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.root / ASSET_STORE_FILENAME
+        if max_size_bytes is None and os.environ.get(ASSET_STORE_MAX_BYTES_ENV_VAR):
+            max_size_bytes = int(os.environ[ASSET_STORE_MAX_BYTES_ENV_VAR])
+        self.max_size_bytes = max_size_bytes
+        with self._connect() as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS assets (
+                    path TEXT PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    url TEXT,
+                    size_bytes INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    mtime REAL
+                )"""
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(assets)")]
+            if "mtime" not in columns:
+                # Manifests written before mtimes were recorded
+                conn.execute("ALTER TABLE assets ADD COLUMN mtime REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS assets_sha256 ON assets (sha256)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS leases (
+                    token TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    pid INTEGER NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS leases_path ON leases (path)")
+
+    def _connect(self):
+        return contextlib.closing(sqlite3.connect(self.manifest_path, timeout=60))
+
+    def add(self, path, source, url=None, keep=()):
+        """Record a downloaded or derived file, then evict assets over the disk budget
+        except path and the keep paths. The checksum of an already recorded file is only
+        computed again if its size or modification time changed."""
+        path = Path(path).resolve()
+        now = time.time()
+        stat = path.stat()
+        with self._connect() as conn, conn:
+            row = conn.execute(
+                "SELECT size_bytes, mtime, sha256 FROM assets WHERE path = ?",
+                (str(path),),
+            ).fetchone()
+            if row is not None and row[:2] == (stat.st_size, stat.st_mtime):
+                sha256 = row[2]
+            else:
+                sha256 = file_sha256(path)
+            conn.execute(
+                """INSERT OR REPLACE INTO assets
+                (path, source, url, size_bytes, sha256, created_at, last_access, mtime)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    str(path),
+                    source,
+                    url,
+                    stat.st_size,
+                    sha256,
+                    now,
+                    now,
+                    stat.st_mtime,
+                ),
+            )
+        self.gc(keep=[path, *keep])
+        return path
+
+    def touch(self, path):
+        "Mark an asset as used, so that it is evicted last"
+        with self._connect() as conn, conn:
+            conn.execute(
+                "UPDATE assets SET last_access = ? WHERE path = ?",
+                (time.time(), str(Path(path).resolve())),
+            )
+
+    def verify(self, path, checksum=False):
+        """Check that a file exists and matches its recorded size (and checksum). Unrecorded
+        files, e.g. cached before the asset store, are valid if they exist."""
+        path = Path(path).resolve()
+        if not path.is_file():
+            return False
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT size_bytes, sha256 FROM assets WHERE path = ?", (str(path),)
+            ).fetchone()
+        if row is None:
+            return True
+        size_bytes, sha256 = row
+        if path.stat().st_size != size_bytes or (
+            checksum and file_sha256(path) != sha256
+        ):
+            logger.warning(f"{path} does not match its recorded size or checksum")
+            return False
+        return True
+
+    @contextlib.contextmanager
+    def lease(self, *paths):
+        """Keep the assets at paths from being evicted, by this or any other process, until
+        the context exits. Lease assets before checking that they exist and then using them."""
+        token = uuid.uuid4().hex
+        with self._connect() as conn, conn:
+            conn.executemany(
+                "INSERT INTO leases VALUES (?, ?, ?)",
+                [(token, str(Path(path).resolve()), os.getpid()) for path in paths],
+            )
+        try:
+            yield
+        finally:
+            with self._connect() as conn, conn:
+                conn.execute("DELETE FROM leases WHERE token = ?", (token,))
+
+    def _evict(self, path):
+        # Leases are checked and the asset deleted in one write transaction, so an asset
+        # is either leased before it is evicted or found missing by the lease holder
+        with self._connect() as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            pids = [
+                pid
+                for (pid,) in conn.execute(
+                    "SELECT pid FROM leases WHERE path = ?", (path,)
+                )
+            ]
+            dead_pids = [pid for pid in pids if not _is_process_alive(pid)]
+            # Leases of processes that exited without releasing them
+            conn.executemany(
+                "DELETE FROM leases WHERE pid = ?", [(pid,) for pid in dead_pids]
+            )
+            if len(dead_pids) < len(pids):
+                return False
+            conn.execute("DELETE FROM assets WHERE path = ?", (path,))
+            Path(path).unlink(missing_ok=True)
+        return True
+
+    def discard(self, path):
+        """Forget an asset and delete its file unless another lease holder is using it.
+        Returns whether it was deleted."""
+        return self._evict(str(Path(path).resolve()))
+
+    def remove(self, path, delete=True):
+        "Forget an asset and delete its file"
+        path = Path(path).resolve()
+        with self._connect() as conn, conn:
+            conn.execute("DELETE FROM assets WHERE path = ?", (str(path),))
+        if delete:
+            path.unlink(missing_ok=True)
+
+    def assets(self):
+        "Dataframe of the recorded assets, dropping the ones whose file was deleted"
+        with self._connect() as conn, conn:
+            assets = pd.read_sql_query("SELECT * FROM assets", conn)
+            missing = [path for path in assets["path"] if not os.path.isfile(path)]
+            conn.executemany(
+                "DELETE FROM assets WHERE path = ?", [(path,) for path in missing]
+            )
+        return assets[~assets["path"].isin(missing)].reset_index(drop=True)
+
+    def du(self):
+        """Disk usage per source: number of assets, their size, the unique size after
+        deduplication and the size of the evictable assets"""
+        assets = self.assets()
+        assets["evictable_bytes"] = assets["size_bytes"].where(assets["url"].notna(), 0)
+        usage = assets.groupby("source").agg(
+            assets=("path", "count"),
+            size_bytes=("size_bytes", "sum"),
+            evictable_bytes=("evictable_bytes", "sum"),
+        )
+        usage["unique_bytes"] = (
+            assets.drop_duplicates("sha256").groupby("source")["size_bytes"].sum()
+        )
+        return usage[["assets", "size_bytes", "unique_bytes", "evictable_bytes"]]
+
+    def size_bytes(self):
+        "Unique size of the assets after deduplication"
+        return int(self.assets().drop_duplicates("sha256")["size_bytes"].sum())
+
+    def dedupe(self):
+        """Replace assets with the same content by hard links to one file. Returns the paths
+        that were linked. Since linked assets share their data, writers must replace assets
+        (write a temp file and rename it over the asset) instead of modifying them in place."""
+        assets = self.assets()
+        linked = []
+        for _, duplicates in assets[assets.duplicated("sha256", keep=False)].groupby(
+            "sha256"
+        ):
+            first_path, *other_paths = duplicates["path"]
+            for path in other_paths:
+                if _link_duplicate(Path(first_path), Path(path)):
+                    logger.info(f"Deduplicated {path} as a hard link to {first_path}")
+                    linked.append(path)
+        return linked
+
+    def gc(self, max_size_bytes=None, keep=()):
+        """Delete the least recently used evictable assets, except the keep paths, until the
+        unique size of the assets is within max_size_bytes (the store budget by default)"""
+        if max_size_bytes is None:
+            max_size_bytes = self.max_size_bytes
+        if max_size_bytes is None:
+            return []
+        keep = {str(Path(path).resolve()) for path in keep}
+        assets = self.assets().sort_values("last_access")
+        total_size = assets.drop_duplicates("sha256")["size_bytes"].sum()
+        if total_size > max_size_bytes:
+            # The unique size is only what the assets take on disk once deduplicated
+            self.dedupe()
+        num_links = assets["sha256"].value_counts().to_dict()
+
+        evicted = []
+        for asset in assets.itertuples():
+            if total_size <= max_size_bytes:
+                break
+            if pd.isna(asset.url) or asset.path in keep:
+                continue
+            if not self._evict(asset.path):
+                logger.info(f"Not evicting {asset.path} since it is in use")
+                continue
+            logger.info(f"Evicted {asset.path} from the asset store")
+            evicted.append(asset.path)
+            # Hard linked duplicates only free their bytes once the last link is removed
+            num_links[asset.sha256] -= 1
+            if num_links[asset.sha256] == 0:
+                total_size -= asset.size_bytes
+        if total_size > max_size_bytes:
+            logger.warning(
+                f"Assets take {total_size} bytes after eviction, over the budget of {max_size_bytes} bytes"
+            )
+        return evicted
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+def _link_duplicate(existing_path, path):
+    # Replace path with a hard link to existing_path with the same content
+    if os.path.samefile(existing_path, path):
+        return False
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.link")
+    try:
+        os.link(existing_path, tmp_path)
+    except OSError:
+        # e.g. on another file system
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+_asset_stores = {}
+_asset_stores_lock = threading.Lock()
+
+
+def get_asset_store(root=ASSET_STORE_DIR, max_size_bytes=None):
+    "Get the shared AssetStore of a cache root, setting its disk budget if max_size_bytes is given"
+    root = os.path.abspath(os.path.expanduser(root))
+    with _asset_stores_lock:
+        if root not in _asset_stores:
+            _asset_stores[root] = AssetStore(root, max_size_bytes=max_size_bytes)
+        elif max_size_bytes is not None:
+            _asset_stores[root].max_size_bytes = max_size_bytes
+        return _asset_stores[root]
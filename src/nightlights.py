@@ -3,27 +3,48 @@ import getpass
 import gzip
 import hashlib
 import json
+import math
+import multiprocessing
 import os
 import shutil
+import socket
+import sqlite3
+import ssl
+import tempfile
+import threading
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+from http.client import HTTPException
 from pathlib import Path
 from types import SimpleNamespace
-from urllib.error import ContentTooShortError, HTTPError
+from urllib.error import ContentTooShortError, HTTPError, URLError
 from urllib.parse import urlparse
 
 import geowrangler.raster_process as rp
 import geowrangler.raster_zonal_stats as rzs
 import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.shutil
 import requests
+import shapely
 from fastcore.net import urlclean, urldest, urlopen
 from fastprogress.fastprogress import progress_bar
+from filelock import FileLock
 from loguru import logger
+from rasterio.windows import Window
 from shapely.geometry import box
 
+from src.asset_store import get_asset_store
+from src.pixel_coverage import PixelCoverage, get_pixel_coverage
+
 HOME_FOLDER = Path(os.path.expanduser("~"))
 DEFAULT_EOG_CREDS_PATH = HOME_FOLDER / ".eog_creds/eog_access_token.txt"
 EOG_ENV_VAR = "EOG_ACCESS_TOKEN"
 NIGHTLIGHTS_CACHE_DIR = HOME_FOLDER / ".geowrangler/nightlights"
+COG_CATALOG_FILENAME = "catalog.json"
 
 # Retrieve access token
 def get_eog_access_token(
@@ -93,33 +114,42 @@ def clear_eog_access_token(
 # from https://github.com/fastai/fastcore/blob/86337bad16a65f23c5335286ab73cd4d6425c586/fastcore/net.py#L147
 # add headers to urlwrap call (to allow auth)
 def urlretrieve(
-    url, filename, headers=None, reporthook=None, timeout=None, chunksize=8192
+    url,
+    filename,
+    headers=None,
+    reporthook=None,
+    timeout=None,
+    chunksize=8192,
+    offset=0,
+    buffering=-1,
 ):
-    "Same as `urllib.request.urlretrieve` but also works with `Request` objects"
-    with contextlib.closing(
-        urlopen(url, data=None, headers=headers, timeout=timeout)
-    ) as fp:
+    """Same as `urllib.request.urlretrieve` but also works with `Request` objects.
+    With offset > 0, the rest of the file is requested with a Range header and appended to filename.
+    """
+    headers = dict(headers or {})
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+    try:
+        fp = urlopen(url, data=None, headers=headers, timeout=timeout)
+    except HTTPError as e:
+        if e.code == 416 and offset > 0:
+            return _range_not_satisfiable(filename, offset, e.headers), e.headers, None
+        raise
+    with contextlib.closing(fp):
         respheaders = fp.info()
-        logger.info(f"Retrieving {url} into {filename}")
-        with open(filename, "wb") as tfp:
-            size = -1
-            read = 0
-            blocknum = 0
-            if "Content-length" in respheaders:
-                size = int(respheaders["Content-Length"])
-                if size < chunksize:
-                    chunksize = size
-            if reporthook:
-                reporthook(blocknum, chunksize, size)
-            while True:
-                block = fp.read(chunksize)
-                if not block:
-                    break
-                read += len(block)
-                tfp.write(block)
-                blocknum += 1
-                if reporthook:
-                    reporthook(blocknum, chunksize, size)
+        if fp.status != 206:
+            offset = 0
+        logger.info(f"Retrieving {url} into {filename} from byte {offset}")
+        size = _expected_size(respheaders, offset)
+        with open(filename, "ab" if offset > 0 else "wb", buffering=buffering) as tfp:
+            read = _write_blocks(
+                iter(lambda: fp.read(chunksize), b""),
+                tfp,
+                reporthook,
+                chunksize,
+                size,
+                offset,
+            )
 
     if size >= 0 and read < size:
         raise ContentTooShortError(
@@ -128,6 +158,111 @@ def urlretrieve(
     return filename, respheaders, fp
 
 
+def session_urlretrieve(
+    session,
+    url,
+    filename,
+    headers=None,
+    reporthook=None,
+    timeout=None,
+    chunksize=8192,
+    offset=0,
+    buffering=-1,
+):
+    "Same as `urlretrieve` but over a `requests.Session`, reusing its pooled connections"
+    headers = dict(headers or {})
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+    with session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+        respheaders = response.headers
+        if response.status_code == 416 and offset > 0:
+            return (
+                _range_not_satisfiable(filename, offset, respheaders),
+                respheaders,
+                None,
+            )
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+        logger.info(f"Retrieving {url} into {filename} from byte {offset}")
+        size = _expected_size(respheaders, offset)
+        with open(filename, "ab" if offset > 0 else "wb", buffering=buffering) as tfp:
+            read = _write_blocks(
+                response.iter_content(chunk_size=chunksize),
+                tfp,
+                reporthook,
+                chunksize,
+                size,
+                offset,
+            )
+
+    if size >= 0 and read < size:
+        raise ContentTooShortError(
+            f"retrieval incomplete: got only {read} out of {size} bytes", respheaders
+        )
+    return filename, respheaders, None
+
+
+def _expected_size(respheaders, offset):
+    # Total size of the file, from Content-Range for partial responses
+    content_range = respheaders.get("Content-Range")
+    if content_range is not None and "/" in content_range:
+        total = content_range.rsplit("/", 1)[-1]
+        if total.isdigit():
+            return int(total)
+    if respheaders.get("Content-Length") is not None:
+        return offset + int(respheaders["Content-Length"])
+    return -1
+
+
+def _write_blocks(blocks, tfp, reporthook, chunksize, size, offset):
+    # Returns the total bytes of the file, including the offset already written
+    read = offset
+    if reporthook:
+        reporthook(0, chunksize, size)
+        if offset > 0:
+            reporthook(1, offset, size)
+    for block in blocks:
+        read += len(block)
+        tfp.write(block)
+        if reporthook:
+            reporthook(1, len(block), size)
+    return read
+
+
+def _range_not_satisfiable(filename, offset, respheaders):
+    # The part file already has every byte if its size is the total in Content-Range
+    if _expected_size(respheaders, 0) != offset:
+        Path(filename).unlink()
+        raise ContentTooShortError(
+            f"Partial download {filename} does not match the remote file, restarting",
+            respheaders,
+        )
+    return filename
+
+
+def _is_retryable_error(error):
+    # Only network errors and transient server errors are retried. Other OSErrors, such as
+    # a full disk or a permission error writing the part file, are raised right away.
+    if isinstance(error, HTTPError):
+        return error.code == 429 or error.code >= 500
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code if error.response is not None else 0
+        return status_code == 429 or status_code >= 500
+    return isinstance(
+        error,
+        (
+            URLError,
+            HTTPException,
+            requests.RequestException,
+            ConnectionError,
+            TimeoutError,
+            socket.timeout,
+            ssl.SSLError,
+        ),
+    )
+
+
 def download_url(
     url,
     dest=None,
@@ -138,8 +273,19 @@ def download_url(
     chunksize=1024 * 1024,
     env_var=EOG_ENV_VAR,
     creds_file=DEFAULT_EOG_CREDS_PATH,
+    session=None,
+    retries=5,
+    backoff=1.0,
+    buffering=8 * 1024 * 1024,
 ):
-    "Download `url` to `dest` and show progress"
+    """Download `url` to `dest` and show progress, over the `requests.Session` session if given
+
+    The download is written to a `.part` file next to dest which is renamed to dest once its
+    size matches the remote file. Interrupted downloads, including ones from a previous run,
+    resume from the end of the `.part` file with a Range request. Network errors are retried
+    up to retries times, waiting backoff * 2**attempt seconds in between. Reads are chunksize
+    bytes and writes are buffered by buffering bytes.
+    """
     if show_progress:
         pbar = progress_bar([])
 
@@ -176,16 +322,46 @@ def download_url(
     dest = urldest(url, dest)
     if not dest.parent.is_dir():  # parent dir should always exist
         dest.parent.mkdir(parents=True, exist_ok=True)
+    part_file = dest.with_name(f"{dest.name}.part")
+
+    for attempt in range(retries + 1):
+        offset = part_file.stat().st_size if part_file.exists() else 0
+        try:
+            if session is None:
+                nm, resp, fp = urlretrieve(
+                    url,
+                    filename=part_file,
+                    headers=headers,
+                    reporthook=reporthook,
+                    timeout=timeout,
+                    chunksize=chunksize,
+                    offset=offset,
+                    buffering=buffering,
+                )
+            else:
+                nm, resp, fp = session_urlretrieve(
+                    session,
+                    url,
+                    filename=part_file,
+                    headers=headers,
+                    reporthook=reporthook,
+                    timeout=timeout,
+                    chunksize=chunksize,
+                    offset=offset,
+                    buffering=buffering,
+                )
+            break
+        except Exception as e:
+            if attempt == retries or not _is_retryable_error(e):
+                raise
+            wait = backoff * 2**attempt
+            logger.warning(
+                f"Download of {url} failed ({e}), retrying in {wait:.1f}s ({attempt + 1}/{retries})"
+            )
+            time.sleep(wait)
 
-    nm, resp, fp = urlretrieve(
-        url,
-        filename=dest,
-        headers=headers,
-        reporthook=reporthook,
-        timeout=timeout,
-        chunksize=chunksize,
-    )
     if "Cache-Control" in resp and "must-revalidate" in resp["Cache-Control"]:
+        part_file.unlink(missing_ok=True)
         raise HTTPError(
             url,
             401,
@@ -193,7 +369,15 @@ def download_url(
             resp,
             fp,
         )
-    return nm
+    size, downloaded_size = _expected_size(resp, 0), part_file.stat().st_size
+    if size >= 0 and downloaded_size != size:
+        part_file.unlink()
+        raise ContentTooShortError(
+            f"Downloaded {url} has {downloaded_size} bytes instead of {size}",
+            resp,
+        )
+    os.replace(part_file, dest)
+    return dest
 
 
 def unzip_eog_gzip(gz_file, dest=None, delete_src=False):
@@ -221,10 +405,14 @@ def unzip_eog_gzip(gz_file, dest=None, delete_src=False):
         else:
             output_file = dest
     logger.info(f"Unzipping {gz_file} into {output_file}")
+    # Replacing the output file instead of writing it in place leaves hard linked copies
+    # of a previous output file (see `AssetStore.dedupe`) intact
+    tmp_output_file = f"{output_file}.{os.getpid()}.{threading.get_ident()}.tmp"
     with gzip.open(gz_file, "rb") as f_in:
-        with open(output_file, "wb") as f_out:
+        with open(tmp_output_file, "wb") as f_out:
             # TODO implement https://stackoverflow.com/questions/29967487/get-progress-back-from-shutil-file-copy-thread to add progress callback
             shutil.copyfileobj(f_in, f_out)
+    os.replace(tmp_output_file, output_file)
 
     if delete_src:
         if not output_file.exists():
@@ -243,15 +431,56 @@ def get_bounding_polygon(bounds, buffer=None):
     return box(*bounds).buffer(buffer)
 
 
-def clip_raster(input_raster_file, dest, bounds, buffer=None):
+def clip_raster(input_raster_file, dest, bounds, buffer=None, snap_to_pixels=False):
+    """Clip the raster to the (buffered) bounds.
+
+    With snap_to_pixels, the window is snapped outwards to whole pixels, so the clip is on
+    the grid of the input raster and clips of overlapping bounds have the same values where
+    they overlap. Otherwise the window matches the bounds exactly and the clip grid is
+    shifted by the fractional offset of the bounds (see `rp.query_window_by_polygon`).
+    An existing dest is replaced once the clip is written rather than written in place.
+    """
     logger.info(
         f"Generating clipped raster file from {input_raster_file} to {dest} with bounds {bounds} and buffer {buffer}"
     )
     bounds_poly = get_bounding_polygon(bounds, buffer=buffer)
-    rp.query_window_by_polygon(input_raster_file, dest, bounds_poly)
+    tmp_dest = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if not snap_to_pixels:
+        rp.query_window_by_polygon(input_raster_file, tmp_dest, bounds_poly)
+        os.replace(tmp_dest, dest)
+        return Path(dest)
+    with rasterio.open(input_raster_file) as src:
+        window = src.window(*bounds_poly.bounds)
+        col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+        window = Window(
+            col_off,
+            row_off,
+            math.ceil(window.col_off + window.width) - col_off,
+            math.ceil(window.row_off + window.height) - row_off,
+        ).intersection(Window(0, 0, src.width, src.height))
+        subset = src.read(window=window)
+        profile = src.profile.copy()
+        profile.update(
+            count=subset.shape[0],
+            height=subset.shape[1],
+            width=subset.shape[2],
+            transform=src.window_transform(window),
+        )
+        with rasterio.open(tmp_dest, "w", **profile) as dst:
+            dst.write(subset)
+            dst.colorinterp = src.colorinterp
+    os.replace(tmp_dest, dest)
     return Path(dest)
 
 
+def clip_gzip_raster(gz_file, dest, bounds, buffer=None, snap_to_pixels=False):
+    """Clip a gzipped raster without decompressing it to disk, by reading it through
+    GDAL's /vsigzip/ virtual file system"""
+    return clip_raster(
+        f"/vsigzip/{Path(gz_file).as_posix()}", dest, bounds, buffer, snap_to_pixels
+    )
+
+
 URLFORM = {
     "annual_v21": "{ntlights_base_url}/{product}/{version}/{year}/VNL_{version}_npp_{year}{year_suffix}_{coverage}_{vcmcfg}_{process_suffix}.{viirs_data_type}.dat.tif.gz",
     "annual_v22": "{ntlights_base_url}/{product}/{version}/{year}/VNL_{version}_npp-j01_{year}{year_suffix}_{coverage}_{vcmcfg}_{process_suffix}.{viirs_data_type}.dat.tif.gz",
@@ -324,6 +553,140 @@ def make_url(
     return url
 
 
+def get_nightlights_asset_store(cache_dir=NIGHTLIGHTS_CACHE_DIR, max_size_bytes=None):
+    """Get the AssetStore of the nightlights cache dir. The default cache dir shares the store
+    of its geowrangler cache root with the Ookla cache, any other cache dir has its own store
+    inside it so that nothing is written outside of it"""
+    cache_dir = Path(os.path.expanduser(cache_dir)).resolve()
+    if cache_dir == Path(os.path.expanduser(NIGHTLIGHTS_CACHE_DIR)).resolve():
+        root = cache_dir.parent
+    else:
+        root = cache_dir
+    return get_asset_store(root, max_size_bytes=max_size_bytes)
+
+
+def convert_to_cog(
+    input_raster_file, dest, compress="deflate", blocksize=512, resampling="average"
+):
+    """Convert a raster into an internally tiled, compressed GeoTIFF with overviews (COG layout)
+    so that window reads only touch the tiles intersecting the window"""
+    logger.info(f"Converting {input_raster_file} into COG {dest}")
+    tmp_dest = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    rasterio.shutil.copy(
+        input_raster_file,
+        tmp_dest,
+        driver="COG",
+        compress=compress,
+        blocksize=blocksize,
+        overview_resampling=resampling,
+        num_threads="ALL_CPUS",
+        bigtiff="IF_SAFER",
+    )
+    os.replace(tmp_dest, dest)
+    return Path(dest)
+
+
+def load_cog_catalog(cache_dir=NIGHTLIGHTS_CACHE_DIR):
+    "Load the catalog of the COG store, keyed by product/version/year/viirs data type"
+    catalog_file = Path(os.path.expanduser(cache_dir)) / "cog" / COG_CATALOG_FILENAME
+    if not catalog_file.exists():
+        return {}
+    with open(catalog_file) as f:
+        return json.load(f)
+
+
+def _update_cog_catalog(cache_dir, key, entry):
+    # The catalog is read and rewritten under a file lock, so that concurrent ingestions
+    # in other threads or processes do not drop each other's entries
+    catalog_file = Path(os.path.expanduser(cache_dir)) / "cog" / COG_CATALOG_FILENAME
+    with FileLock(f"{catalog_file}.lock"):
+        catalog = load_cog_catalog(cache_dir)
+        catalog[key] = entry
+        tmp_catalog_file = f"{catalog_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_catalog_file, "w") as f:
+            json.dump(catalog, f, indent=2)
+        os.replace(tmp_catalog_file, catalog_file)
+
+
+def get_viirs_cog(
+    year,
+    viirs_data_type=EOG_VIIRS_DATA_TYPE.AVERAGE,
+    version=EOG_PRODUCT_VERSION.VER21,
+    product=EOG_PRODUCT.ANNUAL,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    process_suffix="c202205302300",
+    vcmcfg="vcmslcfg",
+    compress="deflate",
+    session=None,
+):
+    """Get the COG of a global VIIRS raster from the COG store, ingesting it if not yet available.
+
+    The COG is converted from the uncompressed global raster if cached, otherwise from
+    the gzipped download read through /vsigzip/ and then deleted.
+    """
+    if year >= 2022:
+        version = EOG_PRODUCT_VERSION.VER22
+
+    viirs_url = make_url(
+        year,
+        viirs_data_type=viirs_data_type,
+        version=version,
+        product=product,
+        coverage=coverage,
+        process_suffix=process_suffix,
+        vcmcfg=vcmcfg,
+    )
+    key = f"{product}/{version}/{year}/{viirs_data_type}"
+    cog_cache_dir = Path(os.path.expanduser(cache_dir)) / "cog"
+    cog_cache_dir.mkdir(parents=True, exist_ok=True)
+
+    viirs_zipped_filename = Path(os.path.basename(urlparse(viirs_url).path)).name
+    viirs_unzip_filename = ".".join(viirs_zipped_filename.split(".")[:-1])
+    viirs_unzip_file = (
+        Path(os.path.expanduser(cache_dir)) / "global" / viirs_unzip_filename
+    )
+    cog_file = cog_cache_dir / viirs_unzip_filename
+
+    asset_store = get_nightlights_asset_store(cache_dir)
+    # Concurrent requests for the same COG wait for a single ingestion
+    with FileLock(f"{cog_file}.lock"):
+        catalog_entry = load_cog_catalog(cache_dir).get(key)
+        if catalog_entry is not None and catalog_entry["url"] == viirs_url:
+            cached_cog_file = cog_cache_dir / catalog_entry["file"]
+            if asset_store.verify(cached_cog_file):
+                logger.info(f"Retrieving VIIRS COG {cached_cog_file}")
+                asset_store.touch(cached_cog_file)
+                return cached_cog_file
+
+        if asset_store.verify(viirs_unzip_file):
+            convert_to_cog(viirs_unzip_file.as_posix(), cog_file, compress=compress)
+        else:
+            with tempfile.TemporaryDirectory(dir=cog_cache_dir) as tmp_dir:
+                viirs_zip_file = download_url(viirs_url, dest=tmp_dir, session=session)
+                convert_to_cog(
+                    f"/vsigzip/{Path(viirs_zip_file).as_posix()}",
+                    cog_file,
+                    compress=compress,
+                )
+        asset_store.add(cog_file, "nightlights", url=viirs_url)
+
+        _update_cog_catalog(
+            cache_dir,
+            key,
+            dict(
+                file=cog_file.name,
+                url=viirs_url,
+                year=str(year),
+                viirs_data_type=viirs_data_type,
+                version=version,
+                product=product,
+                compress=compress,
+            ),
+        )
+    return cog_file
+
+
 def make_clip_hash(
     year,
     bounds,
@@ -333,6 +696,7 @@ def make_clip_hash(
     coverage=EOG_COVERAGE.GLOBAL,
     process_suffix="c202205302300",
     vcmcfg="vcmslcfg",
+    snap_to_pixels=False,
 ):
     # Generate hash from aoi, type_, and year, which will act as a hash key for the cache
     data_tuple = (
@@ -345,6 +709,9 @@ def make_clip_hash(
         process_suffix,
         vcmcfg,
     )
+    if snap_to_pixels:
+        # Keys of clips that are not snapped stay the same as before snapping existed
+        data_tuple += ("snap_to_pixels",)
     m = hashlib.md5()
     for item in data_tuple:
         m.update(item.encode())
@@ -363,7 +730,51 @@ def generate_clipped_raster(
     cache_dir=NIGHTLIGHTS_CACHE_DIR,
     process_suffix="c202205302300",
     vcmcfg="vcmslcfg",
+    stream=False,
+    use_cog=False,
+    session=None,
+    snap_to_pixels=False,
+    keep_download=False,
 ):
+    """Clip the global VIIRS raster to the bounds into dest, downloading it if not cached.
+
+    The global raster is downloaded and unzipped under a file lock, so concurrent clips of
+    the same product and year in other threads or processes wait for it and reuse it
+    instead of downloading it again. With stream, a missing global raster is not unzipped:
+    the gzipped global file is downloaded into the cache with `download_url`, so interrupted
+    downloads resume, and is clipped directly from the compressed file. The clip is then
+    the only file kept: the gzipped global file is deleted once no other clip is streaming
+    from it, unless keep_download is set, in which case later clips reuse it instead of
+    downloading it again at the cost of keeping it on disk. With use_cog, the clip is read from the tiled COG store (see `get_viirs_cog`)
+    which only reads the tiles intersecting the bounds. See `clip_raster` for snap_to_pixels.
+    """
+    asset_store = get_nightlights_asset_store(cache_dir)
+    if use_cog:
+        get_cog = partial(
+            get_viirs_cog,
+            year,
+            viirs_data_type=viirs_data_type,
+            version=version,
+            product=product,
+            coverage=coverage,
+            cache_dir=cache_dir,
+            process_suffix=process_suffix,
+            vcmcfg=vcmcfg,
+            session=session,
+        )
+        cog_file = get_cog()
+        with asset_store.lease(cog_file):
+            if not cog_file.exists():
+                # Evicted by another process before it was leased
+                cog_file = get_cog()
+            return clip_raster(
+                cog_file.as_posix(),
+                dest.as_posix(),
+                bounds,
+                buffer=0.1,
+                snap_to_pixels=snap_to_pixels,
+            )
+
     viirs_cache_dir = Path(os.path.expanduser(cache_dir)) / "global"
     viirs_cache_dir.mkdir(parents=True, exist_ok=True)
 
@@ -381,54 +792,203 @@ def generate_clipped_raster(
     viirs_zipped_filename = Path(os.path.basename(parsed_url.path)).name
     viirs_unzip_filename = ".".join(viirs_zipped_filename.split(".")[:-1])  # remove .gz
     viirs_unzip_file = viirs_cache_dir / viirs_unzip_filename
+    viirs_zip_file = viirs_cache_dir / viirs_zipped_filename
     logger.info(f"Using viirs global file as source raster: {viirs_unzip_file}")
 
-    if not viirs_unzip_file.exists():
-        viirs_zip_file = download_url(viirs_url, dest=viirs_cache_dir)
-        viirs_unzip_file = unzip_eog_gzip(
-            viirs_zip_file, dest=viirs_cache_dir, delete_src=True
+    # The global file is leased until it is clipped, so that assets added by other
+    # threads or processes meanwhile do not evict it
+    with asset_store.lease(viirs_unzip_file, viirs_zip_file):
+        with FileLock(f"{viirs_zip_file}.lock"):
+            is_cached = asset_store.verify(viirs_unzip_file)
+            is_zip_cached = not is_cached and asset_store.verify(viirs_zip_file)
+            if is_cached:
+                asset_store.touch(viirs_unzip_file)
+            elif is_zip_cached:
+                asset_store.touch(viirs_zip_file)
+            else:
+                viirs_zip_file = download_url(
+                    viirs_url, dest=viirs_cache_dir, session=session
+                )
+                if stream:
+                    asset_store.add(viirs_zip_file, "nightlights", url=viirs_url)
+            if not is_cached and not stream:
+                viirs_unzip_file = unzip_eog_gzip(
+                    viirs_zip_file, dest=viirs_cache_dir, delete_src=True
+                )
+                asset_store.remove(viirs_zip_file, delete=False)
+                asset_store.add(viirs_unzip_file, "nightlights", url=viirs_url)
+                is_cached = True
+
+        if is_cached:
+            return clip_raster(
+                viirs_unzip_file.as_posix(),
+                dest.as_posix(),
+                bounds,
+                buffer=0.1,
+                snap_to_pixels=snap_to_pixels,
+            )
+        logger.info(f"Streaming clip from gzipped global file {viirs_zip_file}")
+        clipped_file = clip_gzip_raster(
+            viirs_zip_file,
+            dest.as_posix(),
+            bounds,
+            buffer=0.1,
+            snap_to_pixels=snap_to_pixels,
         )
-    clipped_raster = clip_raster(
-        viirs_unzip_file.as_posix(), dest.as_posix(), bounds, buffer=0.1
-    )
-    return clipped_raster
 
+    # Clips still streaming from the gzipped file hold a lease on it, so the last one
+    # to finish deletes it
+    if not keep_download and asset_store.discard(viirs_zip_file):
+        logger.info(f"Deleted gzipped global file {viirs_zip_file}")
+    return clipped_file
 
-def generate_clipped_metadata(
-    year,
-    bounds,
-    viirs_data_type,
-    version,
-    product,
-    coverage,
-    clip_cache_dir,
-    process_suffix,
-    vcmcfg,
-):
-    key = make_clip_hash(
-        year,
-        bounds,
-        viirs_data_type,
-        version,
-        product,
-        coverage,
-        process_suffix,
-        vcmcfg,
-    )
-    clip_meta_data = dict(
-        bounds=np.array2string(bounds),
-        year=str(year),
-        viirs_data_type=viirs_data_type,
-        version=version,
-        product=product,
-        coverage=coverage,
-        process_suffix=process_suffix,
-        vcmcfg=vcmcfg,
-    )
-    clipped_metadata_file = clip_cache_dir / f"{key}.metadata.json"
-    logger.info(f"Adding metadata.json file {clipped_metadata_file}")
-    with open(clipped_metadata_file, "w") as f:
-        f.write(json.dumps(clip_meta_data))
+
+class ClipCache:
+    """Manifest of the clipped rasters in clip_cache_dir, stored in one SQLite database.
+
+    Each clip is recorded with its product parameters, the extent it was clipped to,
+    its size and when it was last used. Clips are found by key or, for new bounds, by
+    an existing clip of the same product and year whose extent contains them, so that
+    the new clip is a window read of that clip instead of the global raster. Clips are
+    evicted by the asset store (see `AssetStore.gc`) along with the other cached files,
+    so clips whose file is gone are dropped from the manifest.
+    """
+
+    MANIFEST_FILENAME = "manifest.sqlite"
+    PARAM_COLUMNS = [
+        "year",
+        "viirs_data_type",
+        "version",
+        "product",
+        "coverage",
+        "process_suffix",
+        "vcmcfg",
+        "snap_to_pixels",
+    ]
+
+    def __init__(self, clip_cache_dir):
+        self.clip_cache_dir = Path(os.path.expanduser(clip_cache_dir))
+        self.clip_cache_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.clip_cache_dir / self.MANIFEST_FILENAME
+        with self._connect() as conn:
+            conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS clips (
+                    key TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    {", ".join(f"{column} TEXT NOT NULL" for column in self.PARAM_COLUMNS)},
+                    minx REAL NOT NULL,
+                    miny REAL NOT NULL,
+                    maxx REAL NOT NULL,
+                    maxy REAL NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )"""
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(clips)")]
+            if "snap_to_pixels" not in columns:
+                # Manifests written before clips could be snapped to whole pixels
+                conn.execute(
+                    "ALTER TABLE clips ADD COLUMN snap_to_pixels TEXT NOT NULL DEFAULT 'False'"
+                )
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS clips_params ON clips ({', '.join(self.PARAM_COLUMNS)}, minx, maxx)"
+            )
+        self._import_metadata_files()
+        self.prune()
+
+    def _connect(self):
+        return contextlib.closing(sqlite3.connect(self.manifest_path, timeout=60))
+
+    def get(self, key):
+        "Path of the clip with the key, or None if it is not cached"
+        with self._connect() as conn, conn:
+            row = conn.execute(
+                "SELECT filename FROM clips WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            clip_file = self.clip_cache_dir / row[0]
+            if not clip_file.exists():
+                conn.execute("DELETE FROM clips WHERE key = ?", (key,))
+                return None
+            conn.execute(
+                "UPDATE clips SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+        return clip_file
+
+    def find_containing(self, params, extent):
+        "Path of the smallest cached clip of the product params whose extent contains extent"
+        minx, miny, maxx, maxy = (float(x) for x in extent)
+        with self._connect() as conn, conn:
+            rows = conn.execute(
+                f"""SELECT key, filename FROM clips
+                WHERE {" AND ".join(f"{column} = ?" for column in self.PARAM_COLUMNS)}
+                AND minx <= ? AND miny <= ? AND maxx >= ? AND maxy >= ?
+                ORDER BY (maxx - minx) * (maxy - miny)""",
+                (*self._param_values(params), minx, miny, maxx, maxy),
+            ).fetchall()
+            for key, filename in rows:
+                clip_file = self.clip_cache_dir / filename
+                if clip_file.exists():
+                    conn.execute(
+                        "UPDATE clips SET last_access = ? WHERE key = ?",
+                        (time.time(), key),
+                    )
+                    return clip_file
+                conn.execute("DELETE FROM clips WHERE key = ?", (key,))
+        return None
+
+    def add(self, key, params, extent, clip_file):
+        "Record the clip file of the product params clipped to extent"
+        clip_file = Path(clip_file)
+        with self._connect() as conn, conn:
+            conn.execute(
+                f"""INSERT OR REPLACE INTO clips
+                (key, filename, {", ".join(self.PARAM_COLUMNS)}, minx, miny, maxx, maxy, size_bytes, last_access)
+                VALUES ({", ".join("?" * (len(self.PARAM_COLUMNS) + 8))})""",
+                (
+                    key,
+                    clip_file.name,
+                    *self._param_values(params),
+                    *(float(x) for x in extent),
+                    clip_file.stat().st_size,
+                    time.time(),
+                ),
+            )
+
+    def size_bytes(self):
+        "Total size of the cached clips"
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(size_bytes), 0) FROM clips"
+            ).fetchone()[0]
+
+    def prune(self):
+        "Drop the clips whose file was deleted, e.g. evicted by the asset store"
+        filenames = set(os.listdir(self.clip_cache_dir))
+        with self._connect() as conn, conn:
+            rows = conn.execute("SELECT key, filename FROM clips").fetchall()
+            conn.executemany(
+                "DELETE FROM clips WHERE key = ?",
+                [(key,) for key, filename in rows if filename not in filenames],
+            )
+
+    def _param_values(self, params):
+        return [str(params[column]) for column in self.PARAM_COLUMNS]
+
+    def _import_metadata_files(self):
+        # Clips cached before the manifest have a {key}.metadata.json file each
+        for metadata_file in self.clip_cache_dir.glob("*.metadata.json"):
+            key = metadata_file.name[: -len(".metadata.json")]
+            clip_file = self.clip_cache_dir / f"{key}.tif"
+            if clip_file.exists():
+                with open(metadata_file) as f:
+                    params = dict(snap_to_pixels=False, **json.load(f))
+                with rasterio.open(clip_file) as src:
+                    extent = tuple(src.bounds)
+                logger.info(f"Adding clipped raster file {clip_file} to the manifest")
+                self.add(key, params, extent, clip_file)
+            metadata_file.unlink()
 
 
 def get_clipped_raster(
@@ -441,7 +1001,23 @@ def get_clipped_raster(
     cache_dir=NIGHTLIGHTS_CACHE_DIR,
     process_suffix="c202205302300",
     vcmcfg="vcmslcfg",
+    stream=False,
+    use_cog=False,
+    session=None,
+    max_size_bytes=None,
+    snap_to_pixels=False,
+    keep_download=False,
 ):
+    """Get the VIIRS raster clipped to the bounds (plus a 0.1 degree buffer) from the clip cache.
+
+    If no clip of the bounds is cached, it is clipped from the global raster (see
+    `generate_clipped_raster`). With snap_to_pixels, it is clipped instead from the smallest
+    cached snapped clip of the same product and year that contains it, which is on the grid
+    of the global raster so the clip is the same. Unsnapped clips are on a grid shifted by
+    their bounds, so clipping them again would resample the values. See `ClipCache` for the
+    clip cache manifest. Clips are evicted with the least recently used files of the asset
+    store when they exceed its budget, which max_size_bytes sets if given.
+    """
     key = make_clip_hash(
         year,
         bounds,
@@ -451,39 +1027,103 @@ def get_clipped_raster(
         coverage,
         process_suffix,
         vcmcfg,
+        snap_to_pixels,
     )
-    clip_cache_dir = Path(os.path.expanduser(cache_dir)) / "clip"
-    clip_cache_dir.mkdir(parents=True, exist_ok=True)
-    clipped_file = clip_cache_dir / f"{key}.tif"
-    if clipped_file.exists():
+    clip_cache = ClipCache(Path(os.path.expanduser(cache_dir)) / "clip")
+    asset_store = get_nightlights_asset_store(cache_dir, max_size_bytes=max_size_bytes)
+    clipped_file = clip_cache.get(key)
+    if clipped_file is not None:
         logger.info(f"Retrieving clipped raster file {clipped_file}")
+        asset_store.touch(clipped_file)
         return clipped_file
-    # generate clipped raster
-    clipped_file = generate_clipped_raster(
-        year,
-        bounds,
-        clipped_file,
+
+    params = dict(
+        year=year,
         viirs_data_type=viirs_data_type,
         version=version,
         product=product,
         coverage=coverage,
         process_suffix=process_suffix,
         vcmcfg=vcmcfg,
+        snap_to_pixels=snap_to_pixels,
+    )
+    extent = get_bounding_polygon(bounds, buffer=0.1).bounds
+    clipped_file = clip_cache.clip_cache_dir / f"{key}.tif"
+    containing_file = (
+        clip_cache.find_containing(params, extent) if snap_to_pixels else None
     )
-    generate_clipped_metadata(
+    with asset_store.lease(*filter(None, [containing_file])):
+        # The containing clip could have been evicted before it was leased
+        if containing_file is not None and containing_file.exists():
+            logger.info(f"Clipping from cached clipped raster file {containing_file}")
+            asset_store.touch(containing_file)
+            clip_raster(
+                containing_file.as_posix(),
+                clipped_file.as_posix(),
+                bounds,
+                buffer=0.1,
+                snap_to_pixels=snap_to_pixels,
+            )
+        else:
+            clipped_file = generate_clipped_raster(
+                year,
+                bounds,
+                clipped_file,
+                viirs_data_type=viirs_data_type,
+                version=version,
+                product=product,
+                coverage=coverage,
+                cache_dir=cache_dir,
+                process_suffix=process_suffix,
+                vcmcfg=vcmcfg,
+                stream=stream,
+                use_cog=use_cog,
+                session=session,
+                snap_to_pixels=snap_to_pixels,
+                keep_download=keep_download,
+            )
+    clip_cache.add(key, params, extent, clipped_file)
+    # Clips can be clipped again from the source url, so they are evictable assets
+    viirs_url = make_url(
         year,
-        bounds,
-        viirs_data_type,
-        version,
-        product,
-        coverage,
-        clip_cache_dir,
-        process_suffix,
-        vcmcfg,
+        viirs_data_type=viirs_data_type,
+        version=version,
+        product=product,
+        coverage=coverage,
+        process_suffix=process_suffix,
+        vcmcfg=vcmcfg,
     )
+    asset_store.add(clipped_file, "nightlights", url=viirs_url)
     return clipped_file
 
 
+def cluster_aoi(aoi, max_gap=0.2, cluster_col=None):
+    """Label each aoi row with a compact spatial cluster, e.g. to clip each cluster separately.
+
+    Rows whose bounding boxes are within max_gap degrees of each other (directly or
+    through other rows) are in the same cluster. With cluster_col, rows are clustered
+    by its values instead, e.g. one cluster per city. Rows with empty geometries are -1.
+    """
+    if cluster_col is not None:
+        return pd.factorize(aoi[cluster_col])[0]
+    geometry = aoi.geometry
+    has_geometry = ~(geometry.is_empty | geometry.isna()).to_numpy()
+    minx, miny, maxx, maxy = geometry[has_geometry].bounds.to_numpy().T
+    boxes = shapely.box(
+        minx - max_gap / 2, miny - max_gap / 2, maxx + max_gap / 2, maxy + max_gap / 2
+    )
+    clusters = shapely.get_parts(shapely.unary_union(boxes))
+    box_idx, cluster_idx = shapely.STRtree(clusters).query(
+        boxes, predicate="intersects"
+    )
+    box_clusters = np.empty(len(boxes), dtype=int)
+    box_clusters[box_idx] = cluster_idx
+    # Clusters are numbered in order of their first row
+    labels = np.full(len(aoi), -1)
+    labels[has_geometry] = pd.factorize(box_clusters)[0]
+    return labels
+
+
 def generate_nightlights_feature(
     aoi,
     year,
@@ -498,10 +1138,67 @@ def generate_nightlights_feature(
     func=["min", "max", "mean", "median", "std"],
     column="avg_rad",
     copy=False,
+    stream=False,
+    keep_download=False,
+    use_cog=False,
+    use_pixel_coverage=False,
+    clip_per_cluster=False,
+    cluster_max_gap=0.2,
+    cluster_col=None,
 ):
+    """Raster zonal stats of the clipped VIIRS raster of the year over the aoi.
+
+    With use_pixel_coverage, the pixels covered by each aoi geometry are persisted
+    on the clipped raster grid (see `src.pixel_coverage.PixelCoverage`) and reused
+    for every year and viirs data type sharing the grid, instead of rasterizing
+    the aoi again for each raster.
+
+    With clip_per_cluster, the aoi is split into compact clusters (see `cluster_aoi`)
+    which are clipped and processed separately, instead of clipping the bounding box of
+    the whole aoi, which is mostly empty for scattered aois. The cluster clips are snapped
+    to whole pixels, so they are on the grid of the global raster whatever their bounds
+    and the stats of each row do not depend on how the aoi is clustered.
+    """
     if year >= 2022:
         version = EOG_PRODUCT_VERSION.VER22
 
+    coverage_cache_dir = (
+        Path(os.path.expanduser(cache_dir)) / "coverage" if use_pixel_coverage else None
+    )
+    if clip_per_cluster:
+        labels = cluster_aoi(aoi, max_gap=cluster_max_gap, cluster_col=cluster_col)
+        cluster_stats = []
+        for label in np.unique(labels[labels >= 0]):
+            positions = np.flatnonzero(labels == label)
+            cluster = aoi.iloc[positions]
+            clipped_raster_file = get_clipped_raster(
+                year,
+                cluster.total_bounds,
+                viirs_data_type=viirs_data_type,
+                version=version,
+                product=product,
+                coverage=coverage,
+                cache_dir=cache_dir,
+                process_suffix=process_suffix,
+                vcmcfg=vcmcfg,
+                stream=stream,
+                keep_download=keep_download,
+                use_cog=use_cog,
+                snap_to_pixels=True,
+            )
+            cluster_stats.append(
+                _zonal_stats(
+                    cluster,
+                    clipped_raster_file.as_posix(),
+                    func,
+                    column,
+                    extra_args,
+                    coverage_cache_dir,
+                ).set_axis(positions)
+            )
+        stats = _merge_cluster_stats(cluster_stats, len(aoi), func, column)
+        return aoi.join(stats.set_axis(aoi.index))
+
     clipped_raster_file = get_clipped_raster(
         year,
         aoi.total_bounds,
@@ -512,7 +1209,20 @@ def generate_nightlights_feature(
         cache_dir=cache_dir,
         process_suffix=process_suffix,
         vcmcfg=vcmcfg,
+        stream=stream,
+        keep_download=keep_download,
+        use_cog=use_cog,
     )
+    if use_pixel_coverage:
+        stats = _pixel_coverage_zonal_stats(
+            aoi,
+            clipped_raster_file.as_posix(),
+            func,
+            column,
+            extra_args,
+            coverage_cache_dir,
+        )
+        return aoi.join(stats.set_axis(aoi.index))
     if copy:
         aoi = aoi.copy()
     aoi = rzs.create_raster_zonal_stats(
@@ -526,3 +1236,547 @@ def generate_nightlights_feature(
     )
     # aoi['year'] = year
     return aoi
+
+
+def _pixel_coverage_zonal_stats(
+    aoi, raster_file, func, column, extra_args, coverage_cache_dir
+):
+    with rasterio.open(raster_file) as src:
+        transform, shape = src.transform, src.shape
+    coverage = get_pixel_coverage(
+        aoi,
+        transform,
+        shape,
+        coverage_cache_dir,
+        all_touched=extra_args.get("all_touched", False),
+    )
+    return coverage.raster_zonal_stats(
+        raster_file,
+        func,
+        column,
+        band_num=extra_args.get("band_num", 1),
+        nodata=extra_args.get("nodata"),
+    )
+
+
+def _zonal_stats(aoi, raster_file, func, column, extra_args, coverage_cache_dir=None):
+    # Stat columns of the aoi rows by position
+    if coverage_cache_dir is not None:
+        return _pixel_coverage_zonal_stats(
+            aoi, raster_file, func, column, extra_args, coverage_cache_dir
+        )
+    aoi = rzs.create_raster_zonal_stats(
+        aoi[[aoi.geometry.name]].reset_index(drop=True),
+        raster_file,
+        aggregation=dict(func=func, column=column),
+        extra_args=dict(extra_args),
+    )
+    stat_columns = [f"{column}_{f}" for f in func]
+    return pd.DataFrame(aoi[stat_columns])
+
+
+def _merge_cluster_stats(cluster_stats, num_rows, func, column):
+    # Stats of the clusters indexed by aoi row position, NaN for unclustered rows
+    stat_columns = [f"{column}_{f}" for f in func]
+    if not cluster_stats:
+        return pd.DataFrame(np.nan, index=range(num_rows), columns=stat_columns)
+    return pd.concat(cluster_stats).reindex(range(num_rows))
+
+
+def read_on_grid(raster_file, transform, shape, nodata=-999, band_num=1):
+    """Read a band of a raster as float32 on the grid with transform and shape, which must
+    have the same pixel size. Pixels outside of the raster or equal to its nodata are nodata,
+    or NaN if nodata is None."""
+    if nodata is None:
+        nodata = np.nan
+    height, width = shape
+    with rasterio.open(raster_file) as src:
+        window = src.window(*rasterio.transform.array_bounds(height, width, transform))
+        values = src.read(
+            band_num,
+            window=window.round_offsets().round_lengths(),
+            out_shape=(height, width),
+            out_dtype="float32",
+            boundless=True,
+            fill_value=nodata,
+        )
+        if src.nodata is not None:
+            values[values == src.nodata] = nodata
+    return values
+
+
+def stack_rasters(raster_files, nodata=-999, band_num=1):
+    "Stack a band of each raster on the grid of the first into a band x row x col array and its transform"
+    with rasterio.open(raster_files[0]) as src:
+        transform, shape = src.transform, src.shape
+    values = np.stack(
+        [
+            read_on_grid(raster_file, transform, shape, nodata, band_num)
+            for raster_file in raster_files
+        ]
+    )
+    return values, transform
+
+
+def _stacked_zonal_stats(
+    aoi, raster_files, aggregations, extra_args, coverage_cache_dir
+):
+    # Zonal stats of the aggregations over the bands of the stacked rasters, in one
+    # rasterization of the aoi and one gather of its pixels
+    nodata = extra_args.get("nodata")
+    values, transform = stack_rasters(
+        raster_files, nodata=nodata, band_num=extra_args.get("band_num", 1)
+    )
+    all_touched = extra_args.get("all_touched", False)
+    if coverage_cache_dir is not None:
+        coverage = get_pixel_coverage(
+            aoi,
+            transform,
+            values.shape[1:],
+            coverage_cache_dir,
+            all_touched=all_touched,
+        )
+    else:
+        coverage = PixelCoverage.from_geometries(
+            aoi, transform, values.shape[1:], all_touched=all_touched
+        )
+    return coverage.multiband_zonal_stats(values, aggregations, nodata=nodata)
+
+
+def generate_nightlights_products_feature(
+    aoi,
+    year,
+    aggregations=[
+        dict(
+            viirs_data_type=EOG_VIIRS_DATA_TYPE.AVERAGE,
+            func=["min", "max", "mean", "median", "std"],
+            column="avg_rad",
+        )
+    ],
+    product=EOG_PRODUCT.ANNUAL,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    extra_args=dict(band_num=1, nodata=-999),
+    stream=False,
+    keep_download=False,
+    use_cog=False,
+    use_pixel_coverage=False,
+):
+    """Raster zonal stats of several VIIRS products of the year over the aoi in a single pass.
+
+    Each aggregation is a dict with the viirs_data_type, func and column of the stat
+    columns, e.g. `dict(viirs_data_type="cf_cvg", func=["mean"], column="cf_cvg")`. The
+    clipped rasters of the products are stacked into one band x row x col array, so the
+    aoi is rasterized once (see `src.pixel_coverage.PixelCoverage`) and the stats of all
+    products are computed from one gather of the pixels of each aoi geometry, instead of
+    one `generate_nightlights_feature` call per product. With use_pixel_coverage, the
+    rasterized aoi is also persisted for other years.
+    """
+    version = EOG_PRODUCT_VERSION.VER22 if year >= 2022 else EOG_PRODUCT_VERSION.VER21
+    viirs_data_types = list(
+        dict.fromkeys(agg["viirs_data_type"] for agg in aggregations)
+    )
+    clipped_raster_files = [
+        get_clipped_raster(
+            year,
+            aoi.total_bounds,
+            viirs_data_type=viirs_data_type,
+            version=version,
+            product=product,
+            coverage=coverage,
+            cache_dir=cache_dir,
+            stream=stream,
+            keep_download=keep_download,
+            use_cog=use_cog,
+        ).as_posix()
+        for viirs_data_type in viirs_data_types
+    ]
+    stats = _stacked_zonal_stats(
+        aoi,
+        clipped_raster_files,
+        [
+            dict(
+                band=viirs_data_types.index(agg["viirs_data_type"]),
+                func=agg["func"],
+                column=agg["column"],
+            )
+            for agg in aggregations
+        ],
+        extra_args,
+        Path(os.path.expanduser(cache_dir)) / "coverage"
+        if use_pixel_coverage
+        else None,
+    )
+    return aoi.join(stats.set_axis(aoi.index))
+
+
+_zonal_stats_aoi = None
+
+
+def _init_zonal_stats_worker(aoi):
+    # The aoi is sent once per worker process instead of once per raster
+    global _zonal_stats_aoi
+    _zonal_stats_aoi = aoi
+
+
+def _raster_zonal_stats(
+    raster_file, func, column, extra_args, coverage_cache_dir=None, positions=None
+):
+    aoi = _zonal_stats_aoi if positions is None else _zonal_stats_aoi.iloc[positions]
+    return _zonal_stats(aoi, raster_file, func, column, extra_args, coverage_cache_dir)
+
+
+def _stacked_raster_zonal_stats(
+    raster_files, func, column, extra_args, coverage_cache_dir=None, positions=None
+):
+    # Same stat columns as `_raster_zonal_stats` for each raster, from one pass over the stack
+    aoi = _zonal_stats_aoi if positions is None else _zonal_stats_aoi.iloc[positions]
+    stats = _stacked_zonal_stats(
+        aoi,
+        raster_files,
+        [
+            dict(band=band, func=func, column=str(band))
+            for band in range(len(raster_files))
+        ],
+        extra_args,
+        coverage_cache_dir,
+    )
+    return [
+        stats[[f"{band}_{f}" for f in func]].set_axis(
+            [f"{column}_{f}" for f in func], axis=1
+        )
+        for band in range(len(raster_files))
+    ]
+
+
+def generate_nightlights_features(
+    aoi,
+    years,
+    viirs_data_types=[EOG_VIIRS_DATA_TYPE.AVERAGE],
+    product=EOG_PRODUCT.ANNUAL,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    extra_args=dict(band_num=1, nodata=-999),
+    func=["min", "max", "mean", "median", "std"],
+    column="avg_rad",
+    max_download_workers=4,
+    max_workers=None,
+    stream=False,
+    keep_download=False,
+    use_cog=False,
+    use_pixel_coverage=False,
+    clip_per_cluster=False,
+    cluster_max_gap=0.2,
+    cluster_col=None,
+    stack_products=False,
+):
+    """Generate nightlights features of the aoi for every year and viirs data type in one batch.
+
+    Rasters are downloaded and clipped concurrently by up to max_download_workers threads
+    sharing a pooled `requests.Session`, and the raster zonal stats of each clipped raster
+    run in a pool of max_workers processes as soon as it is ready, so downloads overlap
+    with zonal stats. With use_pixel_coverage, the aoi is rasterized once per clipped grid
+    and with clip_per_cluster, each cluster of the aoi is clipped and processed separately
+    (see `generate_nightlights_feature`). With stack_products, the zonal stats of all viirs
+    data types of a year run in one pass over their stacked clipped rasters once they are
+    all ready (see `generate_nightlights_products_feature`). Returns a long-format dataframe
+    with one row per aoi row, year and viirs data type, indexed like the aoi.
+    """
+    if clip_per_cluster:
+        labels = cluster_aoi(aoi, max_gap=cluster_max_gap, cluster_col=cluster_col)
+    else:
+        labels = np.zeros(len(aoi), dtype=int)
+    clusters = {
+        label: np.flatnonzero(labels == label)
+        for label in np.unique(labels[labels >= 0])
+    }
+    jobs = [
+        (year, viirs_data_type)
+        for year in years
+        for viirs_data_type in viirs_data_types
+    ]
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=max_download_workers, pool_maxsize=max_download_workers
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def clip_job(job, label):
+        year, viirs_data_type = job
+        return get_clipped_raster(
+            year,
+            aoi.iloc[clusters[label]].total_bounds,
+            viirs_data_type=viirs_data_type,
+            version=EOG_PRODUCT_VERSION.VER22
+            if year >= 2022
+            else EOG_PRODUCT_VERSION.VER21,
+            product=product,
+            coverage=coverage,
+            cache_dir=cache_dir,
+            stream=stream,
+            keep_download=keep_download,
+            use_cog=use_cog,
+            session=session,
+            snap_to_pixels=clip_per_cluster,
+        )
+
+    # Raster zonal stats are merged back by position, so the aoi index is restored after
+    aoi_geometry = aoi[[aoi.geometry.name]].reset_index(drop=True)
+    cluster_stats = {job: [] for job in jobs}
+    coverage_cache_dir = (
+        Path(os.path.expanduser(cache_dir)) / "coverage" if use_pixel_coverage else None
+    )
+    with contextlib.closing(session), ThreadPoolExecutor(
+        max_workers=max_download_workers
+    ) as download_executor, ProcessPoolExecutor(
+        max_workers=max_workers,
+        # Forking while the download threads hold locks could deadlock the workers
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_zonal_stats_worker,
+        initargs=(aoi_geometry,),
+    ) as zonal_stats_executor:
+        clip_futures = {
+            download_executor.submit(clip_job, job, label): (job, label)
+            for job in jobs
+            for label in clusters
+        }
+        zonal_stats_futures = {}
+        # Clipped rasters of each year and cluster waiting for the other data types to stack
+        stacks = {}
+        for clip_future in as_completed(clip_futures):
+            (year, viirs_data_type), label = clip_futures[clip_future]
+            positions = None if len(clusters[label]) == len(aoi) else clusters[label]
+            clipped_file = clip_future.result().as_posix()
+            if not stack_products:
+                zonal_stats_future = zonal_stats_executor.submit(
+                    _raster_zonal_stats,
+                    clipped_file,
+                    func,
+                    column,
+                    extra_args,
+                    coverage_cache_dir,
+                    positions,
+                )
+                zonal_stats_futures[zonal_stats_future] = (
+                    [(year, viirs_data_type)],
+                    label,
+                )
+                continue
+            stack = stacks.setdefault((year, label), {})
+            stack[viirs_data_type] = clipped_file
+            if len(stack) == len(viirs_data_types):
+                zonal_stats_future = zonal_stats_executor.submit(
+                    _stacked_raster_zonal_stats,
+                    [stack[viirs_data_type] for viirs_data_type in viirs_data_types],
+                    func,
+                    column,
+                    extra_args,
+                    coverage_cache_dir,
+                    positions,
+                )
+                zonal_stats_futures[zonal_stats_future] = (
+                    [(year, viirs_data_type) for viirs_data_type in viirs_data_types],
+                    label,
+                )
+        for zonal_stats_future in as_completed(zonal_stats_futures):
+            stats_jobs, label = zonal_stats_futures[zonal_stats_future]
+            stats = zonal_stats_future.result()
+            if not stack_products:
+                stats = [stats]
+            for job, job_stats in zip(stats_jobs, stats):
+                cluster_stats[job].append(job_stats.set_axis(clusters[label]))
+
+    return pd.concat(
+        [
+            _merge_cluster_stats(cluster_stats[job], len(aoi), func, column)
+            .set_axis(aoi.index)
+            .assign(year=job[0], viirs_data_type=job[1])
+            for job in jobs
+        ]
+    )
+
+
+class NightlightsCube:
+    """Memory-mapped year x row x col array of the clipped VIIRS rasters of an aoi.
+
+    The cube is a raw float32 array in cube_dir/cube.dat with a cube.json sidecar
+    holding its shape, transform, crs, years and nodata. Opening a cube maps the array
+    without reading it, so time series queries only touch the pages of the pixels they
+    need. Build one with `build_nightlights_cube`.
+    """
+
+    DATA_FILENAME = "cube.dat"
+    SIDECAR_FILENAME = "cube.json"
+
+    def __init__(self, cube_dir):
+        self.cube_dir = Path(os.path.expanduser(cube_dir))
+        with open(self.cube_dir / self.SIDECAR_FILENAME) as f:
+            self.metadata = json.load(f)
+        self.years = self.metadata["years"]
+        self.transform = rasterio.Affine(*self.metadata["transform"])
+        self.crs = self.metadata["crs"]
+        self.nodata = self.metadata["nodata"]
+        self.values = np.memmap(
+            self.cube_dir / self.DATA_FILENAME,
+            dtype=self.metadata["dtype"],
+            mode="r",
+            shape=tuple(self.metadata["shape"]),
+        )
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def pixel_time_series(self, x, y):
+        "Values of the pixel containing the point x, y (in the cube crs) for each year"
+        col, row = ~self.transform * (x, y)
+        row, col = int(np.floor(row)), int(np.floor(col))
+        if not (0 <= row < self.shape[1] and 0 <= col < self.shape[2]):
+            raise ValueError(f"Point {(x, y)} is outside of the cube")
+        values = self.values[:, row, col].astype(np.float64)
+        if self.nodata is not None:
+            values[values == self.nodata] = np.nan
+        return pd.Series(values, index=pd.Index(self.years, name="year"))
+
+    def zonal_time_series(
+        self,
+        aoi,
+        func=["mean"],
+        column="avg_rad",
+        coverage_cache_dir=None,
+        all_touched=False,
+    ):
+        """Zonal stats of the aoi geometries for each year, through the pixel coverage of the
+        aoi on the cube grid (see `src.pixel_coverage.PixelCoverage`). Returns a long-format
+        dataframe with one row per aoi row and year, indexed like the aoi."""
+        if coverage_cache_dir is None:
+            coverage_cache_dir = self.cube_dir / "coverage"
+        coverage = get_pixel_coverage(
+            aoi,
+            self.transform,
+            self.shape[1:],
+            coverage_cache_dir,
+            all_touched=all_touched,
+        )
+        return pd.concat(
+            [
+                coverage.zonal_stats(self.values[i], func, column, nodata=self.nodata)
+                .set_axis(aoi.index)
+                .assign(year=year)
+                for i, year in enumerate(self.years)
+            ]
+        )
+
+
+def make_cube_hash(
+    years,
+    bounds,
+    viirs_data_type=EOG_VIIRS_DATA_TYPE.AVERAGE,
+    product=EOG_PRODUCT.ANNUAL,
+    coverage=EOG_COVERAGE.GLOBAL,
+):
+    # Hash of the aoi bounds, data type and years, used as the cube dir name
+    m = hashlib.md5()
+    for item in (
+        np.array2string(np.asarray(bounds)),
+        ",".join(str(year) for year in years),
+        viirs_data_type,
+        product,
+        coverage,
+    ):
+        m.update(item.encode())
+    return m.hexdigest()
+
+
+def build_nightlights_cube(
+    aoi,
+    years,
+    viirs_data_type=EOG_VIIRS_DATA_TYPE.AVERAGE,
+    product=EOG_PRODUCT.ANNUAL,
+    coverage=EOG_COVERAGE.GLOBAL,
+    cache_dir=NIGHTLIGHTS_CACHE_DIR,
+    nodata=-999,
+    stream=False,
+    keep_download=False,
+    use_cog=False,
+):
+    """Stack the clipped VIIRS rasters of the aoi for the years into a `NightlightsCube`.
+
+    The cube is on the grid of the first year's clip and is stored in
+    cache_dir/cube/{key}, where it is reused by later calls with the same aoi bounds,
+    years and data type. Pixels of later years' clips that are missing on the
+    cube grid are filled with nodata.
+    """
+    years = sorted(years)
+    bounds = aoi.total_bounds
+    cube_dir = (
+        Path(os.path.expanduser(cache_dir))
+        / "cube"
+        / make_cube_hash(years, bounds, viirs_data_type, product, coverage)
+    )
+    if (cube_dir / NightlightsCube.SIDECAR_FILENAME).exists():
+        logger.info(f"Retrieving nightlights cube {cube_dir}")
+        return NightlightsCube(cube_dir)
+
+    clipped_files = [
+        get_clipped_raster(
+            year,
+            bounds,
+            viirs_data_type=viirs_data_type,
+            version=EOG_PRODUCT_VERSION.VER22
+            if year >= 2022
+            else EOG_PRODUCT_VERSION.VER21,
+            product=product,
+            coverage=coverage,
+            cache_dir=cache_dir,
+            stream=stream,
+            keep_download=keep_download,
+            use_cog=use_cog,
+        )
+        for year in years
+    ]
+    with rasterio.open(clipped_files[0]) as src:
+        transform, crs, (height, width) = src.transform, src.crs, src.shape
+
+    logger.info(f"Building {len(years)}x{height}x{width} nightlights cube {cube_dir}")
+    cube_dir.parent.mkdir(parents=True, exist_ok=True)
+    # The temp dir is renamed to cube_dir once complete, so there is nothing to clean up
+    tmp_dir = tempfile.mkdtemp(dir=cube_dir.parent)
+    try:
+        values = np.memmap(
+            Path(tmp_dir) / NightlightsCube.DATA_FILENAME,
+            dtype="float32",
+            mode="w+",
+            shape=(len(years), height, width),
+        )
+        for i, clipped_file in enumerate(clipped_files):
+            values[i] = read_on_grid(clipped_file, transform, (height, width), nodata)
+        values.flush()
+        del values
+
+        with open(Path(tmp_dir) / NightlightsCube.SIDECAR_FILENAME, "w") as f:
+            json.dump(
+                dict(
+                    shape=[len(years), height, width],
+                    dtype="float32",
+                    transform=list(transform)[:6],
+                    crs=crs.to_string() if crs is not None else None,
+                    years=years,
+                    nodata=nodata,
+                    viirs_data_type=viirs_data_type,
+                    product=product,
+                    coverage=coverage,
+                    bounds=list(bounds),
+                ),
+                f,
+            )
+        try:
+            os.rename(tmp_dir, cube_dir)
+        except OSError:
+            # Another process built the same cube first
+            logger.info(f"Using nightlights cube {cube_dir} built concurrently")
+    finally:
+        # Nothing is left to remove once the temp dir was renamed into place
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return NightlightsCube(cube_dir)
@@ -1,62 +1,847 @@
+import contextlib
 import gc
 import hashlib
+import json
 import os
 import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
 
 import geopandas as gpd
 import geowrangler.area_zonal_stats as azs
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
+import requests
+import shapely
+from filelock import FileLock
 from geowrangler import grids
-from geowrangler.datasets.ookla import OoklaFile, download_ookla_file, list_ookla_files
+from geowrangler.datasets.ookla import OoklaFile, list_ookla_files
 from loguru import logger
 
+from src.area_weights import AreaWeights
+from src.asset_store import get_asset_store
+from src.quadkeys import QuadkeyIndex, quadkey_cover, quadkeys_to_polygons
 
-def get_OoklaFile(filename):
-    """Get the corresponding OoklaFile tuple given the filename
-    See: https://stackoverflow.com/questions/8023306/get-key-by-value-in-dictionary
+# Columns of the Ookla performance tiles parquet files used downstream.
+# The WKT tile column is not read since tile geometries can be built from the quadkey.
+OOKLA_COLUMNS = [
+    "quadkey",
+    "avg_d_kbps",
+    "avg_u_kbps",
+    "avg_lat_ms",
+    "tests",
+    "devices",
+]
+OOKLA_SCAN_MODES = ["pushdown", "batch"]
+# Yearly features per quadkey as a GeoWrangler-style agg spec over the quarterly rows.
+# See OoklaAggregator for the supported funcs
+OOKLA_YEARLY_AGGREGATIONS = [
+    dict(column="avg_d_kbps", func="mean", output="mean_avg_d_kbps"),
+    dict(column="avg_u_kbps", func="mean", output="mean_avg_u_kbps"),
+    dict(column="avg_lat_ms", func="mean", output="mean_avg_lat_ms"),
+    dict(column="tests", func="mean", output="mean_num_tests"),
+    dict(column="devices", func="mean", output="mean_num_devices"),
+]
+OOKLA_PROCESSED_CACHE_COMPRESSION = "zstd"
+OOKLA_BASE_URL = "https://ookla-open-data.s3.us-west-2.amazonaws.com"
+OOKLA_DOWNLOAD_MANIFEST_FILENAME = "manifest.json"
+# Lon/lat bounds of the Philippines, used as the default region of Ookla regional extracts
+PHILIPPINES_BOUNDS = (116.9, 4.5, 126.7, 21.2)
+OOKLA_REGIONAL_EXTRACT_ROW_GROUP_SIZE = 10_000
+OOKLA_REGION_FILENAME = "region.json"
+# Files of a version of an Ookla panel checkpoint, the manifest marks it as complete
+OOKLA_PANEL_MANIFEST_FILENAME = "manifest.json"
+OOKLA_PANEL_FEATURES_FILENAME = "features.parquet"
+OOKLA_PANEL_STATE_DIRNAME = "yearly_state"
+
+
+def get_OoklaFile(filename, catalog=None):
+    "Get the corresponding OoklaFile tuple given the filename"
+    if catalog is None:
+        catalog = get_ookla_catalog()
+    return catalog.get(filename)
+
+
+@contextlib.contextmanager
+def _atomic_write_path(path):
+    """Yield a temp path to write a file to, which is renamed to path once written.
+    Readers in other threads or processes never see a partially written file."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _list_ookla_quarter_files(type_year_cache_dir, catalog=None):
+    "List (quarter, filepath) of the Ookla files in a type/year cache dir. Quarter is inferred from the filename."
+    quarter_files = []
+    for ookla_filename in sorted(os.listdir(type_year_cache_dir)):
+        # Skip the download manifest and partial downloads
+        if not ookla_filename.endswith(".parquet"):
+            continue
+        ookla_file = get_OoklaFile(ookla_filename, catalog)
+        if ookla_file is None:
+            logger.warning(f"Skipping {ookla_filename} not found in Ookla files")
+            continue
+        quarter = int(ookla_file.quarter)
+        quarter_files.append(
+            (quarter, os.path.join(type_year_cache_dir, ookla_filename))
+        )
+    return quarter_files
+
+
+class OoklaFileCatalog:
+    """Local catalog of the Ookla open data parquet files, indexed by OoklaFile and filename.
+
+    The remote inventory is listed once and stored in cache_dir/ookla/catalog.json, which is
+    reused until it is older than ttl_seconds. If listing fails, a stale catalog is used
+    instead. In offline mode the inventory is never listed: the stored catalog is trusted
+    regardless of age, and without one the catalog is built from the files already in the cache dir.
+    """
+
+    CATALOG_FILENAME = "catalog.json"
+    DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+
+    def __init__(
+        self,
+        cache_dir="~/.geowrangler",
+        ttl_seconds=DEFAULT_TTL_SECONDS,
+        offline=False,
+    ):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.catalog_path = os.path.join(self.cache_dir, "ookla", self.CATALOG_FILENAME)
+        self.ttl_seconds = ttl_seconds
+        self.offline = offline
+        self._files = None
+        self._filenames = None
+        self._lock = threading.Lock()
+
+    @property
+    def files(self):
+        "Dict of OoklaFile(type, year, quarter) to filename"
+        with self._lock:
+            if self._files is None:
+                self._set_files(self._load_files())
+            return self._files
+
+    def refresh(self):
+        "List the remote inventory again and update the stored catalog"
+        with self._lock:
+            self._set_files(self._fetch_files())
+        return self._files
+
+    def get(self, filename):
+        "Get the OoklaFile of a filename, or None if it is not in the catalog"
+        self.files
+        return self._filenames.get(filename)
+
+    def type_year_files(self, type_, year):
+        "Dict of OoklaFile to filename of the available quarters of a type and year"
+        return {
+            ookla_file: filename
+            for ookla_file, filename in self.files.items()
+            if ookla_file.type == str(type_) and ookla_file.year == str(year)
+        }
+
+    def _set_files(self, files):
+        self._files = files
+        self._filenames = {
+            filename: ookla_file for ookla_file, filename in files.items()
+        }
+
+    def _load_files(self):
+        stored = self._read_catalog()
+        if stored is not None:
+            fetched_at, files = stored
+            age = (datetime.now(timezone.utc) - fetched_at).total_seconds()
+            if self.offline or age < self.ttl_seconds:
+                logger.debug(f"Using Ookla file catalog at {self.catalog_path}")
+                return files
+        if self.offline:
+            logger.info(
+                f"Offline mode: building Ookla file catalog from {self.cache_dir}"
+            )
+            return self._scan_local_files()
+        try:
+            return self._fetch_files()
+        except requests.RequestException as e:
+            if stored is None:
+                raise
+            logger.warning(f"Failed to list Ookla files ({e}). Using stale catalog.")
+            return stored[1]
+
+    def _fetch_files(self):
+        logger.debug("Listing available Ookla files")
+        files = list_ookla_files()
+        Path(os.path.dirname(self.catalog_path)).mkdir(parents=True, exist_ok=True)
+        with _atomic_write_path(self.catalog_path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    dict(
+                        fetched_at=datetime.now(timezone.utc).isoformat(),
+                        files=[
+                            dict(ookla_file._asdict(), filename=filename)
+                            for ookla_file, filename in sorted(files.items())
+                        ],
+                    ),
+                    f,
+                    indent=2,
+                )
+        return files
+
+    def _read_catalog(self):
+        if not os.path.exists(self.catalog_path):
+            return None
+        with open(self.catalog_path) as f:
+            catalog = json.load(f)
+        files = {
+            OoklaFile(entry["type"], entry["year"], entry["quarter"]): entry["filename"]
+            for entry in catalog["files"]
+        }
+        return datetime.fromisoformat(catalog["fetched_at"]), files
+
+    def _scan_local_files(self):
+        # Cached files are stored as ookla/{type}/{year}/{filename}. Quarters are read from
+        # the download manifest or inferred from the date in the filename
+        files = {}
+        for filepath in sorted(Path(self.cache_dir, "ookla").glob("*/*/*.parquet")):
+            type_, year = filepath.parent.parent.name, filepath.parent.name
+            if type_ not in ["fixed", "mobile"]:
+                continue
+            download_manifest = _load_download_manifest(filepath.parent)
+            quarter = download_manifest.get(filepath.name, {}).get("quarter")
+            if quarter is None:
+                try:
+                    month = int(filepath.name.split("-")[1])
+                except (IndexError, ValueError):
+                    continue
+                quarter = (month - 1) // 3 + 1
+            files[OoklaFile(type_, year, str(quarter))] = filepath.name
+        return files
+
+
+_ookla_catalogs = {}
+
+
+def get_ookla_catalog(cache_dir="~/.geowrangler", offline=False):
+    "Get the shared OoklaFileCatalog of a cache dir"
+    key = (os.path.expanduser(cache_dir), offline)
+    if key not in _ookla_catalogs:
+        _ookla_catalogs[key] = OoklaFileCatalog(cache_dir, offline=offline)
+    return _ookla_catalogs[key]
+
+
+def _estimate_scan_bytes(parquet_file, row_group_at_a_time=True):
+    """Estimate the memory needed to scan a parquet file from its uncompressed row group sizes.
+    Scans reading a row group at a time only need memory for the largest row group."""
+    metadata = pq.ParquetFile(parquet_file).metadata
+    row_group_bytes = [
+        metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups)
+    ]
+    if not row_group_bytes:
+        return 0
+    return max(row_group_bytes) if row_group_at_a_time else sum(row_group_bytes)
+
+
+class _ByteBudget:
+    """Limits the total bytes reserved by concurrently running tasks.
+    A reservation larger than the whole budget only runs when nothing else is reserved."""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.reserved_bytes = 0
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        if self.max_bytes is None:
+            yield
+            return
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.reserved_bytes == 0
+                or self.reserved_bytes + nbytes <= self.max_bytes
+            )
+            self.reserved_bytes += nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved_bytes -= nbytes
+                self._condition.notify_all()
+
+
+class DataFrameLRUCache:
+    """In-memory cache of dataframes bounded by their total memory usage in bytes.
+    Least recently used entries are evicted first once max_bytes is exceeded."""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get(self, key, default=None):
+        "Get a cached dataframe and mark it as most recently used, counting hits and misses."
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def __getitem__(self, key):
+        df = self.get(key)
+        if df is None:
+            raise KeyError(key)
+        return df
+
+    def __setitem__(self, key, df):
+        nbytes = int(df.memory_usage(deep=True).sum())
+        with self._lock:
+            self.pop(key)
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                logger.debug(
+                    f"Not caching {key} in memory: {nbytes} bytes exceeds the memory budget of {self.max_bytes} bytes"
+                )
+                return
+            self._entries[key] = (df, nbytes)
+            self.resident_bytes += nbytes
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            df, nbytes = self._entries.pop(key)
+            self.resident_bytes -= nbytes
+            return df
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def _evict(self):
+        while self.max_bytes is not None and self.resident_bytes > self.max_bytes:
+            key, (_, nbytes) = self._entries.popitem(last=False)
+            self.resident_bytes -= nbytes
+            self.evictions += 1
+            logger.debug(f"Evicted {key} ({nbytes} bytes) from the memory cache")
+
+    def stats(self):
+        "Hit, miss and eviction counters along with the resident bytes of the cache"
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                resident_bytes=self.resident_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+
+def _is_percentile_func(func):
+    return func.startswith("p") and func[1:].replace(".", "", 1).isdigit()
+
+
+def _percentile_quantile(func):
+    return float(func[1:]) / 100
+
+
+def _fix_ookla_aggregation(agg):
+    "Fix an Ookla agg spec so that func and output are lists of the same length"
+    agg = dict(agg)
+    if isinstance(agg["func"], str):
+        agg["func"] = [agg["func"]]
+    if "output" not in agg:
+        agg["output"] = [f"{func}_{agg['column']}" for func in agg["func"]]
+    elif isinstance(agg["output"], str):
+        agg["output"] = [agg["output"]]
+    if len(agg["output"]) != len(agg["func"]):
+        raise ValueError(f"Number of outputs and funcs do not match in {agg}")
+    return agg
+
+
+class OoklaAggregator:
+    """Running per-quadkey aggregations of Ookla data that are updated batch by batch.
+
+    Aggregations follow the GeoWrangler agg spec, a list of dicts with a column, a list of
+    funcs and optionally a list of output names (default: func + "_" + column). Supported
+    funcs are "mean", "weighted_mean" (weighted by the weights column, e.g. tests), "sum",
+    "count", "min", "max" and approximate percentiles such as "p50" or "p90". Percentiles
+    use log-bucketed sketches with the given relative accuracy for non-negative values.
+
+    Only running sums, counts, min/max and sketch bucket counts are kept per quadkey, so
+    memory scales with the number of distinct quadkeys, and aggregators for different
+    batches, quarters or workers can be merged.
     """
 
-    available_ookla_files = list_ookla_files()
-    for ooklafile_tuple, ooklafile_item in available_ookla_files.items():
-        if ooklafile_item == filename:
-            return ooklafile_tuple
+    STATE_FILENAME = "state.parquet"
+    SKETCHES_FILENAME = "sketches.parquet"
+
+    def __init__(
+        self, aggregations=None, weights_column="tests", relative_accuracy=0.01
+    ):
+        if aggregations is None:
+            aggregations = OOKLA_YEARLY_AGGREGATIONS
+        self.aggregations = [_fix_ookla_aggregation(agg) for agg in aggregations]
+        self.weights_column = weights_column
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.state = None
+        self.sketches = None
+
+        # Running stats needed per column to compute the aggregations
+        self.column_stats = {}
+        for agg in self.aggregations:
+            stats = self.column_stats.setdefault(agg["column"], set())
+            for func in agg["func"]:
+                if func == "mean":
+                    stats.update(["sum", "count"])
+                elif func == "weighted_mean":
+                    stats.update(["weighted_sum", "weight"])
+                elif func in ["sum", "count", "min", "max"]:
+                    stats.add(func)
+                elif _is_percentile_func(func):
+                    stats.add("sketch")
+                else:
+                    raise ValueError(f"Unsupported Ookla aggregation func {func}")
+
+    @property
+    def columns(self):
+        "Columns of the Ookla data needed for the aggregations"
+        columns = ["quadkey"] + list(self.column_stats)
+        if any("weight" in stats for stats in self.column_stats.values()):
+            columns.append(self.weights_column)
+        return list(dict.fromkeys(columns))
+
+    def update(self, df):
+        "Add a batch of Ookla data to the running aggregations"
+        if len(df) == 0:
+            return self
+        quadkeys = df["quadkey"]
+        stat_series = []
+        sketch_dfs = []
+        for column, stats in self.column_stats.items():
+            values = df[column]
+            groups = values.groupby(quadkeys)
+            for stat in ["sum", "count", "min", "max"]:
+                if stat in stats:
+                    stat_series.append(groups.agg(stat).rename(f"{column}__{stat}"))
+            if "weight" in stats:
+                weights = df[self.weights_column].where(values.notna(), 0)
+                stat_series.append(
+                    (values * weights)
+                    .groupby(quadkeys)
+                    .sum()
+                    .rename(f"{column}__weighted_sum")
+                )
+                stat_series.append(
+                    weights.groupby(quadkeys).sum().rename(f"{column}__weight")
+                )
+            if "sketch" in stats:
+                sketch_df = pd.DataFrame(
+                    dict(
+                        quadkey=quadkeys.to_numpy(),
+                        column=column,
+                        bucket=self._bucket(values.to_numpy(dtype=float)),
+                    )
+                )[values.notna().to_numpy()]
+                sketch_dfs.append(
+                    sketch_df.groupby(["quadkey", "column", "bucket"])
+                    .size()
+                    .rename("count")
+                )
+
+        batch_state = pd.concat(stat_series, axis=1) if stat_series else None
+        batch_sketches = pd.concat(sketch_dfs) if sketch_dfs else None
+        self._merge_state(batch_state, batch_sketches)
+        return self
+
+    def merge(self, other):
+        "Merge the running aggregations of another aggregator into this one"
+        self._merge_state(other.state, other.sketches)
+        return self
+
+    def _merge_state(self, state, sketches):
+        if state is not None:
+            if self.state is None:
+                self.state = state
+            else:
+                combined_state = pd.concat([self.state, state])
+                self.state = combined_state.groupby(level=0).agg(
+                    {
+                        col: col.rsplit("__", 1)[-1]
+                        if col.endswith(("__min", "__max"))
+                        else "sum"
+                        for col in combined_state.columns
+                    }
+                )
+        if sketches is not None:
+            if self.sketches is None:
+                self.sketches = sketches
+            else:
+                self.sketches = (
+                    pd.concat([self.sketches, sketches]).groupby(level=[0, 1, 2]).sum()
+                )
+
+    def _bucket(self, values):
+        # Zero and negative values all fall in the lowest bucket
+        with np.errstate(divide="ignore", invalid="ignore"):
+            buckets = np.ceil(np.log(values) / np.log(self.gamma))
+        return np.where(values > 0, buckets, np.iinfo(np.int32).min).astype(np.int32)
+
+    def _bucket_value(self, buckets):
+        values = 2 * np.power(self.gamma, buckets.astype(float)) / (self.gamma + 1)
+        return np.where(buckets == np.iinfo(np.int32).min, 0.0, values)
+
+    def _percentile(self, column, quantile):
+        if self.sketches is None:
+            return pd.Series(np.nan, index=self.state.index)
+        sketch = self.sketches.xs(column, level="column").sort_index()
+        counts = sketch.groupby(level="quadkey").cumsum()
+        totals = sketch.groupby(level="quadkey").transform("sum")
+        # Same rank as the lower value of a linearly interpolated percentile
+        selected = counts[counts > quantile * (totals - 1)].reset_index()
+        buckets = selected.groupby("quadkey")["bucket"].first()
+        return pd.Series(
+            self._bucket_value(buckets.to_numpy()), index=buckets.index
+        ).reindex(self.state.index)
+
+    def result(self, prefix=""):
+        "Compute the aggregations with one row per quadkey, with output names prefixed by prefix"
+        output_columns = [
+            output for agg in self.aggregations for output in agg["output"]
+        ]
+        if self.state is None:
+            return pd.DataFrame(
+                columns=["quadkey"] + [prefix + col for col in output_columns]
+            )
+
+        state = self.state
+        result = pd.DataFrame(index=state.index)
+        for agg in self.aggregations:
+            column = agg["column"]
+            for func, output in zip(agg["func"], agg["output"]):
+                if func == "mean":
+                    count = state[f"{column}__count"]
+                    values = (state[f"{column}__sum"] / count).where(count > 0)
+                elif func == "weighted_mean":
+                    weight = state[f"{column}__weight"]
+                    values = (state[f"{column}__weighted_sum"] / weight).where(
+                        weight > 0
+                    )
+                elif func in ["sum", "count", "min", "max"]:
+                    values = state[f"{column}__{func}"]
+                else:
+                    values = self._percentile(column, _percentile_quantile(func))
+                result[prefix + output] = values
+        result.index.name = "quadkey"
+        return result.reset_index()
+
+    def save(self, directory):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        if self.state is not None:
+            self.state.to_parquet(os.path.join(directory, self.STATE_FILENAME))
+        if self.sketches is not None:
+            self.sketches.to_frame().to_parquet(
+                os.path.join(directory, self.SKETCHES_FILENAME)
+            )
+
+    @classmethod
+    def load(cls, directory, aggregations=None, **kwargs):
+        aggregator = cls(aggregations, **kwargs)
+        state_path = os.path.join(directory, cls.STATE_FILENAME)
+        sketches_path = os.path.join(directory, cls.SKETCHES_FILENAME)
+        if os.path.exists(state_path):
+            aggregator.state = pd.read_parquet(state_path)
+        if os.path.exists(sketches_path):
+            aggregator.sketches = pd.read_parquet(sketches_path)["count"]
+        return aggregator
 
 
 class OoklaDataManager:
     """An instance of this class provides convenience functoins for loading and caching Ookla data"""
 
     DEFAULT_CACHE_DIR = "~/.geowrangler"
+    DEFAULT_MEMORY_BUDGET_BYTES = 2 * 1024**3
+    MANIFEST_FILENAME = "manifest.json"
 
-    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
-        self.data_cache = {}
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES,
+        offline=False,
+        use_regional_extracts=True,
+    ):
+        # Regional extracts built with build_ookla_regional_extract are scanned instead of
+        # the global files for aois they cover
+        # In offline mode only the Ookla files already in the cache dir are used
+        self.offline = offline
+        # Processed data evicted from memory can still be reloaded from the processed cache dir
+        self.data_cache = DataFrameLRUCache(max_bytes=memory_budget_bytes)
         self.cache_dir = os.path.expanduser(cache_dir)
         self.processed_cache_dir = os.path.join(self.cache_dir, "ookla", "processed")
+        self.catalog = get_ookla_catalog(self.cache_dir, offline=offline)
+        self.use_regional_extracts = use_regional_extracts
+        # Futures of the data keys being loaded by a thread, see _single_flight
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.regional_extracts = None
         Path(self.processed_cache_dir).mkdir(parents=True, exist_ok=True)
+        self.manifest_path = os.path.join(
+            self.processed_cache_dir, self.MANIFEST_FILENAME
+        )
+        self.coverage_index_cache = {}
+        self.area_weights_cache = {}
+        self.area_weights_cache_dir = os.path.join(
+            self.cache_dir, "ookla", "area_weights"
+        )
+        self.quadkey_cover_cache = {}
+        self.quadkey_cover_cache_dir = os.path.join(
+            self.cache_dir, "ookla", "quadkey_covers"
+        )
 
     def reinitialize_processed_cache(self):
         "Reinitialize processed_cache_dir to start over from scratch."
         shutil.rmtree(self.processed_cache_dir, ignore_errors=True)
+        self.coverage_index_cache = {}
         response = Path(self.processed_cache_dir).mkdir(parents=True, exist_ok=True)
         logger.info(
             f"{self.processed_cache_dir} reintialized. All cached processed data in this folder has been deleted."
         )
         return response
 
-    def load_type_year_data(
-        self,
-        aoi,
-        type_,
-        year,
-        use_cache=True,
-        return_geometry=False,
-        use_aoi_quadkey=False,
-        aoi_quadkey_col="quadkey",
+    def cache_stats(self):
+        "Hit, miss and eviction counters and resident bytes of the in-memory data cache."
+        return self.data_cache.stats()
+
+    def load_area_weights(self, aoi, metric_crs="epsg:3123", zoom_lvl=16):
+        """Load the AOI x Ookla tile area weights for the aoi geometries, building and
+        caching them in the area_weights dir if not yet available."""
+        m = hashlib.md5()
+        for geom_wkb in aoi.geometry.to_wkb():
+            m.update(geom_wkb)
+        m.update(str(aoi.crs).encode())
+        m.update(str(metric_crs).encode())
+        m.update(str(zoom_lvl).encode())
+        weights_key = m.hexdigest()
+
+        if weights_key in self.area_weights_cache:
+            return self.area_weights_cache[weights_key]
+
+        weights_file_path = os.path.join(
+            self.area_weights_cache_dir, f"{weights_key}.npz"
+        )
+        if os.path.exists(weights_file_path):
+            logger.debug(f"Loading area weights from {weights_file_path}")
+            area_weights = AreaWeights.load(weights_file_path)
+        else:
+            tiles = grids.BingTileGridGenerator(zoom_lvl).generate_grid(aoi)
+            area_weights = AreaWeights.from_geometries(
+                aoi, tiles, "quadkey", metric_crs=metric_crs
+            )
+            Path(self.area_weights_cache_dir).mkdir(parents=True, exist_ok=True)
+            with _atomic_write_path(weights_file_path) as tmp_file_path:
+                with open(tmp_file_path, "wb") as f:
+                    area_weights.save(f)
+            logger.info(f"Saved area weights to {weights_file_path}")
+
+        self.area_weights_cache[weights_key] = area_weights
+        return area_weights
+
+    def load_manifest(self):
+        "Load the manifest of processed cache entries, keyed by data key."
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _update_manifest(self, data_key, entry):
+        # Lock so that concurrent processes don't drop each other's entries, and write to
+        # a temp file first so that the manifest is never left half-written
+        with FileLock(f"{self.manifest_path}.lock"):
+            manifest = self.load_manifest()
+            manifest[data_key] = entry
+            with _atomic_write_path(self.manifest_path) as tmp_manifest_path:
+                with open(tmp_manifest_path, "w") as f:
+                    json.dump(manifest, f, indent=2)
+
+    def _processed_cache_path(self, data_key):
+        return os.path.join(self.processed_cache_dir, f"{data_key}.parquet")
+
+    def _read_processed_cache(self, data_key, return_geometry):
+        """Read a processed cache entry, migrating legacy CSV/GeoJSON entries to parquet.
+        Returns None if there is no cached entry for the data key."""
+        cached_file_path = self._processed_cache_path(data_key)
+        if os.path.exists(cached_file_path):
+            if return_geometry:
+                return gpd.read_parquet(cached_file_path, memory_map=True)
+            return pd.read_parquet(cached_file_path, memory_map=True)
+
+        # Entries written before the parquet cache are stored as CSV or GeoJSON
+        legacy_file_path = os.path.join(
+            self.processed_cache_dir,
+            f"{data_key}.geojson" if return_geometry else f"{data_key}.csv",
+        )
+        if not os.path.exists(legacy_file_path):
+            return None
+
+        logger.info(f"Migrating legacy processed cache file {legacy_file_path}")
+        if return_geometry:
+            df = gpd.read_file(legacy_file_path, driver="GeoJSON")
+        else:
+            df = pd.read_csv(legacy_file_path, dtype={"quadkey": str})
+        self._write_processed_cache(
+            data_key, df, return_geometry, dict(migrated_from=legacy_file_path)
+        )
+        os.remove(legacy_file_path)
+        return df
+
+    def _write_processed_cache(
+        self, data_key, df, return_geometry, key_inputs, coverage_quadkeys=None
     ):
-        "Load Ookla data across all quarters for a specified aoi, type (fixed, mobile) and year"
+        cached_file_path = self._processed_cache_path(data_key)
+        with _atomic_write_path(cached_file_path) as tmp_file_path:
+            df.to_parquet(
+                tmp_file_path,
+                index=False,
+                compression=OOKLA_PROCESSED_CACHE_COMPRESSION,
+            )
+        manifest_entry = dict(
+            file=os.path.basename(cached_file_path),
+            format="geoparquet" if return_geometry else "parquet",
+            num_rows=len(df),
+            created_at=datetime.now(timezone.utc).isoformat(),
+            **key_inputs,
+        )
 
+        # Keep the quadkeys the entry was filtered with so that it can serve any aoi it covers
+        if coverage_quadkeys is not None:
+            coverage_file_path = os.path.join(
+                self.processed_cache_dir, f"{data_key}.coverage.parquet"
+            )
+            with _atomic_write_path(coverage_file_path) as tmp_file_path:
+                pd.DataFrame(dict(quadkey=sorted(set(coverage_quadkeys)))).to_parquet(
+                    tmp_file_path, index=False
+                )
+            manifest_entry["coverage_file"] = os.path.basename(coverage_file_path)
+
+        self._update_manifest(data_key, manifest_entry)
+
+    def _load_coverage_index(self, data_key, coverage_file):
+        if data_key not in self.coverage_index_cache:
+            coverage_quadkeys = pd.read_parquet(
+                os.path.join(self.processed_cache_dir, coverage_file)
+            )["quadkey"]
+            self.coverage_index_cache[data_key] = QuadkeyIndex(coverage_quadkeys)
+        return self.coverage_index_cache[data_key]
+
+    def _get_covering_cached_data(self, type_, year, return_geometry, aoi_quadkeys):
+        """Get processed data for the aoi quadkeys by filtering a cached entry for the same
+        type and year whose quadkey coverage includes all of them. Returns None if there is none."""
+        manifest = self.load_manifest()
+        candidates = [
+            (entry["num_rows"], data_key)
+            for data_key, entry in manifest.items()
+            if "coverage_file" in entry
+            and entry.get("type_") == str(type_)
+            and entry.get("year") == str(year)
+            and entry.get("return_geometry") == return_geometry
+        ]
+
+        # Filter the smallest covering entry
+        for _, data_key in sorted(candidates):
+            coverage_index = self._load_coverage_index(
+                data_key, manifest[data_key]["coverage_file"]
+            )
+            if not coverage_index.contains(aoi_quadkeys).all():
+                continue
+            cached_df = self._get_cached_data(data_key, type_, year, return_geometry)
+            if cached_df is None:
+                continue
+            logger.debug(
+                f"Ookla data for aoi, {type_} {year} is covered by cached data (key: {data_key}). Filtering cached data."
+            )
+            aoi_mask = _quadkey_prefix_mask(
+                pa.array(cached_df["quadkey"]), aoi_quadkeys
+            ).to_numpy(zero_copy_only=False)
+            return cached_df[aoi_mask].reset_index(drop=True)
+
+        return None
+
+    @contextlib.contextmanager
+    def _single_flight(self, data_key, type_, year, return_geometry):
+        """Coalesce concurrent loads of a data key across threads and processes.
+
+        Yields a future that is already resolved if another thread loaded the data, or if
+        another process cached it while waiting for the data key's file lock. Otherwise the
+        caller holds the file lock and should set the loaded data as the future's result,
+        which is shared with the threads waiting on the same data key.
+        """
+        with self._inflight_lock:
+            future = self._inflight.get(data_key)
+            is_loader = future is None
+            if is_loader:
+                future = Future()
+                self._inflight[data_key] = future
+
+        if not is_loader:
+            logger.debug(
+                f"Waiting for Ookla data (key: {data_key}) loaded by another thread"
+            )
+            future.result()
+            yield future
+            return
+
+        try:
+            with FileLock(f"{self._processed_cache_path(data_key)}.lock"):
+                cached_df = self._get_cached_data(
+                    data_key, type_, year, return_geometry
+                )
+                if cached_df is not None:
+                    future.set_result(cached_df)
+                yield future
+                if not future.done():
+                    raise RuntimeError(f"Ookla data (key: {data_key}) was not loaded")
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(data_key, None)
+
+    def _make_data_key(
+        self, aoi, type_, year, return_geometry, use_aoi_quadkey, aoi_quadkey_col
+    ):
         # Generate hash from aoi, type_, and year, which will act as a hash key for the cache
         aoi_bounds = aoi.total_bounds
         data_tuple = (
@@ -71,49 +856,35 @@ class OoklaDataManager:
         for item in data_tuple:
             m.update(item.encode())
         data_key = m.hexdigest()
+        return data_key
+
+    def _get_cached_data(self, data_key, type_, year, return_geometry):
+        "Get processed data from the RAM cache, then the filesystem. Returns None if not cached."
 
         # Get from RAM cache if already available
-        logger.debug(f"Contents of data cache: {list(self.data_cache.keys())}")
-        if data_key in self.data_cache:
+        cached_df = self.data_cache.get(data_key)
+        logger.debug(f"Data cache stats: {self.data_cache.stats()}")
+        if cached_df is not None:
             logger.debug(
                 f"Ookla data for aoi, {type_} {year} (key: {data_key}) found in cache."
             )
-            return self.data_cache[data_key]
+            return cached_df
 
         ## Get cached data from filesystem if saved
-        cached_file_path = (
-            os.path.join(self.processed_cache_dir, f"{data_key}.geojson")
-            if return_geometry
-            else os.path.join(self.processed_cache_dir, f"{data_key}.csv")
-        )
-
-        cached_data_available = os.path.exists(cached_file_path)
+        cached_df = self._read_processed_cache(data_key, return_geometry)
         logger.info(
-            f"Cached data available at {cached_file_path}? {cached_data_available}"
+            f"Cached data available for key {data_key}? {cached_df is not None}"
         )
 
-        if cached_data_available:
+        if cached_df is not None:
             logger.debug(
                 f"Processed Ookla data for aoi, {type_} {year} (key: {data_key}) found in filesystem. Loading in cache."
             )
-            if not return_geometry:
-                df = pd.read_csv(cached_file_path)
-                self.data_cache[data_key] = df
-                return df
-            else:
-                gdf = gpd.read_file(cached_file_path, driver="GeoJSON")
-                self.data_cache[data_key] = gdf
-                return gdf
+            self.data_cache[data_key] = cached_df
+        return cached_df
 
-        logger.debug("No cached data found. Processing Ookla data from scratch.")
-
-        # Otherwise, load from raw file and add to RAM cache
-        type_year_cache_dir = download_ookla_year_data(
-            type_,
-            year,
-            cache_dir=self.cache_dir,
-            use_cache=use_cache,
-        )
+    def _get_aoi_quadkeys(self, aoi, use_aoi_quadkey, aoi_quadkey_col):
+        "Get the quadkeys used to pull intersecting Ookla data for the aoi"
 
         # If use_quadkey. we'll get quadkeys from the input to determine what Ookla data to save
         if use_aoi_quadkey:
@@ -123,60 +894,252 @@ class OoklaDataManager:
             input_aoi_quadkeys = aoi[aoi_quadkey_col].to_list()
             input_aoi_quadkeys = [str(x) for x in input_aoi_quadkeys]
 
-            # Check if zoom level is the same across all items in list
-            input_aoi_quadkeys_iter = iter(input_aoi_quadkeys)
-            first_key_zoom_lvl = len(next(input_aoi_quadkeys_iter))
-            if not all(
-                len(key) == first_key_zoom_lvl for key in input_aoi_quadkeys_iter
-            ):
-                raise ValueError(
-                    f"Not all items in aoi_quadkey_col = {aoi_quadkey_col} are of the same zoom level."
-                )
-
-            input_aoi_quadkey_zoom_lvl = first_key_zoom_lvl
+            # Quadkeys can be at a mix of zoom levels, e.g. from adaptive tilings
+            input_aoi_quadkey_zoom_lvls = sorted(
+                set(len(x) for x in input_aoi_quadkeys)
+            )
             logger.debug(
-                f"Quadkeys in {aoi_quadkey_col} are at zoom level {input_aoi_quadkey_zoom_lvl}."
+                f"Quadkeys in {aoi_quadkey_col} are at zoom levels {input_aoi_quadkey_zoom_lvls}."
             )
+            return input_aoi_quadkeys
+
+        # Else, cover the input aoi with quadkey prefixes of the intersecting zoom 16 tiles
+        m = hashlib.md5()
+        for geom_wkb in aoi.geometry.to_wkb():
+            m.update(geom_wkb)
+        m.update(str(aoi.crs).encode())
+        cover_key = m.hexdigest()
+        if cover_key in self.quadkey_cover_cache:
+            return self.quadkey_cover_cache[cover_key]
 
-        # Else, generate the bing tile quadkeys that intersect with the input aoi
+        cover_file_path = os.path.join(
+            self.quadkey_cover_cache_dir, f"{cover_key}.json"
+        )
+        if os.path.exists(cover_file_path):
+            logger.debug(f"Loading aoi quadkey cover from {cover_file_path}")
+            with open(cover_file_path) as f:
+                aoi_quadkeys = json.load(f)
         else:
             logger.debug(
                 f"Generating quadkeys based on input aoi geometry to pull intersecting Ookla data."
             )
-            bing_tile_grid_generator_no_geom = grids.BingTileGridGenerator(
-                16, return_geometry=False
+            aoi_quadkeys = quadkey_cover(aoi, zoom_lvl=16)
+            Path(self.quadkey_cover_cache_dir).mkdir(parents=True, exist_ok=True)
+            with _atomic_write_path(cover_file_path) as tmp_file_path:
+                with open(tmp_file_path, "w") as f:
+                    json.dump(aoi_quadkeys, f)
+            logger.debug(
+                f"Covered aoi with {len(aoi_quadkeys)} quadkeys at zoom levels {sorted(set(len(x) for x in aoi_quadkeys))}"
             )
-            aoi_quadkeys = bing_tile_grid_generator_no_geom.generate_grid(aoi)[
-                "quadkey"
-            ].tolist()
 
-        # Combine quarterly data for the specified year, filtered to the aoi using quadkey
-        # Quarter is inferred from the Ookla filename
-        quarter_df_list = []
+        self.quadkey_cover_cache[cover_key] = aoi_quadkeys
+        return aoi_quadkeys
 
-        for ookla_filename in sorted(os.listdir(type_year_cache_dir)):
-            quarter = int(getattr(get_OoklaFile(ookla_filename), "quarter"))
-            ookla_quarter_filepath = os.path.join(type_year_cache_dir, ookla_filename)
-            logger.debug(
-                f"Ookla data for aoi, {type_} {year} {quarter} being loaded from {ookla_quarter_filepath}"
+    def _load_regional_extracts(self):
+        "Load the quadkey index and quarters of the regional extracts in the cache dir"
+        if self.regional_extracts is None:
+            self.regional_extracts = {}
+            regional_dir = Path(self.cache_dir, "ookla", "regional")
+            for region_path in sorted(regional_dir.glob(f"*/{OOKLA_REGION_FILENAME}")):
+                with open(region_path) as f:
+                    region = json.load(f)
+                self.regional_extracts[region_path.parent] = (
+                    QuadkeyIndex(region["quadkeys"]),
+                    region["files"],
+                )
+        return self.regional_extracts
+
+    def _get_quarter_files(self, type_, year, use_cache, aoi_quadkeys):
+        """List (quarter, filepath) of the Ookla files to scan for the aoi quadkeys.
+        Files of a regional extract covering the aoi with all available quarters are
+        preferred over downloading and scanning the global files."""
+        if self.use_regional_extracts and use_cache:
+            available_quarters = sorted(
+                int(ookla_file.quarter)
+                for ookla_file in self.catalog.type_year_files(type_, year)
+            )
+            type_year = f"{type_}/{year}"
+            for region_dir, (
+                quadkey_index,
+                files,
+            ) in self._load_regional_extracts().items():
+                region_quarters = sorted(
+                    int(quarter) for quarter in files.get(type_year, {})
+                )
+                if region_quarters != available_quarters or not available_quarters:
+                    continue
+                if not quadkey_index.contains(aoi_quadkeys).all():
+                    continue
+                logger.debug(
+                    f"Using Ookla regional extract {region_dir} for {type_} {year}"
+                )
+                return [
+                    (int(quarter), os.path.join(region_dir, filename))
+                    for quarter, filename in sorted(files[type_year].items())
+                ]
+
+        type_year_cache_dir = download_ookla_year_data(
+            type_,
+            year,
+            cache_dir=self.cache_dir,
+            use_cache=use_cache,
+            catalog=self.catalog,
+        )
+        return _list_ookla_quarter_files(type_year_cache_dir, self.catalog)
+
+    def _load_quarter_data(
+        self, ookla_quarter_filepath, quarter, aoi_quadkeys, use_aoi_quadkey, scan_mode
+    ):
+        "Load a quarterly Ookla parquet file filtered to the aoi quadkeys"
+
+        ## With pushdown, only row groups overlapping the aoi quadkeys are read
+        ## and rows are filtered in Arrow before converting to pandas
+        if scan_mode == "pushdown":
+            quarter_df = _scan_quadkey_parquet_file(
+                ookla_quarter_filepath,
+                aoi_quadkeys,
+                "quadkey",
+                columns=OOKLA_COLUMNS,
             )
+        ## When using quadkey optimizations read and filter Ookla parquet
+        ## in batches to circumvent memory issues
+        ## Read: https://stackoverflow.com/questions/59098785/is-it-possible-to-read-parquet-files-in-chunks
+        elif use_aoi_quadkey:
+            quarter_df = _read_and_filter_quadkey_parquet_file(
+                ookla_quarter_filepath, aoi_quadkeys, "quadkey", columns=OOKLA_COLUMNS
+            )
+        else:
+            table = pq.read_table(ookla_quarter_filepath, columns=OOKLA_COLUMNS)
+            quarter_df = table.filter(
+                _quadkey_prefix_mask(table["quadkey"], aoi_quadkeys)
+            ).to_pandas()
+
+        quarter_df["quarter"] = quarter
+        return quarter_df
 
-            ## When using quadkey optimizations read and filter Ookla parquet
-            ## in batches to circumvent memory issues
-            ## Read: https://stackoverflow.com/questions/59098785/is-it-possible-to-read-parquet-files-in-chunks
-            if use_aoi_quadkey:
-                quarter_df = _read_and_filter_quadkey_parquet_file(
-                    ookla_quarter_filepath, input_aoi_quadkeys, "quadkey"
+    def _cache_processed_data(
+        self, data_key, df, return_geometry, key_inputs, coverage_quadkeys=None
+    ):
+        "Add processed data to the RAM cache and processed cache dir"
+
+        # NOTE: Since there will be groupby operations in processing, we don't return
+        #       a geodataframe by default since it does not work well with aggregations
+        #       by quadkey.
+        if return_geometry and not isinstance(df, gpd.GeoDataFrame):
+            logger.debug(f"Converting Ookla data into geodataframe")
+            df = gpd.GeoDataFrame(df, geometry=quadkeys_to_polygons(df["quadkey"]))
+        self.data_cache[data_key] = df
+        self._write_processed_cache(
+            data_key, df, return_geometry, key_inputs, coverage_quadkeys
+        )
+        return df
+
+    def load_type_year_data(
+        self,
+        aoi,
+        type_,
+        year,
+        use_cache=True,
+        return_geometry=False,
+        use_aoi_quadkey=False,
+        aoi_quadkey_col="quadkey",
+        scan_mode="pushdown",
+        max_workers=1,
+    ):
+        """Load Ookla data across all quarters for a specified aoi, type (fixed, mobile) and year
+
+        scan_mode controls how the quarterly parquet files are filtered:
+        "pushdown" skips row groups using the quadkey min/max statistics and filters in Arrow,
+        while "batch" converts every batch to pandas before filtering.
+        Quarterly files are scanned in a thread pool when max_workers > 1.
+        """
+
+        if scan_mode not in OOKLA_SCAN_MODES:
+            raise ValueError(
+                f"Invalid scan_mode {scan_mode}. Must be one of {OOKLA_SCAN_MODES}."
+            )
+
+        data_key = self._make_data_key(
+            aoi, type_, year, return_geometry, use_aoi_quadkey, aoi_quadkey_col
+        )
+        cached_df = self._get_cached_data(data_key, type_, year, return_geometry)
+        if cached_df is not None:
+            return cached_df
+
+        # Concurrent loads of the same data key only process the data once
+        with self._single_flight(data_key, type_, year, return_geometry) as future:
+            if not future.done():
+                future.set_result(
+                    self._process_type_year_data(
+                        data_key,
+                        aoi,
+                        type_,
+                        year,
+                        use_cache,
+                        return_geometry,
+                        use_aoi_quadkey,
+                        aoi_quadkey_col,
+                        scan_mode,
+                        max_workers,
+                    )
                 )
-            else:
-                quarter_df = pd.read_parquet(ookla_quarter_filepath)
-                quarter_df = quarter_df[quarter_df["quadkey"].isin(aoi_quadkeys)]
+        return future.result()
+
+    def _process_type_year_data(
+        self,
+        data_key,
+        aoi,
+        type_,
+        year,
+        use_cache,
+        return_geometry,
+        use_aoi_quadkey,
+        aoi_quadkey_col,
+        scan_mode,
+        max_workers,
+    ):
+        "Process Ookla data for a data key from previously processed data or the raw files"
+        key_inputs = dict(
+            aoi_bounds=aoi.total_bounds.tolist(),
+            type_=str(type_),
+            year=str(year),
+            return_geometry=return_geometry,
+            use_aoi_quadkey=use_aoi_quadkey,
+            aoi_quadkey_col=aoi_quadkey_col,
+        )
+        aoi_quadkeys = self._get_aoi_quadkeys(aoi, use_aoi_quadkey, aoi_quadkey_col)
+
+        # Filter previously processed data covering the aoi if available
+        covering_df = self._get_covering_cached_data(
+            type_, year, return_geometry, aoi_quadkeys
+        )
+        if covering_df is not None:
+            return self._cache_processed_data(
+                data_key, covering_df, return_geometry, key_inputs, aoi_quadkeys
+            )
+
+        logger.debug("No cached data found. Processing Ookla data from scratch.")
 
-            quarter_df["quarter"] = quarter
-            quarter_df_list.append(quarter_df)
+        # Otherwise, load from raw file and add to RAM cache
+        quarter_files = self._get_quarter_files(type_, year, use_cache, aoi_quadkeys)
+
+        # Combine quarterly data for the specified year, filtered to the aoi using quadkey
+        # Quarter is inferred from the Ookla filename
+        def load_quarter(quarter_file):
+            quarter, ookla_quarter_filepath = quarter_file
+            logger.debug(
+                f"Ookla data for aoi, {type_} {year} {quarter} being loaded from {ookla_quarter_filepath}"
+            )
+            return self._load_quarter_data(
+                ookla_quarter_filepath,
+                quarter,
+                aoi_quadkeys,
+                use_aoi_quadkey,
+                scan_mode,
+            )
 
-            # Free memory after processing
-            del quarter_df
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            quarter_df_list = list(executor.map(load_quarter, quarter_files))
 
         logger.debug(
             f"Concatenating quarterly Ookla data for {type_} and {year} into one dataframe"
@@ -185,34 +1148,533 @@ class OoklaDataManager:
         del quarter_df_list
         gc.collect()
 
-        # NOTE: Since there will be groupby operations in processing, we don't return
-        #       a geodataframe by default since it does not work well with aggregations
-        #       by quadkey.
-        if not return_geometry:
-            self.data_cache[data_key] = df
-            df.to_csv(cached_file_path, index=False)
-            return df
-        else:
-            logger.debug(f"Converting Ookla data into geodataframe")
-            gdf = gpd.GeoDataFrame(df, geometry=gpd.GeoSeries.from_wkt(df["tile"]))
-            self.data_cache[data_key] = gdf
-            gdf.to_file(cached_file_path, driver="GeoJSON")
-            return gdf
+        return self._cache_processed_data(
+            data_key, df, return_geometry, key_inputs, aoi_quadkeys
+        )
 
+    def aggregate_type_year_data(
+        self,
+        aoi,
+        type_,
+        year,
+        aggregations=None,
+        use_cache=True,
+        use_aoi_quadkey=False,
+        aoi_quadkey_col="quadkey",
+        max_workers=1,
+    ):
+        """Aggregate Ookla data per quadkey across all quarters for the aoi, type and year in one pass
 
-def download_ookla_year_data(type_, year, cache_dir, use_cache=True):
+        Instead of concatenating the quarterly data, each filtered row group is folded into
+        running per-quadkey aggregations (see `OoklaAggregator`), so peak memory is bounded
+        by a row group and the number of aoi quadkeys. Processed data already cached for the
+        aoi is aggregated directly. Returns the aggregator, e.g. to call `result()` or merge.
+        """
+        aggregator = OoklaAggregator(aggregations)
 
-    "Download ookla data for a specifed type (fixed or mobile) and year. Data for all 4 quarters will be downloaded."
+        data_key = self._make_data_key(
+            aoi, type_, year, False, use_aoi_quadkey, aoi_quadkey_col
+        )
+        cached_df = self._get_cached_data(data_key, type_, year, False)
+        if cached_df is not None:
+            return aggregator.update(cached_df)
 
-    # Determine number of expected data for type_ and year, specified by OoklaFile(type, year, quarter)
-    available_ookla_files = list_ookla_files()
-    expected_ookla_files = {}
-    for quarter in [1, 2, 3, 4]:
-        quarter_ookla_file = OoklaFile(str(type_), str(year), str(quarter))
-        if quarter_ookla_file in available_ookla_files.keys():
-            expected_ookla_files[quarter_ookla_file] = available_ookla_files[
-                quarter_ookla_file
+        aoi_quadkeys = self._get_aoi_quadkeys(aoi, use_aoi_quadkey, aoi_quadkey_col)
+        quarter_files = self._get_quarter_files(type_, year, use_cache, aoi_quadkeys)
+
+        def aggregate_quarter(quarter_file):
+            quarter, ookla_quarter_filepath = quarter_file
+            logger.debug(
+                f"Ookla data for aoi, {type_} {year} {quarter} being aggregated from {ookla_quarter_filepath}"
+            )
+            quarter_aggregator = OoklaAggregator(aggregations)
+            for table in _iter_quadkey_parquet_file(
+                ookla_quarter_filepath,
+                aoi_quadkeys,
+                "quadkey",
+                columns=quarter_aggregator.columns,
+            ):
+                quarter_aggregator.update(table.to_pandas())
+            return quarter_aggregator
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for quarter_aggregator in executor.map(aggregate_quarter, quarter_files):
+                aggregator.merge(quarter_aggregator)
+
+        return aggregator
+
+    def load_many(
+        self,
+        aoi,
+        types,
+        years,
+        use_cache=True,
+        use_aoi_quadkey=False,
+        aoi_quadkey_col="quadkey",
+        scan_mode="pushdown",
+        max_workers=None,
+        scan_memory_budget_bytes=DEFAULT_MEMORY_BUDGET_BYTES,
+    ):
+        """Load Ookla data for an aoi across several types (fixed, mobile) and years into one
+        long-format dataframe with type, year and quarter columns.
+
+        Quarterly files of all type/year combinations are scanned concurrently in a thread pool
+        of max_workers threads. Scans only start while the estimated memory of the running scans
+        stays within scan_memory_budget_bytes (None for no limit).
+        """
+
+        if scan_mode not in OOKLA_SCAN_MODES:
+            raise ValueError(
+                f"Invalid scan_mode {scan_mode}. Must be one of {OOKLA_SCAN_MODES}."
+            )
+        types = [types] if isinstance(types, str) else list(types)
+        years = [years] if isinstance(years, (str, int)) else list(years)
+
+        type_year_dfs = {}
+        missing_type_year_keys = {}
+        for type_ in types:
+            for year in years:
+                data_key = self._make_data_key(
+                    aoi, type_, year, False, use_aoi_quadkey, aoi_quadkey_col
+                )
+                cached_df = self._get_cached_data(data_key, type_, year, False)
+                if cached_df is not None:
+                    type_year_dfs[(type_, year)] = cached_df
+                    continue
+                missing_type_year_keys[(type_, year)] = data_key
+
+        # Claim the missing data keys in a fixed order so that concurrent loads with
+        # overlapping keys process each key once without deadlocking
+        with contextlib.ExitStack() as stack:
+            futures = {}
+            for (type_, year), data_key in sorted(
+                missing_type_year_keys.items(), key=lambda item: item[1]
+            ):
+                future = stack.enter_context(
+                    self._single_flight(data_key, type_, year, False)
+                )
+                if future.done():
+                    type_year_dfs[(type_, year)] = future.result()
+                else:
+                    futures[(type_, year)] = future
+
+            if futures:
+                processed_dfs = self._process_many(
+                    aoi,
+                    {
+                        type_year: missing_type_year_keys[type_year]
+                        for type_year in futures
+                    },
+                    use_cache,
+                    use_aoi_quadkey,
+                    aoi_quadkey_col,
+                    scan_mode,
+                    max_workers,
+                    scan_memory_budget_bytes,
+                )
+                for type_year, df in processed_dfs.items():
+                    futures[type_year].set_result(df)
+                    type_year_dfs[type_year] = df
+
+        return pd.concat(
+            [
+                type_year_dfs[(type_, year)].assign(type=str(type_), year=int(year))
+                for type_ in types
+                for year in years
+            ],
+            ignore_index=True,
+        )
+
+    def _process_many(
+        self,
+        aoi,
+        type_year_keys,
+        use_cache,
+        use_aoi_quadkey,
+        aoi_quadkey_col,
+        scan_mode,
+        max_workers,
+        scan_memory_budget_bytes,
+    ):
+        """Process Ookla data for the (type, year) data keys, scanning the quarterly files
+        of all of them in one thread pool. Returns the processed data per (type, year)."""
+        aoi_quadkeys = self._get_aoi_quadkeys(aoi, use_aoi_quadkey, aoi_quadkey_col)
+        quarter_df_lists = {}
+        quarter_jobs = []
+        for type_, year in type_year_keys:
+            covering_df = self._get_covering_cached_data(
+                type_, year, False, aoi_quadkeys
+            )
+            if covering_df is not None:
+                quarter_df_lists[(type_, year)] = [covering_df]
+                continue
+
+            for quarter, ookla_quarter_filepath in self._get_quarter_files(
+                type_, year, use_cache, aoi_quadkeys
+            ):
+                quarter_jobs.append((type_, year, quarter, ookla_quarter_filepath))
+
+        scan_budget = _ByteBudget(scan_memory_budget_bytes)
+
+        def load_quarter(quarter_job):
+            type_, year, quarter, ookla_quarter_filepath = quarter_job
+            scan_bytes = _estimate_scan_bytes(
+                ookla_quarter_filepath,
+                row_group_at_a_time=scan_mode == "pushdown" or use_aoi_quadkey,
+            )
+            with scan_budget.reserve(scan_bytes):
+                logger.debug(
+                    f"Ookla data for aoi, {type_} {year} {quarter} being loaded from {ookla_quarter_filepath}"
+                )
+                return self._load_quarter_data(
+                    ookla_quarter_filepath,
+                    quarter,
+                    aoi_quadkeys,
+                    use_aoi_quadkey,
+                    scan_mode,
+                )
+
+        logger.info(
+            f"Scanning {len(quarter_jobs)} quarterly Ookla files with {max_workers or 'default'} workers"
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            quarter_dfs = list(executor.map(load_quarter, quarter_jobs))
+
+        for (type_, year, _, _), quarter_df in zip(quarter_jobs, quarter_dfs):
+            quarter_df_lists.setdefault((type_, year), []).append(quarter_df)
+        del quarter_dfs
+
+        type_year_dfs = {}
+        for (type_, year), data_key in type_year_keys.items():
+            key_inputs = dict(
+                aoi_bounds=aoi.total_bounds.tolist(),
+                type_=str(type_),
+                year=str(year),
+                return_geometry=False,
+                use_aoi_quadkey=use_aoi_quadkey,
+                aoi_quadkey_col=aoi_quadkey_col,
+            )
+            df = pd.concat(quarter_df_lists.pop((type_, year)), ignore_index=True)
+            type_year_dfs[(type_, year)] = self._cache_processed_data(
+                data_key, df, False, key_inputs, aoi_quadkeys
+            )
+        return type_year_dfs
+
+    def _make_panel_key(
+        self, aoi, use_aoi_quadkey, aoi_quadkey_col, metric_crs, aggregations
+    ):
+        # Generate hash from the aoi geometries and the panel options, which keys the panel dir
+        m = hashlib.md5()
+        for geom_wkb in aoi.geometry.to_wkb():
+            m.update(geom_wkb)
+        m.update(str(aoi.crs).encode())
+        if use_aoi_quadkey:
+            for quadkey in aoi[aoi_quadkey_col].astype(str):
+                m.update(quadkey.encode())
+        panel_options = dict(
+            use_aoi_quadkey=use_aoi_quadkey,
+            aoi_quadkey_col=aoi_quadkey_col,
+            metric_crs=str(metric_crs),
+            aggregations=aggregations,
+        )
+        m.update(json.dumps(panel_options, sort_keys=True).encode())
+        return m.hexdigest()
+
+    def update_panel(
+        self,
+        aoi,
+        types,
+        years,
+        use_cache=True,
+        use_aoi_quadkey=False,
+        aoi_quadkey_col="quadkey",
+        scan_mode="pushdown",
+        metric_crs="epsg:3123",
+        aggregations=None,
+    ):
+        """Incrementally compute yearly Ookla features for the aoi across types and years.
+
+        Each (type, year, quarter) is processed once and checkpointed in the panel dir as its
+        filtered extract along with the running per-quadkey aggregations for the year. When
+        Ookla publishes a new quarter only that file is scanned and the yearly features of
+        its type and year are updated. The aggregations, features and processed quarters of a
+        type and year are written together as a new checkpoint version, so an interrupted
+        update never counts a quarter twice. Returns one row per aoi row and year with the
+        features of each type, named the same as in `add_ookla_features`.
+        """
+        types = [types] if isinstance(types, str) else list(types)
+        years = [years] if isinstance(years, (str, int)) else list(years)
+
+        panel_key = self._make_panel_key(
+            aoi, use_aoi_quadkey, aoi_quadkey_col, metric_crs, aggregations
+        )
+        panel_dir = os.path.join(self.cache_dir, "ookla", "panel", panel_key)
+
+        available_ookla_files = self.catalog.files
+        area_weights = self.load_area_weights(aoi, metric_crs=metric_crs)
+        aoi_quadkeys = None
+
+        year_features = {}
+        for type_ in types:
+            for year in years:
+                checkpoint_dir = os.path.join(panel_dir, str(type_), str(year))
+                Path(checkpoint_dir).mkdir(parents=True, exist_ok=True)
+                available_quarters = sorted(
+                    int(ookla_file.quarter)
+                    for ookla_file in available_ookla_files
+                    if ookla_file.type == str(type_) and ookla_file.year == str(year)
+                )
+
+                # Only one thread or process updates the checkpoint of a type/year at a time
+                with FileLock(f"{checkpoint_dir}.lock"):
+                    version, version_dir, processed_quarters = _load_panel_checkpoint(
+                        checkpoint_dir
+                    )
+                    new_quarters = [
+                        quarter
+                        for quarter in available_quarters
+                        if quarter not in processed_quarters
+                    ]
+
+                    if not new_quarters and version_dir is not None:
+                        logger.debug(f"Ookla panel for {type_} {year} is up to date")
+                        features = pd.read_parquet(
+                            os.path.join(version_dir, OOKLA_PANEL_FEATURES_FILENAME)
+                        ).set_axis(aoi.index)
+                        year_features.setdefault(year, []).append(features)
+                        continue
+
+                    logger.info(
+                        f"Updating Ookla panel for {type_} {year} with quarters {new_quarters}"
+                    )
+                    yearly_aggregator = (
+                        OoklaAggregator.load(
+                            os.path.join(version_dir, OOKLA_PANEL_STATE_DIRNAME),
+                            aggregations,
+                        )
+                        if version_dir is not None
+                        else OoklaAggregator(aggregations)
+                    )
+                    quarter_files = None
+                    for quarter in new_quarters:
+                        quarter_path = os.path.join(
+                            checkpoint_dir, f"q{quarter}.parquet"
+                        )
+                        if os.path.exists(quarter_path):
+                            quarter_df = pd.read_parquet(quarter_path)
+                        else:
+                            if aoi_quadkeys is None:
+                                aoi_quadkeys = self._get_aoi_quadkeys(
+                                    aoi, use_aoi_quadkey, aoi_quadkey_col
+                                )
+                            if quarter_files is None:
+                                quarter_files = dict(
+                                    self._get_quarter_files(
+                                        type_, year, use_cache, aoi_quadkeys
+                                    )
+                                )
+                            quarter_df = self._load_quarter_data(
+                                quarter_files[quarter],
+                                quarter,
+                                aoi_quadkeys,
+                                use_aoi_quadkey,
+                                scan_mode,
+                            )
+                            with _atomic_write_path(quarter_path) as tmp_quarter_path:
+                                quarter_df.to_parquet(tmp_quarter_path, index=False)
+                        yearly_aggregator.update(quarter_df)
+                        processed_quarters = sorted(processed_quarters + [quarter])
+
+                    if yearly_aggregator.state is None:
+                        logger.warning(
+                            f"Ookla data: No data available for {type_} and {year}"
+                        )
+                        continue
+
+                    ookla_yearly = yearly_aggregator.result(prefix=f"{type_}_")
+                    feature_columns = [col for col in ookla_yearly if col != "quadkey"]
+                    feature_means = area_weights.mean(
+                        ookla_yearly, "quadkey", feature_columns
+                    )
+                    features = pd.DataFrame(
+                        {
+                            f"{feature}_mean": feature_means[feature].to_numpy()
+                            for feature in feature_columns
+                        },
+                        index=aoi.index,
+                    )
+                    _save_panel_checkpoint(
+                        checkpoint_dir,
+                        version + 1,
+                        yearly_aggregator,
+                        features,
+                        processed_quarters,
+                    )
+                year_features.setdefault(year, []).append(features)
+
+        return pd.concat(
+            [
+                pd.concat(features_list, axis=1).assign(year=int(year))
+                for year, features_list in year_features.items()
+            ]
+        )
+
+
+def _load_panel_checkpoint(checkpoint_dir):
+    """Get the latest complete version of a panel checkpoint as (version, version dir,
+    processed quarters). Returns (0, None, []) if there is none."""
+    versions = []
+    for version_dir in Path(checkpoint_dir).glob("v*"):
+        manifest_path = version_dir / OOKLA_PANEL_MANIFEST_FILENAME
+        if version_dir.name[1:].isdigit() and manifest_path.exists():
+            versions.append((int(version_dir.name[1:]), version_dir))
+    if not versions:
+        return 0, None, []
+    version, version_dir = max(versions)
+    with open(version_dir / OOKLA_PANEL_MANIFEST_FILENAME) as f:
+        return version, version_dir, json.load(f)["quarters"]
+
+
+def _save_panel_checkpoint(checkpoint_dir, version, aggregator, features, quarters):
+    """Write the yearly state, features and processed quarters of a panel checkpoint to a
+    new version dir. The version is written to a temp dir, with the manifest last, and
+    renamed into place so that readers only ever see complete versions."""
+    # Clean up versions left behind by an interrupted update
+    for tmp_dir in Path(checkpoint_dir).glob(".v*.tmp"):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir = os.path.join(checkpoint_dir, f".v{version}.{os.getpid()}.tmp")
+    Path(tmp_dir).mkdir()
+    aggregator.save(os.path.join(tmp_dir, OOKLA_PANEL_STATE_DIRNAME))
+    features.to_parquet(os.path.join(tmp_dir, OOKLA_PANEL_FEATURES_FILENAME))
+    with open(os.path.join(tmp_dir, OOKLA_PANEL_MANIFEST_FILENAME), "w") as f:
+        json.dump(dict(quarters=quarters), f, indent=2)
+    os.rename(tmp_dir, os.path.join(checkpoint_dir, f"v{version}"))
+
+    for version_dir in Path(checkpoint_dir).glob("v*"):
+        if version_dir.name[1:].isdigit() and int(version_dir.name[1:]) < version:
+            shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def build_ookla_regional_extract(
+    types,
+    years,
+    cache_dir="~/.geowrangler",
+    region_name="philippines",
+    region_bounds=PHILIPPINES_BOUNDS,
+    region_zoom_lvl=10,
+    use_cache=True,
+    catalog=None,
+    row_group_size=OOKLA_REGIONAL_EXTRACT_ROW_GROUP_SIZE,
+):
+    """Extract the Ookla data within a region into a local parquet dataset, one time.
+
+    Every available quarter of the types and years is filtered from the global files to the
+    quadkeys covering region_bounds at region_zoom_lvl and written to
+    cache_dir/ookla/regional/{region_name}/type={type}/year={year}/, sorted by quadkey with
+    small row groups. OoklaDataManager reads from the extract for aois within the region.
+    Already extracted quarters are skipped. Returns the regional extract dir.
+    """
+    types = [types] if isinstance(types, str) else list(types)
+    years = [years] if isinstance(years, (str, int)) else list(years)
+    cache_dir = os.path.expanduser(cache_dir)
+    if catalog is None:
+        catalog = get_ookla_catalog(cache_dir)
+
+    region_dir = os.path.join(cache_dir, "ookla", "regional", region_name)
+    region_path = os.path.join(region_dir, OOKLA_REGION_FILENAME)
+    region = dict(bounds=list(region_bounds), files={})
+    if os.path.exists(region_path):
+        with open(region_path) as f:
+            region = json.load(f)
+        if region["bounds"] != list(region_bounds):
+            raise ValueError(
+                f"Regional extract {region_name} exists with bounds {region['bounds']}"
+            )
+    region_quadkeys = quadkey_cover(
+        gpd.GeoSeries([shapely.box(*region_bounds)], crs="epsg:4326"),
+        zoom_lvl=region_zoom_lvl,
+    )
+    region["quadkeys"] = region_quadkeys
+
+    for type_ in types:
+        for year in years:
+            type_year = f"{type_}/{year}"
+            type_year_files = region["files"].setdefault(type_year, {})
+            partition_dir = os.path.join(region_dir, f"type={type_}", f"year={year}")
+            missing_quarters = [
+                ookla_file.quarter
+                for ookla_file in catalog.type_year_files(type_, year)
+                if ookla_file.quarter not in type_year_files
+                or not _is_valid_parquet_file(
+                    os.path.join(region_dir, type_year_files[ookla_file.quarter])
+                )
             ]
+            if not missing_quarters:
+                logger.debug(f"Ookla regional extract for {type_} {year} is up to date")
+                continue
+
+            type_year_cache_dir = download_ookla_year_data(
+                type_, year, cache_dir=cache_dir, use_cache=use_cache, catalog=catalog
+            )
+            Path(partition_dir).mkdir(parents=True, exist_ok=True)
+            for quarter, ookla_quarter_filepath in _list_ookla_quarter_files(
+                type_year_cache_dir, catalog
+            ):
+                if str(quarter) not in missing_quarters:
+                    continue
+                logger.info(
+                    f"Extracting {region_name} from Ookla data for {type_} {year} {quarter}"
+                )
+                extract = _scan_quadkey_parquet_file(
+                    ookla_quarter_filepath, region_quadkeys, columns=OOKLA_COLUMNS
+                )
+                table = pa.Table.from_pandas(
+                    extract.sort_values("quadkey"), preserve_index=False
+                )
+                filename = f"quarter={quarter}.parquet"
+                filepath = os.path.join(partition_dir, filename)
+                with _atomic_write_path(filepath) as tmp_filepath:
+                    pq.write_table(
+                        table,
+                        tmp_filepath,
+                        row_group_size=row_group_size,
+                        compression=OOKLA_PROCESSED_CACHE_COMPRESSION,
+                    )
+                # Extracts are not evictable since they have no single source url
+                get_asset_store(cache_dir).add(filepath, "ookla")
+                type_year_files[str(quarter)] = os.path.relpath(filepath, region_dir)
+
+            # Keep track of extracted quarters as they are written
+            with _atomic_write_path(region_path) as tmp_region_path:
+                with open(tmp_region_path, "w") as f:
+                    json.dump(region, f)
+
+    return region_dir
+
+
+def download_ookla_year_data(
+    type_,
+    year,
+    cache_dir,
+    use_cache=True,
+    max_workers=4,
+    base_url=OOKLA_BASE_URL,
+    timeout=60,
+    catalog=None,
+):
+    """Download ookla data for a specifed type (fixed or mobile) and year. Data for all 4 quarters will be downloaded.
+
+    Only quarters that are missing or fail verification (size and parquet footer) are downloaded,
+    in parallel. Downloads are written to .part files which are renamed once verified, and the url
+    and size of every downloaded file is kept in a manifest.json in the type/year cache dir.
+    Available quarters come from the OoklaFileCatalog of the cache dir, and nothing is
+    downloaded if the catalog is offline.
+    """
+
+    # Determine number of expected data for type_ and year, specified by OoklaFile(type, year, quarter)
+    if catalog is None:
+        catalog = get_ookla_catalog(cache_dir)
+    expected_ookla_files = catalog.type_year_files(type_, year)
     num_expected_ookla_files = len(expected_ookla_files)
 
     if num_expected_ookla_files == 0:
@@ -223,46 +1685,179 @@ def download_ookla_year_data(type_, year, cache_dir, use_cache=True):
         )
 
     type_year_cache_dir = os.path.join(cache_dir, "ookla", type_, str(year))
+    Path(type_year_cache_dir).mkdir(parents=True, exist_ok=True)
+    # Only one thread or process checks and downloads a type/year at a time.
+    # The others wait for it and then find the files cached
+    download_lock_path = f"{type_year_cache_dir}.lock"
+    asset_store = get_asset_store(cache_dir)
+    with FileLock(download_lock_path):
+        download_manifest = _load_download_manifest(type_year_cache_dir)
 
-    # Check if the cached data is valid. Otherwise, we have to re-download.
-    # For Ookla, we need to check if we've downloaded all expected files for that year.
-    cached_data_available = (
-        os.path.exists(type_year_cache_dir)
-        and len(os.listdir(type_year_cache_dir)) == num_expected_ookla_files
-    )
-
-    logger.info(
-        f"Ookla Data: Cached data available for {type_} and {year} at {type_year_cache_dir}? {cached_data_available}"
-    )
+        # Check which of the expected files are cached and valid. Otherwise, we have to re-download them.
+        missing_ookla_files = {}
+        for ookla_file, ookla_filename in expected_ookla_files.items():
+            ookla_filepath = os.path.join(type_year_cache_dir, ookla_filename)
+            manifest_entry = download_manifest.get(ookla_filename, {})
+            if use_cache and _is_valid_parquet_file(
+                ookla_filepath, expected_size=manifest_entry.get("size")
+            ):
+                if not manifest_entry:
+                    # Files downloaded before the manifest was kept
+                    download_manifest[ookla_filename] = dict(
+                        quarter=int(ookla_file.quarter),
+                        size=os.path.getsize(ookla_filepath),
+                    )
+                asset_store.touch(ookla_filepath)
+                continue
+            missing_ookla_files[ookla_file] = ookla_filename
 
-    # Download if cache is invalid or user specified use_cache = False
-    if not cached_data_available or not use_cache:
         logger.info(
-            f"Ookla Data: Re-initializing Ookla type/year cache dir at {type_year_cache_dir}..."
+            f"Ookla Data: Cached data available for {type_} and {year} at {type_year_cache_dir}? {len(missing_ookla_files) == 0}"
         )
-        # Re-create the country cache dir and start over to fix any corrupted states
-        shutil.rmtree(type_year_cache_dir, ignore_errors=True)
-        Path(type_year_cache_dir).mkdir(parents=True, exist_ok=True)
 
-        # This downloads a parquet file to the type_year_dir for each quarter
-        for quarter in range(1, num_expected_ookla_files + 1, 1):
+        if catalog.offline and missing_ookla_files:
+            logger.warning(
+                f"Offline mode: skipping download of {sorted(missing_ookla_files.values())}"
+            )
+            missing_ookla_files = {}
+
+        def download_quarter(ookla_file):
+            ookla_filename = missing_ookla_files[ookla_file]
+            url = make_ookla_url(
+                ookla_file.type,
+                ookla_file.year,
+                ookla_file.quarter,
+                ookla_filename,
+                base_url=base_url,
+            )
             logger.info(
-                f"Ookla Data: Downloading Ookla parquet file for quarter {quarter}..."
+                f"Ookla Data: Downloading Ookla parquet file for quarter {ookla_file.quarter}..."
             )
-            download_path = download_ookla_file(
-                type_=type_,
-                year=year,
-                quarter=str(quarter),
-                directory=type_year_cache_dir,
+            ookla_filepath = os.path.join(type_year_cache_dir, ookla_filename)
+            size = _download_parquet_file(url, ookla_filepath, timeout=timeout)
+            return ookla_filename, dict(
+                url=url,
+                quarter=int(ookla_file.quarter),
+                size=size,
+                downloaded_at=datetime.now(timezone.utc).isoformat(),
             )
 
-        logger.info(
-            f"Ookla Data: Successfully downloaded and cached Ookla data for {type_} and {year} at {type_year_cache_dir}!"
-        )
+        if missing_ookla_files:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                downloaded = list(executor.map(download_quarter, missing_ookla_files))
+            download_manifest.update(dict(downloaded))
+            # The other quarters of the type and year are kept when over the disk budget
+            type_year_filepaths = [
+                os.path.join(type_year_cache_dir, ookla_filename)
+                for ookla_filename in expected_ookla_files.values()
+            ]
+            for ookla_filename, manifest_entry in downloaded:
+                asset_store.add(
+                    os.path.join(type_year_cache_dir, ookla_filename),
+                    "ookla",
+                    url=manifest_entry["url"],
+                    keep=type_year_filepaths,
+                )
+            logger.info(
+                f"Ookla Data: Successfully downloaded and cached Ookla data for {type_} and {year} at {type_year_cache_dir}!"
+            )
+        _save_download_manifest(type_year_cache_dir, download_manifest)
 
     return type_year_cache_dir
 
 
+def make_ookla_url(type_, year, quarter, filename, base_url=OOKLA_BASE_URL):
+    "Make the url of an Ookla parquet file for a type (fixed or mobile), year and quarter"
+    return f"{base_url}/parquet/performance/type={type_}/year={year}/quarter={quarter}/{filename}"
+
+
+def _load_download_manifest(type_year_cache_dir):
+    manifest_path = os.path.join(type_year_cache_dir, OOKLA_DOWNLOAD_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _save_download_manifest(type_year_cache_dir, download_manifest):
+    manifest_path = os.path.join(type_year_cache_dir, OOKLA_DOWNLOAD_MANIFEST_FILENAME)
+    with _atomic_write_path(manifest_path) as tmp_manifest_path:
+        with open(tmp_manifest_path, "w") as f:
+            json.dump(download_manifest, f, indent=2)
+
+
+def _is_valid_parquet_file(filepath, expected_size=None):
+    "Check that a parquet file exists, has the expected size and has a readable footer"
+    if not os.path.isfile(filepath):
+        return False
+    if expected_size is not None and os.path.getsize(filepath) != expected_size:
+        logger.warning(
+            f"{filepath} has size {os.path.getsize(filepath)} instead of {expected_size}"
+        )
+        return False
+    try:
+        pq.ParquetFile(filepath).metadata
+    except Exception as e:
+        logger.warning(f"{filepath} is not a valid parquet file: {e}")
+        return False
+    return True
+
+
+def _download_parquet_file(url, dest, timeout=60, chunksize=1024 * 1024):
+    """Download a parquet file to a .part file, resuming a previous partial download if the
+    server supports range requests, and rename it to dest once its size and footer are verified.
+    Returns the size of the downloaded file."""
+    part_path = f"{dest}.part"
+    downloaded_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    restart = False
+    headers = {"Range": f"bytes={downloaded_size}-"} if downloaded_size > 0 else {}
+
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        # A range starting at the end of the file means the .part file is already complete
+        if response.status_code == 416:
+            mode = None
+            content_range = response.headers.get("Content-Range", "*/-1")
+            expected_size = int(content_range.rsplit("/", 1)[-1])
+            if expected_size != downloaded_size:
+                # Otherwise every later run would send the same out of range request
+                logger.warning(
+                    f"{part_path} has {downloaded_size} bytes but {url} has {expected_size}, restarting the download"
+                )
+                os.remove(part_path)
+                restart = True
+        else:
+            response.raise_for_status()
+            # The whole file is sent again if the server ignores the range request
+            if response.status_code == 206:
+                logger.info(f"Resuming download of {url} from byte {downloaded_size}")
+                mode = "ab"
+                content_range = response.headers["Content-Range"]
+                expected_size = int(content_range.rsplit("/", 1)[-1])
+            else:
+                mode = "wb"
+                expected_size = int(response.headers.get("Content-Length", -1))
+
+        if mode is not None:
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=chunksize):
+                    f.write(chunk)
+    if restart:
+        # Without the .part file, the whole file is requested
+        return _download_parquet_file(url, dest, timeout=timeout, chunksize=chunksize)
+
+    size = os.path.getsize(part_path)
+    if expected_size >= 0 and size != expected_size:
+        raise IOError(
+            f"Download of {url} incomplete: got only {size} out of {expected_size} bytes"
+        )
+    if not _is_valid_parquet_file(part_path):
+        os.remove(part_path)
+        raise IOError(f"Downloaded file from {url} is not a valid parquet file")
+
+    os.replace(part_path, dest)
+    return size
+
+
 def add_ookla_features(
     aoi,
     type_,
@@ -273,55 +1868,65 @@ def add_ookla_features(
     aoi_quadkey_col="quadkey",
     metric_crs="epsg:3123",
     inplace=False,
+    scan_mode="pushdown",
+    use_area_weights=True,
+    aggregations=None,
+    streaming=False,
 ):
-    """Generates yearly aggregate features for the AOI based on Ookla data for a given type (fixed, mobile) and year."""
+    """Generates yearly aggregate features for the AOI based on Ookla data for a given type (fixed, mobile) and year.
 
-    ookla = ookla_data_manager.load_type_year_data(
-        aoi,
-        type_,
-        year,
-        use_cache=use_cache,
-        use_aoi_quadkey=use_aoi_quadkey,
-        aoi_quadkey_col=aoi_quadkey_col,
-    )
+    The yearly features per tile are given by aggregations, a GeoWrangler-style agg spec
+    over the quarterly rows (default: OOKLA_YEARLY_AGGREGATIONS). With streaming, the
+    quarterly data is aggregated row group by row group without loading it all in memory.
+    With use_area_weights, the area zonal stats use the AOI x tile area weights cached by
+    the ookla_data_manager instead of intersecting the AOI with the tiles on every call.
+    """
+
+    if streaming:
+        aggregator = ookla_data_manager.aggregate_type_year_data(
+            aoi,
+            type_,
+            year,
+            aggregations=aggregations,
+            use_cache=use_cache,
+            use_aoi_quadkey=use_aoi_quadkey,
+            aoi_quadkey_col=aoi_quadkey_col,
+        )
+    else:
+        ookla = ookla_data_manager.load_type_year_data(
+            aoi,
+            type_,
+            year,
+            use_cache=use_cache,
+            use_aoi_quadkey=use_aoi_quadkey,
+            aoi_quadkey_col=aoi_quadkey_col,
+            scan_mode=scan_mode,
+        )
+        aggregator = OoklaAggregator(aggregations).update(ookla)
 
     # Create a copy of the AOI gdf if not inplace to avoid modifying the original gdf
     if not inplace:
         aoi = aoi.copy()
 
-    # Combine quarterly data from Ookla into yearly aggregate data
-    # Geometries are stored separately and rejoined after aggregation by quadkey
-    # TODO: incorporate parametrized aggregations, take inspiration from GeoWrangler agg spec
-    ookla_geoms = ookla[["quadkey", "tile"]].drop_duplicates().reset_index(drop=True)
-    ookla_yearly = (
-        ookla.groupby("quadkey")
-        .agg(
-            mean_avg_d_kbps=("avg_d_kbps", "mean"),
-            mean_avg_u_kbps=("avg_u_kbps", "mean"),
-            mean_avg_lat_ms=("avg_lat_ms", "mean"),
-            mean_num_tests=("tests", "mean"),
-            mean_num_devices=("devices", "mean"),
-        )
-        .reset_index()
-    )
-    # Add type_year prefix to feature names
-    ookla_yearly = ookla_yearly.rename(
-        {
-            col: f"{type_}_" + col
-            for col in ookla_yearly.columns[~ookla_yearly.columns.isin(["quadkey"])]
-        },
-        axis=1,
-    )
-    ookla_yearly = ookla_yearly.merge(ookla_geoms, on="quadkey", how="left")
+    # Combine quarterly data from Ookla into yearly aggregate data with the type as prefix
+    # Geometries are built from the quadkey after aggregation
+    ookla_yearly = aggregator.result(prefix=f"{type_}_")
+
+    # Area-weighted means from the precomputed aoi x tile weights, without an overlay
+    if use_area_weights:
+        features = [col for col in ookla_yearly.columns if col != "quadkey"]
+        area_weights = ookla_data_manager.load_area_weights(aoi, metric_crs=metric_crs)
+        feature_means = area_weights.mean(ookla_yearly, "quadkey", features)
+        for feature in features:
+            aoi[f"{feature}_mean"] = feature_means[feature].to_numpy()
+        return aoi.to_crs("epsg:4326")
+
     ookla_yearly = gpd.GeoDataFrame(
-        ookla_yearly,
-        geometry=gpd.GeoSeries.from_wkt(ookla_yearly["tile"], crs="epsg:4326"),
+        ookla_yearly, geometry=quadkeys_to_polygons(ookla_yearly["quadkey"])
     )
 
     # GeoWrangler: area zonal stats of features per AOI
-    features = ookla_yearly.columns[
-        ~ookla_yearly.columns.isin(["quadkey", "tile", "geometry"])
-    ]
+    features = ookla_yearly.columns[~ookla_yearly.columns.isin(["quadkey", "geometry"])]
     agg_funcs = ["mean"]
     feature_aggregrations = [
         dict(func=agg_funcs, column=feature) for feature in features
@@ -342,29 +1947,130 @@ def _read_and_filter_quadkey_parquet_file(
     filter_quadkey_list,
     input_quadkey_col="quadkey",
     batch_size=50000,
+    columns=None,
 ):
-    """Read parquet file with a quadkey in batches and filter based on given quadkey list"""
+    """Read parquet file with a quadkey in batches and filter based on given quadkey list.
+    The filter quadkeys can be at any mix of zoom levels."""
     parquet_file = pq.ParquetFile(parquet_file)
 
-    # Get the zoom level of the filter quadkey list. All entries must be the same level
-    filter_quadkey_list_iter = iter(filter_quadkey_list)
-    first_key_zoom_lvl = len(next(filter_quadkey_list_iter))
-    if not all(len(key) == first_key_zoom_lvl for key in filter_quadkey_list_iter):
-        raise ValueError(
-            f"Not all items in filter_quadkey_list are of the same zoom level."
-        )
-    filter_quadkey_zoom_lvl = first_key_zoom_lvl
+    if columns is not None:
+        columns = [col for col in columns if col in parquet_file.schema_arrow.names]
 
     batch_df_list = []
-    for batch in parquet_file.iter_batches(batch_size):
+    for batch in parquet_file.iter_batches(batch_size, columns=columns):
         batch_df = batch.to_pandas()
-
-        # Create helper index column to filter out quadkeys at specified zoom level
-        filter_col = f"quadkey_at_zoom_lvl_{filter_quadkey_zoom_lvl}"
-        batch_df[filter_col] = batch_df[input_quadkey_col].str[:filter_quadkey_zoom_lvl]
-        batch_df = batch_df[batch_df[filter_col].isin(filter_quadkey_list)]
+        mask = _quadkey_prefix_mask(
+            batch.column(input_quadkey_col), filter_quadkey_list
+        )
+        batch_df = batch_df[mask.to_numpy(zero_copy_only=False)]
         batch_df_list.append(batch_df)
 
     output_df = pd.concat(batch_df_list, ignore_index=True)
 
     return output_df
+
+
+def _quadkey_prefix_mask(quadkeys, quadkey_prefixes):
+    """Arrow boolean mask of the quadkeys (an Arrow string array) that start with any of the
+    given prefixes
+
+    This is not interval matching: for each distinct zoom level of the prefixes the quadkeys
+    are sliced to that length with `utf8_slice_codeunits` and looked up in the prefixes with
+    `is_in`, so the cost is one hash lookup per quadkey per prefix zoom level.
+    """
+    prefixes_by_zoom_lvl = {}
+    for prefix in sorted(set(str(x) for x in quadkey_prefixes)):
+        prefixes_by_zoom_lvl.setdefault(len(prefix), []).append(prefix)
+
+    mask = None
+    for zoom_lvl, prefixes in prefixes_by_zoom_lvl.items():
+        zoom_lvl_mask = pc.is_in(
+            pc.utf8_slice_codeunits(quadkeys, 0, zoom_lvl),
+            value_set=pa.array(prefixes, type=pa.string()),
+        )
+        mask = zoom_lvl_mask if mask is None else pc.or_(mask, zoom_lvl_mask)
+    if mask is None:
+        return pa.array(np.zeros(len(quadkeys), dtype=bool))
+    return mask
+
+
+def _iter_quadkey_parquet_file(
+    parquet_file,
+    filter_quadkey_list,
+    input_quadkey_col="quadkey",
+    columns=None,
+):
+    """Iterate over the row groups of a parquet file as Arrow tables filtered to rows whose
+    quadkey starts with any of the given quadkeys
+
+    Row groups whose quadkey min/max statistics do not overlap the filter quadkeys
+    are skipped, and only the requested columns of the remaining row groups are read.
+    The filter quadkeys can be at any mix of zoom levels.
+    """
+    parquet_file = pq.ParquetFile(parquet_file)
+    schema_arrow = parquet_file.schema_arrow
+
+    if columns is None:
+        columns = schema_arrow.names
+    columns = [col for col in columns if col in schema_arrow.names]
+    if input_quadkey_col not in columns:
+        columns = [input_quadkey_col] + columns
+
+    quadkey_index = QuadkeyIndex(filter_quadkey_list)
+
+    # Skip row groups using the min/max statistics of the quadkey column
+    metadata = parquet_file.metadata
+    quadkey_col_idx = metadata.schema.names.index(input_quadkey_col)
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(quadkey_col_idx).statistics
+        if stats is None or not stats.has_min_max:
+            row_groups.append(i)
+            continue
+        stats_min, stats_max = stats.min, stats.max
+        if isinstance(stats_min, bytes):
+            stats_min, stats_max = stats_min.decode(), stats_max.decode()
+        if quadkey_index.overlaps(stats_min, stats_max):
+            row_groups.append(i)
+    logger.debug(
+        f"Scanning {len(row_groups)} out of {metadata.num_row_groups} row groups"
+    )
+
+    # Rows are filtered in Arrow, the quadkey index is only used to prune row groups
+    for i in row_groups:
+        table = parquet_file.read_row_group(i, columns=columns)
+        table = table.filter(
+            _quadkey_prefix_mask(table[input_quadkey_col], filter_quadkey_list)
+        )
+        if table.num_rows > 0:
+            yield table
+
+
+def _scan_quadkey_parquet_file(
+    parquet_file,
+    filter_quadkey_list,
+    input_quadkey_col="quadkey",
+    columns=None,
+):
+    """Read rows of a parquet file whose quadkey starts with any of the given quadkeys
+
+    Only the row groups and columns needed are read and filtered in Arrow
+    (see `_iter_quadkey_parquet_file`) before converting to pandas.
+    """
+    tables = list(
+        _iter_quadkey_parquet_file(
+            parquet_file, filter_quadkey_list, input_quadkey_col, columns
+        )
+    )
+    if tables:
+        output_table = pa.concat_tables(tables)
+    else:
+        schema_arrow = pq.read_schema(parquet_file)
+        if columns is None:
+            columns = schema_arrow.names
+        columns = [col for col in columns if col in schema_arrow.names]
+        if input_quadkey_col not in columns:
+            columns = [input_quadkey_col] + columns
+        output_table = schema_arrow.empty_table().select(columns)
+
+    return output_table.to_pandas()
@@ -0,0 +1,327 @@
+import hashlib
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from affine import Affine
+from loguru import logger
+from rasterio import features
+from rasterio.windows import Window
+
+PIXEL_COVERAGE_FUNCS = ["min", "max", "mean", "median", "std", "sum", "count"]
+
+
+class PixelCoverage:
+    """Pixels covered by each of a list of geometries on a fixed raster grid.
+
+    For each geometry, stores the flat indices of the covered pixels on a grid
+    (transform and shape) and their coverage weights, in CSR layout. With the default
+    pixel center coverage, the weights are all 1 and the stats are the same as
+    `geowrangler.raster_zonal_stats.create_raster_zonal_stats` (i.e. `rasterstats`).
+    Once built for a grid, the stats of any raster on that grid (e.g. every year of
+    the VIIRS annual products) are a gather and reduce without any geometry work.
+    """
+
+    def __init__(self, indptr, pixel_indices, weights, transform, shape):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.pixel_indices = np.asarray(pixel_indices, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.transform = Affine(*tuple(transform)[:6])
+        self.shape = tuple(int(x) for x in shape)
+        if len(self.pixel_indices) != len(self.weights):
+            raise ValueError(
+                f"Number of pixel indices {len(self.pixel_indices)} does not match the {len(self.weights)} weights"
+            )
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @classmethod
+    def from_geometries(
+        cls,
+        geometries,
+        transform,
+        shape,
+        all_touched=False,
+        fractional=False,
+        supersample=10,
+    ):
+        """Rasterize each geometry in its own bounds window on the grid.
+        With fractional, the weights are the fraction of each touched pixel covered by the
+        geometry, estimated on a supersample x supersample subgrid of the pixel."""
+        transform = Affine(*tuple(transform)[:6])
+        height, width = shape
+        geometries = _geometries(geometries)
+
+        logger.info(
+            f"Building pixel coverage for {len(geometries)} geometries on a {height}x{width} grid"
+        )
+        indptr = [0]
+        pixel_indices, weights = [], []
+        for geom in geometries:
+            window = _bounds_window(geom, transform, shape)
+            if window is None:
+                indptr.append(indptr[-1])
+                continue
+            row_off, col_off, win_height, win_width = window
+            win_transform = transform * Affine.translation(col_off, row_off)
+            if fractional:
+                coverage = features.rasterize(
+                    [(geom, 1)],
+                    out_shape=(win_height * supersample, win_width * supersample),
+                    transform=win_transform * Affine.scale(1 / supersample),
+                    fill=0,
+                    dtype="uint8",
+                )
+                coverage = coverage.reshape(
+                    win_height, supersample, win_width, supersample
+                ).mean(axis=(1, 3))
+                touched = features.rasterize(
+                    [(geom, 1)],
+                    out_shape=(win_height, win_width),
+                    transform=win_transform,
+                    fill=0,
+                    dtype="uint8",
+                    all_touched=True,
+                ).astype(bool)
+                # Touched pixels missed by the subgrid get the smallest nonzero weight
+                coverage = np.where(
+                    touched, np.maximum(coverage, 1 / supersample**2), 0
+                )
+            else:
+                coverage = features.rasterize(
+                    [(geom, 1)],
+                    out_shape=(win_height, win_width),
+                    transform=win_transform,
+                    fill=0,
+                    dtype="uint8",
+                    all_touched=all_touched,
+                )
+            rows, cols = np.nonzero(coverage)
+            pixel_indices.append((rows + row_off) * width + (cols + col_off))
+            weights.append(coverage[rows, cols])
+            indptr.append(indptr[-1] + len(rows))
+
+        return cls(
+            indptr,
+            np.concatenate(pixel_indices) if pixel_indices else [],
+            np.concatenate(weights) if weights else [],
+            transform,
+            shape,
+        )
+
+    def save(self, path):
+        # Written to a temp file first since concurrent workers may build the same coverage
+        tmp_path = Path(f"{path}.{os.getpid()}.tmp.npz")
+        np.savez_compressed(
+            tmp_path,
+            indptr=self.indptr,
+            pixel_indices=self.pixel_indices,
+            weights=self.weights,
+            transform=np.array(tuple(self.transform)[:6]),
+            shape=np.array(self.shape),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            return cls(
+                npz["indptr"],
+                npz["pixel_indices"],
+                npz["weights"],
+                npz["transform"],
+                npz["shape"],
+            )
+
+    def zonal_stats(self, values, func, column, nodata=None):
+        """Stats of the values (a 2D array on the grid) over the pixels of each geometry,
+        as a dataframe with a `{column}_{func}` column for each func. Pixels equal to nodata
+        or NaN are skipped and geometries without any valid pixel are NaN (0 for count)."""
+        values = np.asarray(values)
+        if values.shape != self.shape:
+            raise ValueError(
+                f"Values of shape {values.shape} do not match the coverage grid {self.shape}"
+            )
+        pixel_values = values.reshape(-1)[self.pixel_indices]
+        return self._reduce(pixel_values, func, column, nodata)
+
+    def multiband_zonal_stats(self, values, aggregations, nodata=None):
+        """Stats of several bands of values (a 3D band x row x col array on the grid) in one
+        gather of the pixels of each geometry. Each aggregation is a dict with the band
+        (index of the first axis of values), func and column, and optionally the nodata of
+        the band (nodata by default). Returns the stat columns of every aggregation."""
+        values = np.asarray(values)
+        if values.shape[1:] != self.shape:
+            raise ValueError(
+                f"Values of shape {values.shape} do not match the coverage grid {self.shape}"
+            )
+        pixel_values = values.reshape(len(values), -1)[:, self.pixel_indices]
+        return pd.concat(
+            [
+                self._reduce(
+                    pixel_values[agg["band"]],
+                    agg["func"],
+                    agg["column"],
+                    agg.get("nodata", nodata),
+                )
+                for agg in aggregations
+            ],
+            axis=1,
+        )
+
+    def _reduce(self, pixel_values, func, column, nodata):
+        # Reduce the values of the covered pixels, in pixel_indices order, per geometry
+        if isinstance(func, str):
+            func = [func]
+        unknown_funcs = set(func) - set(PIXEL_COVERAGE_FUNCS)
+        if unknown_funcs:
+            raise ValueError(
+                f"Unsupported pixel coverage funcs {sorted(unknown_funcs)}, use any of {PIXEL_COVERAGE_FUNCS}"
+            )
+
+        num_geoms = len(self)
+        geom_ids = np.repeat(np.arange(num_geoms), np.diff(self.indptr))
+        pixel_values = pixel_values.astype(np.float64)
+        valid = ~np.isnan(pixel_values)
+        if nodata is not None:
+            valid &= pixel_values != nodata
+        geom_ids, pixel_values = geom_ids[valid], pixel_values[valid]
+        weights = self.weights[valid].astype(np.float64)
+
+        counts = np.bincount(geom_ids, minlength=num_geoms)
+        has_values = counts > 0
+        weight_sums = np.bincount(geom_ids, weights=weights, minlength=num_geoms)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = (
+                np.bincount(
+                    geom_ids, weights=weights * pixel_values, minlength=num_geoms
+                )
+                / weight_sums
+            )
+
+        stats = {}
+        if {"min", "max", "median"} & set(func):
+            # Sorting by geometry then value puts each geometry's order stats in one run
+            sorted_values = pixel_values[np.lexsort((pixel_values, geom_ids))]
+            starts = np.cumsum(counts) - counts
+            last = np.where(has_values, starts + counts - 1, 0)
+            lower = np.where(has_values, starts + (counts - 1) // 2, 0)
+            upper = np.where(has_values, starts + counts // 2, 0)
+            if len(sorted_values) == 0:
+                sorted_values = np.full(1, np.nan)
+            stats["min"] = sorted_values[np.where(has_values, starts, 0)]
+            stats["max"] = sorted_values[last]
+            stats["median"] = (sorted_values[lower] + sorted_values[upper]) / 2
+        if "std" in func:
+            deviations = np.bincount(
+                geom_ids,
+                weights=weights * (pixel_values - means[geom_ids]) ** 2,
+                minlength=num_geoms,
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                stats["std"] = np.sqrt(deviations / weight_sums)
+        stats["mean"] = means
+        stats["sum"] = np.bincount(
+            geom_ids, weights=weights * pixel_values, minlength=num_geoms
+        )
+        stats["count"] = counts
+
+        results = {}
+        for f in func:
+            result = stats[f]
+            if f != "count":
+                result = np.where(has_values, result, np.nan)
+            results[f"{column}_{f}"] = result
+        return pd.DataFrame(results)
+
+    def raster_zonal_stats(self, raster_file, func, column, band_num=1, nodata=None):
+        """Same as `zonal_stats` over a band of a raster file. The raster can be any window of
+        a grid with the same pixel size that is aligned with the coverage grid, as long as it
+        contains the whole coverage grid, e.g. a larger clip of the same global raster."""
+        with rasterio.open(raster_file) as src:
+            window = self.grid_window(src.transform, src.shape)
+            values = src.read(band_num, window=window)
+            if nodata is None:
+                nodata = src.nodata
+        return self.zonal_stats(values, func, column, nodata=nodata)
+
+    def grid_window(self, transform, shape):
+        "Window of the coverage grid within a raster grid with the transform and shape"
+        col_off, row_off = ~transform * (self.transform.c, self.transform.f)
+        if (
+            not np.allclose(tuple(transform)[:6:4], tuple(self.transform)[:6:4])
+            or not np.isclose(col_off, round(col_off), atol=1e-6)
+            or not np.isclose(row_off, round(row_off), atol=1e-6)
+        ):
+            raise ValueError(
+                f"Raster grid {tuple(transform)[:6]} is not aligned with the coverage grid {tuple(self.transform)[:6]}"
+            )
+        col_off, row_off = round(col_off), round(row_off)
+        height, width = self.shape
+        if (
+            row_off < 0
+            or col_off < 0
+            or row_off + height > shape[0]
+            or col_off + width > shape[1]
+        ):
+            raise ValueError(
+                f"Raster of shape {tuple(shape)} does not contain the coverage grid {self.shape} at offset {(row_off, col_off)}"
+            )
+        return Window(col_off, row_off, width, height)
+
+
+def _geometries(geometries):
+    # Geometries of a GeoDataFrame/GeoSeries or an iterable of shapely geometries
+    return np.asarray(getattr(geometries, "geometry", geometries))
+
+
+def _bounds_window(geom, transform, shape):
+    # Same window as `rasterstats`, clipped to the grid. None if empty or outside the grid
+    if geom is None or geom.is_empty:
+        return None
+    minx, miny, maxx, maxy = geom.bounds
+    row_start = math.floor((maxy - transform.f) / transform.e)
+    col_start = math.floor((minx - transform.c) / transform.a)
+    row_stop = math.ceil((miny - transform.f) / transform.e)
+    col_stop = math.ceil((maxx - transform.c) / transform.a)
+    row_start, col_start = max(row_start, 0), max(col_start, 0)
+    row_stop, col_stop = min(row_stop, shape[0]), min(col_stop, shape[1])
+    if row_stop <= row_start or col_stop <= col_start:
+        return None
+    return row_start, col_start, row_stop - row_start, col_stop - col_start
+
+
+def pixel_coverage_key(
+    geometries, transform, shape, all_touched=False, fractional=False
+):
+    "Hash of the geometries, grid and coverage options to key persisted pixel coverages"
+    m = hashlib.md5()
+    for geom_wkb in shapely.to_wkb(_geometries(geometries)):
+        m.update(geom_wkb if geom_wkb is not None else b"")
+    m.update(np.array(tuple(Affine(*tuple(transform)[:6]))[:6]).tobytes())
+    m.update(np.array(shape, dtype=np.int64).tobytes())
+    m.update(f"{all_touched}{fractional}".encode())
+    return m.hexdigest()
+
+
+def get_pixel_coverage(
+    geometries, transform, shape, cache_dir, all_touched=False, fractional=False
+):
+    "Load the pixel coverage of the geometries on the grid from cache_dir, building it if missing"
+    key = pixel_coverage_key(geometries, transform, shape, all_touched, fractional)
+    cache_dir = Path(os.path.expanduser(cache_dir))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    coverage_file = cache_dir / f"{key}.npz"
+    if coverage_file.exists():
+        logger.info(f"Retrieving pixel coverage {coverage_file}")
+        return PixelCoverage.load(coverage_file)
+    coverage = PixelCoverage.from_geometries(
+        geometries, transform, shape, all_touched=all_touched, fractional=fractional
+    )
+    coverage.save(coverage_file)
+    return coverage
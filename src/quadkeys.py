@@ -0,0 +1,179 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# Quadkeys are encoded as 2 bits per zoom level, so zoom levels up to 31 fit in a uint64
+MAX_ZOOM_LVL = 31
+
+
+def quadkeys_to_ints(quadkeys):
+    """Encode quadkey strings as (zoom level, uint64 tile id) arrays.
+    The tile id interleaves the x and y bits of the tile, 2 bits per quadkey digit."""
+    quadkeys = np.asarray(quadkeys, dtype="S")
+    if quadkeys.ndim != 1:
+        quadkeys = quadkeys.reshape(-1)
+    zoom_lvls = np.char.str_len(quadkeys).astype(np.uint8)
+    if len(quadkeys) > 0 and zoom_lvls.max() > MAX_ZOOM_LVL:
+        raise ValueError(f"Quadkeys cannot be deeper than zoom level {MAX_ZOOM_LVL}")
+
+    max_zoom_lvl = quadkeys.dtype.itemsize
+    quadkey_bytes = quadkeys.view(np.uint8).reshape(len(quadkeys), max_zoom_lvl)
+    digits = quadkey_bytes.astype(np.int64) - ord("0")
+    # Positions past the end of a quadkey are null padded
+    in_quadkey = np.arange(max_zoom_lvl) < zoom_lvls[:, None]
+    if np.any(in_quadkey & ((digits < 0) | (digits > 3))):
+        raise ValueError("Quadkeys must only contain the digits 0, 1, 2 and 3")
+    digits = np.where(in_quadkey, digits, 0).astype(np.uint64)
+
+    tile_ids = np.zeros(len(quadkeys), dtype=np.uint64)
+    for i in range(max_zoom_lvl):
+        tile_ids = np.where(
+            in_quadkey[:, i], (tile_ids << np.uint64(2)) | digits[:, i], tile_ids
+        )
+    return zoom_lvls, tile_ids
+
+
+def ints_to_quadkeys(zoom_lvls, tile_ids):
+    "Decode (zoom level, uint64 tile id) arrays back into quadkey strings"
+    zoom_lvls = np.asarray(zoom_lvls, dtype=np.uint64)
+    tile_ids = np.asarray(tile_ids, dtype=np.uint64)
+    quadkeys = []
+    for zoom_lvl, tile_id in zip(zoom_lvls.tolist(), tile_ids.tolist()):
+        digits = [
+            str((tile_id >> (2 * (zoom_lvl - 1 - i))) & 3) for i in range(zoom_lvl)
+        ]
+        quadkeys.append("".join(digits))
+    return quadkeys
+
+
+def quadkeys_to_tiles(quadkeys):
+    "Decode quadkeys into (x, y, zoom level) Bing tile coordinate arrays"
+    zoom_lvls, tile_ids = quadkeys_to_ints(quadkeys)
+    x = np.zeros(len(tile_ids), dtype=np.uint64)
+    y = np.zeros(len(tile_ids), dtype=np.uint64)
+    max_zoom_lvl = int(zoom_lvls.max()) if len(zoom_lvls) > 0 else 0
+    # Each quadkey digit holds the x bit in its low bit and the y bit in its high bit
+    for i in range(max_zoom_lvl):
+        digits = (tile_ids >> np.uint64(2 * i)) & np.uint64(3)
+        x |= (digits & np.uint64(1)) << np.uint64(i)
+        y |= (digits >> np.uint64(1)) << np.uint64(i)
+    return x, y, zoom_lvls
+
+
+def quadkeys_to_bounds(quadkeys):
+    "Get the (minx, miny, maxx, maxy) lon/lat bounds of the Bing tiles of the quadkeys"
+    x, y, zoom_lvls = quadkeys_to_tiles(quadkeys)
+    x, y = x.astype(np.float64), y.astype(np.float64)
+    num_tiles = np.exp2(zoom_lvls.astype(np.float64))
+
+    def tile_lat(tile_y):
+        return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * tile_y / num_tiles))))
+
+    minx = x / num_tiles * 360.0 - 180.0
+    maxx = (x + 1) / num_tiles * 360.0 - 180.0
+    miny = tile_lat(y + 1)
+    maxy = tile_lat(y)
+    return minx, miny, maxx, maxy
+
+
+def quadkeys_to_polygons(quadkeys, crs="epsg:4326"):
+    "Build the Bing tile polygons of the quadkeys as a GeoSeries in one vectorized call"
+    index = quadkeys.index if isinstance(quadkeys, pd.Series) else None
+    return gpd.GeoSeries(
+        shapely.box(*quadkeys_to_bounds(quadkeys)), index=index, crs=crs
+    )
+
+
+def quadkey_intervals(quadkeys):
+    """Get the [start, end) interval of tile ids at MAX_ZOOM_LVL covered by each quadkey.
+    A quadkey is a prefix of another if and only if its interval contains the other's."""
+    zoom_lvls, tile_ids = quadkeys_to_ints(quadkeys)
+    shifts = (2 * (MAX_ZOOM_LVL - zoom_lvls.astype(np.int64))).astype(np.uint64)
+    starts = tile_ids << shifts
+    ends = starts + (np.uint64(1) << shifts)
+    return starts, ends
+
+
+class QuadkeyIndex:
+    """Index of quadkey prefixes at any mix of zoom levels for coverage checks and pruning.
+
+    The prefixes are stored as sorted, merged intervals of tile ids at MAX_ZOOM_LVL so that
+    `contains` checks n quadkeys against m prefixes with a sorted search costing O(n log m)
+    and `overlaps` checks a lexicographic quadkey range (e.g. parquet row group statistics).
+    Parquet rows themselves are filtered in Arrow, see `ookla._quadkey_prefix_mask`.
+    """
+
+    def __init__(self, quadkey_prefixes):
+        starts, ends = quadkey_intervals(quadkey_prefixes)
+        self.zoom_lvls = sorted(set(len(str(x)) for x in quadkey_prefixes))
+
+        order = np.argsort(starts, kind="stable")
+        starts, ends = starts[order], ends[order]
+
+        # Merge nested and adjacent intervals so that both starts and ends are sorted
+        merged_starts, merged_ends = [], []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if merged_ends and start <= merged_ends[-1]:
+                merged_ends[-1] = max(merged_ends[-1], end)
+            else:
+                merged_starts.append(start)
+                merged_ends.append(end)
+        self.starts = np.array(merged_starts, dtype=np.uint64)
+        self.ends = np.array(merged_ends, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def contains(self, quadkeys):
+        "Boolean array of whether each quadkey falls under any of the indexed prefixes"
+        starts, ends = quadkey_intervals(quadkeys)
+        idx = np.searchsorted(self.starts, starts, side="right") - 1
+        found = idx >= 0
+        idx = np.where(found, idx, 0)
+        if len(self.ends) == 0:
+            return np.zeros(len(starts), dtype=bool)
+        return found & (ends <= self.ends[idx])
+
+    def overlaps(self, min_quadkey, max_quadkey):
+        """Check if any quadkey between min_quadkey and max_quadkey (in lexicographic order)
+        can fall under the indexed prefixes, e.g. to skip parquet row groups using statistics"""
+        if len(self.starts) == 0:
+            return False
+        (min_start,), _ = quadkey_intervals([min_quadkey])
+        _, (max_end,) = quadkey_intervals([max_quadkey])
+        # Only the last interval starting before max_end can reach past min_start
+        idx = int(np.searchsorted(self.starts, max_end, side="left"))
+        return idx > 0 and self.ends[idx - 1] > min_start
+
+
+def quadkey_cover(geometries, zoom_lvl=16):
+    """Cover geometries with a compact set of quadkey prefixes at a mix of zoom levels.
+
+    Descends the quadtree from the root and only splits tiles on the boundary of the
+    geometries. Tiles fully within a geometry are emitted as coarse prefixes, and boundary
+    tiles down to zoom_lvl are emitted if they intersect a geometry. The zoom_lvl tiles under
+    the prefixes are the same as the tiles from `grids.BingTileGridGenerator(zoom_lvl)`.
+    """
+    geometries = gpd.GeoSeries(geometries.geometry).to_crs("epsg:4326")
+    geometries = geometries[~(geometries.is_empty | geometries.isna())]
+    tree = shapely.STRtree(geometries.to_numpy())
+
+    cover = []
+    quadkeys = np.array([""])
+    for tile_zoom_lvl in range(zoom_lvl + 1):
+        boxes = shapely.box(*quadkeys_to_bounds(quadkeys))
+        intersects = np.zeros(len(quadkeys), dtype=bool)
+        intersects[np.unique(tree.query(boxes, predicate="intersects")[0])] = True
+        within = np.zeros(len(quadkeys), dtype=bool)
+        within[np.unique(tree.query(boxes, predicate="within")[0])] = True
+
+        if tile_zoom_lvl == zoom_lvl:
+            cover.extend(quadkeys[intersects].tolist())
+            break
+        cover.extend(quadkeys[within].tolist())
+        boundary = quadkeys[intersects & ~within]
+        quadkeys = np.char.add(
+            np.repeat(boundary, 4), np.tile(list("0123"), len(boundary))
+        )
+    return sorted(cover)
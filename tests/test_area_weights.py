@@ -0,0 +1,55 @@
+import geopandas as gpd
+import geowrangler.area_zonal_stats as azs
+import numpy as np
+import pandas as pd
+import shapely
+
+from src.area_weights import AreaWeights
+
+
+def test_area_weights_mean_matches_area_zonal_stats():
+    rng = np.random.default_rng(0)
+    tiles = gpd.GeoDataFrame(
+        dict(
+            key=[f"tile_{i:02d}_{j:02d}" for i in range(10) for j in range(10)],
+            value=rng.random(100) * 100,
+            other_value=rng.random(100),
+        ),
+        geometry=[
+            shapely.box(
+                121 + 0.01 * i, 14 + 0.01 * j, 121.01 + 0.01 * i, 14.01 + 0.01 * j
+            )
+            for i in range(10)
+            for j in range(10)
+        ],
+        crs="epsg:4326",
+    )
+    tiles.loc[[3, 40], "value"] = np.nan
+    aoi = gpd.GeoDataFrame(
+        geometry=[
+            shapely.Point(121.03, 14.04).buffer(0.02),
+            shapely.box(121.055, 14.001, 121.075, 14.009),
+            # No overlapping tiles
+            shapely.box(122, 15, 122.1, 15.1),
+        ],
+        crs="epsg:4326",
+    )
+    columns = ["value", "other_value"]
+    expected = azs.create_area_zonal_stats(
+        aoi.to_crs("epsg:3123"),
+        tiles.to_crs("epsg:3123"),
+        [dict(func=["mean"], column=column) for column in columns],
+    )
+
+    area_weights = AreaWeights.from_geometries(aoi, tiles, "key")
+    means = area_weights.mean(tiles.sample(frac=1, random_state=0), "key", columns)
+    for column in columns:
+        np.testing.assert_allclose(means[column], expected[f"{column}_mean"])
+    assert means.loc[2].isna().all()
+
+    # Data keys are sorted when the weights are built from unsorted keys
+    order = rng.permutation(len(area_weights.data_keys))
+    shuffled = AreaWeights(
+        area_weights.weights[:, order], area_weights.data_keys[order]
+    )
+    pd.testing.assert_frame_equal(shuffled.mean(tiles, "key", columns), means)
@@ -0,0 +1,156 @@
+import contextlib
+import os
+import sqlite3
+import subprocess
+import sys
+
+from src import asset_store
+from src.asset_store import AssetStore, get_asset_store
+
+
+def test_asset_store_dedupes_and_evicts_lru_downloads(tmp_path):
+    store = AssetStore(tmp_path)
+    paths = {}
+    for name, content in [
+        ("a.parquet", b"a" * 100),
+        ("b.parquet", b"b" * 100),
+        ("b_copy.parquet", b"b" * 100),
+        ("extract.parquet", b"c" * 100),
+    ]:
+        paths[name] = tmp_path / name
+        paths[name].write_bytes(content)
+    store.add(paths["a.parquet"], "ookla", url="http://example.com/a")
+    store.add(paths["extract.parquet"], "ookla")
+    store.add(paths["b.parquet"], "nightlights", url="http://example.com/b")
+    store.add(paths["b_copy.parquet"], "nightlights", url="http://example.com/b")
+    store.touch(paths["a.parquet"])
+
+    usage = store.du()
+    assert usage.loc["nightlights"].tolist() == [2, 200, 100, 200]
+    assert usage.loc["ookla"].tolist() == [2, 200, 200, 100]
+    assert store.size_bytes() == 300
+
+    assert store.dedupe() == [str(paths["b_copy.parquet"].resolve())]
+    assert os.path.samefile(paths["b.parquet"], paths["b_copy.parquet"])
+
+    # Both links of the least recently used download go to free its bytes
+    evicted = store.gc(max_size_bytes=200)
+    assert sorted(evicted) == sorted(
+        str(paths[name].resolve()) for name in ["b.parquet", "b_copy.parquet"]
+    )
+    assert paths["a.parquet"].exists() and paths["extract.parquet"].exists()
+    assert store.size_bytes() == 200
+
+    # Assets without a url are never evicted
+    store.gc(max_size_bytes=0)
+    assert not paths["a.parquet"].exists() and paths["extract.parquet"].exists()
+
+    paths["extract.parquet"].write_bytes(b"c" * 50)
+    assert not store.verify(paths["extract.parquet"])
+    assert not store.verify(tmp_path / "missing.parquet")
+
+
+def test_asset_store_only_hashes_changed_files(tmp_path, monkeypatch):
+    hashed = []
+    file_sha256 = asset_store.file_sha256
+
+    def counting_file_sha256(path):
+        hashed.append(path)
+        return file_sha256(path)
+
+    monkeypatch.setattr(asset_store, "file_sha256", counting_file_sha256)
+    store = AssetStore(tmp_path)
+    path = tmp_path / "a.parquet"
+    path.write_bytes(b"a" * 100)
+    store.add(path, "ookla", url="http://example.com/a")
+    store.add(path, "ookla", url="http://example.com/a")
+    assert len(hashed) == 1
+
+    # Same size but a new modification time
+    path.write_bytes(b"b" * 100)
+    os.utime(path, ns=(0, 0))
+    store.add(path, "ookla", url="http://example.com/a")
+    assert len(hashed) == 2
+    assert store.assets()["sha256"].tolist() == [file_sha256(path)]
+
+
+def test_asset_store_migrates_manifest_without_mtime(tmp_path):
+    path = tmp_path / "a.parquet"
+    path.write_bytes(b"a" * 100)
+    with contextlib.closing(sqlite3.connect(tmp_path / "assets.sqlite")) as conn, conn:
+        conn.execute(
+            """CREATE TABLE assets (
+                path TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                url TEXT,
+                size_bytes INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        conn.execute(
+            "INSERT INTO assets VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (str(path.resolve()), "ookla", None, 100, "sha256", 0.0, 0.0),
+        )
+    store = AssetStore(tmp_path)
+    assert store.verify(path)
+    store.add(path, "ookla")
+    assets = store.assets()
+    assert assets["mtime"].tolist() == [path.stat().st_mtime]
+    assert assets["sha256"].tolist() == [asset_store.file_sha256(path)]
+
+
+def test_get_asset_store_sets_budget(tmp_path, monkeypatch):
+    monkeypatch.setenv(asset_store.ASSET_STORE_MAX_BYTES_ENV_VAR, "1000")
+    assert AssetStore(tmp_path / "env").max_size_bytes == 1000
+    assert AssetStore(tmp_path / "arg", max_size_bytes=10).max_size_bytes == 10
+
+    store = get_asset_store(tmp_path / "shared", max_size_bytes=10)
+    assert store.max_size_bytes == 10
+    assert get_asset_store(tmp_path / "shared") is store
+    assert store.max_size_bytes == 10
+    get_asset_store(tmp_path / "shared", max_size_bytes=20)
+    assert store.max_size_bytes == 20
+
+
+def test_asset_store_does_not_evict_leased_assets(tmp_path):
+    store = AssetStore(tmp_path)
+    paths = [tmp_path / f"{name}.tif" for name in "ab"]
+    for i, path in enumerate(paths):
+        path.write_bytes(bytes([i]) * 100)
+        store.add(path, "nightlights", url=f"http://example.com/{path.name}")
+
+    with store.lease(paths[0]):
+        assert store.gc(max_size_bytes=0) == [str(paths[1].resolve())]
+        assert paths[0].exists()
+    assert store.gc(max_size_bytes=0) == [str(paths[0].resolve())]
+
+    # Leases of processes that exited are ignored
+    paths[1].write_bytes(b"b" * 100)
+    store.add(paths[1], "nightlights", url="http://example.com/b.tif")
+    process = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True,
+        text=True,
+    )
+    with contextlib.closing(sqlite3.connect(tmp_path / "assets.sqlite")) as conn, conn:
+        conn.execute(
+            "INSERT INTO leases VALUES (?, ?, ?)",
+            ("token", str(paths[1].resolve()), int(process.stdout)),
+        )
+    assert store.gc(max_size_bytes=0) == [str(paths[1].resolve())]
+
+
+def test_asset_store_discards_assets_once_released(tmp_path):
+    store = AssetStore(tmp_path)
+    path = tmp_path / "a.tif.gz"
+    path.write_bytes(b"a" * 100)
+    store.add(path, "nightlights", url="http://example.com/a.tif.gz")
+
+    with store.lease(path):
+        assert not store.discard(path)
+        assert path.exists()
+    assert store.discard(path)
+    assert not path.exists()
+    assert len(store.assets()) == 0
@@ -0,0 +1,756 @@
+import errno
+import gzip
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import geopandas as gpd
+import geowrangler.raster_process as rp
+import geowrangler.raster_zonal_stats as rzs
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+
+from src import nightlights
+
+
+class FlakyRangeRequestHandler(SimpleHTTPRequestHandler):
+    "Local stand-in for the EOG server that drops the first response halfway"
+
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.requests.append(range_header)
+        with open(self.translate_path(self.path), "rb") as f:
+            content = f.read()
+
+        start = 0 if range_header is None else int(range_header[6:].split("-")[0])
+        if start > 0:
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        if len(self.requests) == 1:
+            self.wfile.write(content[: len(content) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:])
+
+
+@pytest.fixture
+def eog_server(tmp_path):
+    server_dir = tmp_path / "server"
+    server_dir.mkdir()
+    content = os.urandom(100_000)
+    (server_dir / "viirs.tif.gz").write_bytes(content)
+
+    FlakyRangeRequestHandler.requests = []
+    handler = partial(FlakyRangeRequestHandler, directory=str(server_dir))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/viirs.tif.gz", content
+    server.shutdown()
+
+
+@pytest.mark.parametrize("use_session", [False, True])
+def test_download_url_resumes_interrupted_download(tmp_path, eog_server, use_session):
+    url, content = eog_server
+    dest = tmp_path / "viirs.tif.gz"
+    session = None
+    if use_session:
+        import requests
+
+        session = requests.Session()
+
+    nightlights.download_url(
+        url,
+        dest=dest,
+        access_token="token",
+        show_progress=False,
+        chunksize=4096,
+        session=session,
+        backoff=0,
+    )
+    assert dest.read_bytes() == content
+    assert not os.path.exists(f"{dest}.part")
+    # The retry resumed from the bytes already written to the part file
+    first, resumed = FlakyRangeRequestHandler.requests
+    assert first is None
+    assert 0 < int(resumed[6:-1]) <= len(content) // 2
+
+
+@pytest.mark.parametrize("use_session", [False, True])
+def test_download_url_does_not_retry_file_system_errors(
+    tmp_path, eog_server, monkeypatch, use_session
+):
+    url, content = eog_server
+    writes = []
+
+    def write_blocks(*args):
+        writes.append(args)
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(nightlights, "_write_blocks", write_blocks)
+    monkeypatch.setattr(nightlights.time, "sleep", lambda seconds: None)
+    session = None
+    if use_session:
+        import requests
+
+        session = requests.Session()
+
+    with pytest.raises(OSError) as excinfo:
+        nightlights.download_url(
+            url,
+            dest=tmp_path / "viirs.tif.gz",
+            access_token="token",
+            show_progress=False,
+            session=session,
+        )
+    assert excinfo.value.errno == errno.ENOSPC
+    assert len(writes) == 1
+
+
+def write_global_raster(path, values):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=values.shape[0],
+        width=values.shape[1],
+        count=1,
+        dtype="float32",
+        crs="epsg:4326",
+        transform=from_origin(115.0, 22.0, 0.05, 0.05),
+        nodata=-999,
+    ) as dst:
+        dst.write(values, 1)
+    return path
+
+
+class CountingRequestHandler(SimpleHTTPRequestHandler):
+    "Local stand-in for the EOG server that records the requested paths"
+
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        super().do_GET()
+
+
+@pytest.fixture
+def viirs_server(tmp_path, monkeypatch):
+    "Serve a gzipped global raster as the VIIRS url of every product and year"
+    server_dir = tmp_path / "server"
+    server_dir.mkdir()
+    global_file = write_global_raster(
+        tmp_path / "global.tif",
+        np.arange(200 * 300, dtype="float32").reshape(200, 300),
+    )
+    with open(global_file, "rb") as f_in, gzip.open(
+        server_dir / "VNL_test.average.dat.tif.gz", "wb"
+    ) as f_out:
+        shutil.copyfileobj(f_in, f_out)
+
+    CountingRequestHandler.requests = []
+    handler = partial(CountingRequestHandler, directory=str(server_dir))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/VNL_test.average.dat.tif.gz"
+    monkeypatch.setattr(nightlights, "make_url", lambda year, **kwargs: url)
+    monkeypatch.setenv(nightlights.EOG_ENV_VAR, "token")
+
+    yield global_file
+    server.shutdown()
+
+
+@pytest.mark.parametrize("keep_download", [False, True])
+def test_generate_clipped_raster_streams_from_gzip(
+    tmp_path, viirs_server, keep_download
+):
+    cache_dir = tmp_path / "cache"
+    bounds = np.array([120.9, 14.4, 121.2, 14.8])
+    for i in range(2):
+        clip = nightlights.generate_clipped_raster(
+            2020,
+            bounds,
+            tmp_path / f"clip_{i}.tif",
+            cache_dir=cache_dir,
+            stream=True,
+            keep_download=keep_download,
+        )
+
+    # The gzipped global file is never unzipped and is only kept with keep_download,
+    # in which case it is downloaded once into the cache
+    global_dir = cache_dir / "global"
+    global_files = [
+        filename
+        for filename in os.listdir(global_dir)
+        if not filename.endswith(".lock")
+    ]
+    asset_store = nightlights.get_nightlights_asset_store(cache_dir)
+    if keep_download:
+        assert CountingRequestHandler.requests == ["/VNL_test.average.dat.tif.gz"]
+        assert global_files == ["VNL_test.average.dat.tif.gz"]
+        assert asset_store.verify(
+            global_dir / "VNL_test.average.dat.tif.gz", checksum=True
+        )
+    else:
+        assert CountingRequestHandler.requests == ["/VNL_test.average.dat.tif.gz"] * 2
+        assert global_files == []
+        assert len(asset_store.assets()) == 0
+    expected = nightlights.clip_raster(
+        viirs_server, tmp_path / "expected.tif", bounds, buffer=0.1
+    )
+    with rasterio.open(clip) as src, rasterio.open(expected) as expected_src:
+        assert src.transform == expected_src.transform
+        assert np.array_equal(src.read(), expected_src.read())
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_generate_clipped_raster_downloads_global_file_once(
+    tmp_path, viirs_server, stream
+):
+    all_bounds = [np.array([116.0 + i, 14.4, 116.5 + i, 14.8]) for i in range(8)]
+    with ThreadPoolExecutor(max_workers=len(all_bounds)) as executor:
+        clips = list(
+            executor.map(
+                lambda i: nightlights.generate_clipped_raster(
+                    2020,
+                    all_bounds[i],
+                    tmp_path / f"clip_{i}.tif",
+                    cache_dir=tmp_path / "cache",
+                    stream=stream,
+                    keep_download=True,
+                ),
+                range(len(all_bounds)),
+            )
+        )
+
+    assert CountingRequestHandler.requests == ["/VNL_test.average.dat.tif.gz"]
+    for bounds, clip in zip(all_bounds, clips):
+        expected = nightlights.clip_raster(
+            viirs_server, tmp_path / "expected.tif", bounds, buffer=0.1
+        )
+        with rasterio.open(clip) as src, rasterio.open(expected) as expected_src:
+            assert src.transform == expected_src.transform
+            assert np.array_equal(src.read(), expected_src.read())
+
+
+def test_nightlights_asset_store_stays_in_cache_dir(
+    tmp_path, viirs_server, monkeypatch
+):
+    cache_dir = tmp_path / "scratch"
+    nightlights.generate_clipped_raster(
+        2020,
+        np.array([120.9, 14.4, 121.2, 14.8]),
+        tmp_path / "clip.tif",
+        cache_dir=cache_dir,
+    )
+    assert nightlights.get_nightlights_asset_store(cache_dir).root == cache_dir
+    assert (cache_dir / "assets.sqlite").exists()
+    assert not (tmp_path / "assets.sqlite").exists()
+    # The default cache dir shares the store of the geowrangler cache root
+    default_cache_dir = tmp_path / ".geowrangler" / "nightlights"
+    monkeypatch.setattr(nightlights, "NIGHTLIGHTS_CACHE_DIR", default_cache_dir)
+    assert (
+        nightlights.get_nightlights_asset_store(default_cache_dir).root
+        == default_cache_dir.parent
+    )
+
+
+def test_generate_clipped_raster_leases_global_file(
+    tmp_path, viirs_server, monkeypatch
+):
+    cache_dir = tmp_path / "cache"
+    store = nightlights.get_nightlights_asset_store(cache_dir)
+    global_file = (cache_dir / "global" / "VNL_test.average.dat.tif").resolve()
+    clip_raster = nightlights.clip_raster
+    evicted = []
+
+    def clip_raster_after_gc(input_raster_file, *args, **kwargs):
+        # Another thread or process adding an asset over the budget mid-clip
+        evicted.extend(store.gc(max_size_bytes=0))
+        return clip_raster(input_raster_file, *args, **kwargs)
+
+    monkeypatch.setattr(nightlights, "clip_raster", clip_raster_after_gc)
+    nightlights.generate_clipped_raster(
+        2020,
+        np.array([120.9, 14.4, 121.2, 14.8]),
+        tmp_path / "clip.tif",
+        cache_dir=cache_dir,
+    )
+    assert evicted == []
+    assert store.gc(max_size_bytes=0) == [str(global_file)]
+
+
+def test_get_clipped_raster_reuses_containing_clip(tmp_path, monkeypatch):
+    global_file = write_global_raster(
+        tmp_path / "global.tif",
+        np.arange(200 * 300, dtype="float32").reshape(200, 300),
+    )
+
+    global_clips = []
+
+    def generate_clipped_raster(year, bounds, dest, snap_to_pixels=False, **kwargs):
+        global_clips.append(bounds)
+        return nightlights.clip_raster(
+            global_file, dest, bounds, buffer=0.1, snap_to_pixels=snap_to_pixels
+        )
+
+    monkeypatch.setattr(nightlights, "generate_clipped_raster", generate_clipped_raster)
+    get_clipped_raster = partial(
+        nightlights.get_clipped_raster, 2020, cache_dir=tmp_path / "cache"
+    )
+    # Bounds off the 0.05 degree grid of the global raster
+    all_cities_bounds = np.array([119.013, 10.027, 124.021, 16.038])
+    city_bounds = np.array([120.913, 14.427, 121.234, 14.778])
+
+    def assert_same_clip(clip, bounds, snap_to_pixels):
+        expected = nightlights.clip_raster(
+            global_file,
+            tmp_path / "expected.tif",
+            bounds,
+            buffer=0.1,
+            snap_to_pixels=snap_to_pixels,
+        )
+        with rasterio.open(clip) as src, rasterio.open(expected) as expected_src:
+            assert src.transform.almost_equals(expected_src.transform)
+            assert np.array_equal(src.read(), expected_src.read())
+
+    # Snapped clips are clipped from a cached snapped clip containing them
+    get_clipped_raster(all_cities_bounds, snap_to_pixels=True)
+    city = get_clipped_raster(city_bounds, snap_to_pixels=True)
+    assert len(global_clips) == 1
+    assert_same_clip(city, city_bounds, snap_to_pixels=True)
+
+    # Cached clips are found by key without clipping again
+    assert get_clipped_raster(city_bounds, snap_to_pixels=True) == city
+    assert len(global_clips) == 1
+
+    # Unsnapped clips are on a grid shifted by their bounds, so they are always
+    # clipped from the global raster
+    all_cities = get_clipped_raster(all_cities_bounds)
+    city = get_clipped_raster(city_bounds)
+    assert len(global_clips) == 3
+    assert_same_clip(city, city_bounds, snap_to_pixels=False)
+
+    # Over the asset store budget, the least recently used clips are evicted and
+    # dropped from the clip cache
+    other_year = nightlights.get_clipped_raster(
+        2021,
+        city_bounds,
+        cache_dir=tmp_path / "cache",
+        max_size_bytes=2 * city.stat().st_size,
+    )
+    assert not all_cities.exists()
+    assert city.exists() and other_year.exists()
+    assert len(global_clips) == 4
+    clip_cache = nightlights.ClipCache(tmp_path / "cache" / "clip")
+    assert clip_cache.size_bytes() == city.stat().st_size + other_year.stat().st_size
+    get_clipped_raster(all_cities_bounds)
+    assert len(global_clips) == 5
+
+
+def test_clip_raster_replaces_deduplicated_clips(tmp_path):
+    global_file = write_global_raster(
+        tmp_path / "global.tif",
+        np.arange(200 * 300, dtype="float32").reshape(200, 300),
+    )
+    store = nightlights.get_nightlights_asset_store(tmp_path / "cache")
+    bounds = np.array([120.9, 14.4, 121.2, 14.8])
+    clips = [
+        nightlights.clip_raster(global_file, tmp_path / name, bounds, buffer=0.1)
+        for name in ["clip.tif", "clip_copy.tif"]
+    ]
+    for clip in clips:
+        store.add(clip, "nightlights", url="http://example.com/global.tif.gz")
+    assert store.dedupe() == [str(clips[1].resolve())]
+    assert os.path.samefile(*clips)
+    expected = clips[0].read_bytes()
+
+    # Rewriting one clip breaks the link instead of changing the other clip
+    nightlights.clip_raster(
+        global_file, clips[1], np.array([119.0, 10.0, 124.0, 16.0]), buffer=0.1
+    )
+    assert not os.path.samefile(*clips)
+    assert clips[0].read_bytes() == expected
+    assert store.verify(clips[0], checksum=True)
+
+
+def test_nightlights_cube_time_series(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    global_files = {
+        year: write_global_raster(
+            tmp_path / f"global_{year}.tif",
+            rng.gamma(2, 3, (200, 300)).astype("float32") + year - 2020,
+        )
+        for year in [2020, 2021, 2022]
+    }
+
+    def generate_clipped_raster(year, bounds, dest, **kwargs):
+        return nightlights.clip_raster(global_files[year], dest, bounds, buffer=0.1)
+
+    monkeypatch.setattr(nightlights, "generate_clipped_raster", generate_clipped_raster)
+    aoi = gpd.GeoDataFrame(
+        geometry=[shapely.Point(120.5 + i, 15).buffer(0.3) for i in range(3)],
+        index=["a", "b", "c"],
+        crs="epsg:4326",
+    )
+    cube = nightlights.build_nightlights_cube(
+        aoi, [2022, 2020, 2021], cache_dir=tmp_path / "cache"
+    )
+    assert cube.years == [2020, 2021, 2022]
+    assert isinstance(cube.values, np.memmap)
+    # The temp dir the cube was built in was renamed into place
+    assert os.listdir(cube.cube_dir.parent) == [cube.cube_dir.name]
+
+    time_series = cube.zonal_time_series(aoi, func=["mean", "max"])
+    expected = nightlights.generate_nightlights_feature(
+        aoi.reset_index(drop=True),
+        2021,
+        cache_dir=tmp_path / "cache",
+        func=["mean", "max"],
+    )
+    np.testing.assert_allclose(
+        time_series[time_series["year"] == 2021][["avg_rad_mean", "avg_rad_max"]],
+        expected[["avg_rad_mean", "avg_rad_max"]],
+        rtol=1e-5,
+    )
+
+    pixel_time_series = cube.pixel_time_series(120.5, 15.0)
+    with rasterio.open(global_files[2022]) as src:
+        (expected_value,) = next(src.sample([(120.5, 15.0)]))
+    assert pixel_time_series.loc[2022] == pytest.approx(expected_value)
+
+
+def test_generate_nightlights_feature_clips_per_cluster(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    global_file = write_global_raster(
+        tmp_path / "global.tif", rng.gamma(2, 3, (200, 300)).astype("float32")
+    )
+    clipped_bounds = []
+
+    def generate_clipped_raster(year, bounds, dest, snap_to_pixels=False, **kwargs):
+        clipped_bounds.append(bounds)
+        return nightlights.clip_raster(
+            global_file, dest, bounds, buffer=0.1, snap_to_pixels=snap_to_pixels
+        )
+
+    monkeypatch.setattr(nightlights, "generate_clipped_raster", generate_clipped_raster)
+    aoi = gpd.GeoDataFrame(
+        geometry=[
+            shapely.Point(x, y).buffer(0.2)
+            for x, y in [(116, 20), (116.5, 20.3), (128, 13), (128.3, 13.2)]
+        ],
+        index=[5, 6, 7, 8],
+        crs="epsg:4326",
+    )
+    assert nightlights.cluster_aoi(aoi).tolist() == [0, 0, 1, 1]
+
+    cluster_features = nightlights.generate_nightlights_feature(
+        aoi, 2020, cache_dir=tmp_path / "clusters", clip_per_cluster=True
+    )
+    assert len(clipped_bounds) == 2
+    # Cluster clips are on the global grid, so their stats are the global raster stats
+    expected = rzs.create_raster_zonal_stats(
+        aoi.reset_index(drop=True),
+        global_file.as_posix(),
+        aggregation=dict(
+            func=["min", "max", "mean", "median", "std"], column="avg_rad"
+        ),
+        extra_args=dict(band_num=1, nodata=-999),
+    ).set_axis(aoi.index)
+    pd.testing.assert_frame_equal(
+        cluster_features, expected[cluster_features.columns], rtol=1e-5
+    )
+
+
+def test_clip_raster_snaps_to_pixels(tmp_path):
+    global_file = write_global_raster(
+        tmp_path / "global.tif",
+        np.arange(200 * 300, dtype="float32").reshape(200, 300),
+    )
+    bounds = np.array([120.91, 14.42, 121.23, 14.77])
+
+    # By default the window matches the bounds, as clipped by geowrangler
+    clip = nightlights.clip_raster(global_file, tmp_path / "clip.tif", bounds, 0.1)
+    rp.query_window_by_polygon(
+        global_file.as_posix(),
+        (tmp_path / "expected.tif").as_posix(),
+        nightlights.get_bounding_polygon(bounds, 0.1),
+    )
+    with rasterio.open(clip) as src, rasterio.open(tmp_path / "expected.tif") as ex:
+        assert src.transform == ex.transform
+        assert np.array_equal(src.read(), ex.read())
+
+    snapped = nightlights.clip_raster(
+        global_file, tmp_path / "snapped.tif", bounds, 0.1, snap_to_pixels=True
+    )
+    with rasterio.open(snapped) as src, rasterio.open(global_file) as global_src:
+        window = global_src.window(*src.bounds)
+        assert window.col_off == int(window.col_off)
+        assert window.row_off == int(window.row_off)
+        assert src.bounds.left <= 120.81 and src.bounds.right >= 121.33
+        assert src.bounds.bottom <= 14.32 and src.bounds.top >= 14.87
+        assert np.array_equal(
+            src.read(1), global_src.read(1, window=window.round_offsets())
+        )
+
+
+def test_generate_nightlights_products_feature_matches_single_products(
+    tmp_path, monkeypatch
+):
+    rng = np.random.default_rng(0)
+    global_files = {
+        viirs_data_type: write_global_raster(
+            tmp_path / f"{viirs_data_type}.tif",
+            rng.gamma(2, 3, (200, 300)).astype("float32"),
+        )
+        for viirs_data_type in ["average", "cf_cvg"]
+    }
+
+    def generate_clipped_raster(
+        year, bounds, dest, viirs_data_type, snap_to_pixels=False, **kwargs
+    ):
+        return nightlights.clip_raster(
+            global_files[viirs_data_type],
+            dest,
+            bounds,
+            buffer=0.1,
+            snap_to_pixels=snap_to_pixels,
+        )
+
+    monkeypatch.setattr(nightlights, "generate_clipped_raster", generate_clipped_raster)
+    aoi = gpd.GeoDataFrame(
+        geometry=[shapely.Point(120.5 + i, 15).buffer(0.3) for i in range(3)],
+        crs="epsg:4326",
+    )
+    aggregations = [
+        dict(viirs_data_type="average", func=["mean", "median"], column="avg_rad"),
+        dict(viirs_data_type="cf_cvg", func=["max"], column="cf_cvg"),
+    ]
+    features = nightlights.generate_nightlights_products_feature(
+        aoi, 2020, aggregations=aggregations, cache_dir=tmp_path / "cache"
+    )
+    for aggregation in aggregations:
+        expected = nightlights.generate_nightlights_feature(
+            aoi,
+            2020,
+            viirs_data_type=aggregation["viirs_data_type"],
+            func=aggregation["func"],
+            column=aggregation["column"],
+            cache_dir=tmp_path / "cache",
+        )
+        columns = [f"{aggregation['column']}_{func}" for func in aggregation["func"]]
+        pd.testing.assert_frame_equal(
+            features[columns], expected[columns], check_dtype=False, rtol=1e-5
+        )
+
+
+@pytest.mark.parametrize(
+    "clip_per_cluster,stack_products", [(False, False), (True, False), (True, True)]
+)
+def test_generate_nightlights_features_matches_serial_features(
+    tmp_path, monkeypatch, clip_per_cluster, stack_products
+):
+    rng = np.random.default_rng(0)
+    global_files = {
+        (year, viirs_data_type): write_global_raster(
+            tmp_path / f"{year}_{viirs_data_type}.tif",
+            rng.gamma(2, 3, (200, 300)).astype("float32"),
+        )
+        for year in [2020, 2021]
+        for viirs_data_type in ["average", "cf_cvg"]
+    }
+
+    def generate_clipped_raster(
+        year, bounds, dest, viirs_data_type, snap_to_pixels=False, **kwargs
+    ):
+        return nightlights.clip_raster(
+            global_files[year, viirs_data_type],
+            dest,
+            bounds,
+            buffer=0.1,
+            snap_to_pixels=snap_to_pixels,
+        )
+
+    # Only the clips run in this process, the zonal stats run in spawned workers
+    monkeypatch.setattr(nightlights, "generate_clipped_raster", generate_clipped_raster)
+    aoi = gpd.GeoDataFrame(
+        geometry=[
+            shapely.Point(x, y).buffer(0.2)
+            for x, y in [(116, 20), (116.5, 20.3), (128, 13), (128.3, 13.2)]
+        ],
+        crs="epsg:4326",
+    )
+    features = nightlights.generate_nightlights_features(
+        aoi,
+        [2020, 2021],
+        viirs_data_types=["average", "cf_cvg"],
+        cache_dir=tmp_path / "cache",
+        func=["mean", "max"],
+        max_download_workers=3,
+        max_workers=2,
+        clip_per_cluster=clip_per_cluster,
+        stack_products=stack_products,
+    )
+    expected = pd.concat(
+        [
+            nightlights.generate_nightlights_feature(
+                aoi,
+                year,
+                viirs_data_type=viirs_data_type,
+                cache_dir=tmp_path / "cache",
+                func=["mean", "max"],
+                copy=True,
+                clip_per_cluster=clip_per_cluster,
+            )
+            .drop(columns=aoi.geometry.name)
+            .assign(year=year, viirs_data_type=viirs_data_type)
+            for year in [2020, 2021]
+            for viirs_data_type in ["average", "cf_cvg"]
+        ]
+    )
+    pd.testing.assert_frame_equal(
+        features, expected[features.columns], check_dtype=False, rtol=1e-5
+    )
+
+
+def test_stacked_zonal_stats_without_nodata(tmp_path):
+    rng = np.random.default_rng(0)
+    values = rng.gamma(2, 3, (200, 300)).astype("float32")
+    values[:50] = -999
+    raster_files = [
+        write_global_raster(tmp_path / "average.tif", values),
+        write_global_raster(
+            tmp_path / "cf_cvg.tif", np.where(values == -999, -999, values + 1)[:150]
+        ),
+    ]
+    aoi = gpd.GeoDataFrame(
+        geometry=[shapely.Point(120.5 + i, 15).buffer(0.3) for i in range(3)],
+        crs="epsg:4326",
+    )
+    aggregations = [
+        dict(band=band, func=["mean", "max", "count"], column=str(band))
+        for band in range(2)
+    ]
+
+    stacked, _ = nightlights.stack_rasters(raster_files, nodata=None)
+    assert np.isnan(stacked[:, :50]).all()
+    # Pixels outside of the second raster are missing too
+    assert np.isnan(stacked[1, 150:]).all()
+
+    # The nodata of the rasters is used without a nodata in extra_args
+    stats = nightlights._stacked_zonal_stats(
+        aoi, raster_files, aggregations, dict(band_num=1), None
+    )
+    expected = nightlights._stacked_zonal_stats(
+        aoi, raster_files, aggregations, dict(band_num=1, nodata=-999), None
+    )
+    pd.testing.assert_frame_equal(stats, expected)
+
+
+def test_convert_to_cog_window_reads_match_source(tmp_path):
+    rng = np.random.default_rng(0)
+    source = write_global_raster(
+        tmp_path / "global.tif", rng.gamma(2, 3, (200, 300)).astype("float32")
+    )
+    cog_file = nightlights.convert_to_cog(
+        source, tmp_path / "global_cog.tif", blocksize=128
+    )
+    assert sorted(os.listdir(tmp_path)) == ["global.tif", "global_cog.tif"]
+
+    window = rasterio.windows.Window(70, 30, 100, 50)
+    with rasterio.open(cog_file) as src, rasterio.open(source) as expected_src:
+        assert src.profile["tiled"]
+        assert src.block_shapes == [(128, 128)]
+        assert src.overviews(1) == [2, 4]
+        assert src.transform == expected_src.transform
+        assert src.nodata == expected_src.nodata
+        assert np.array_equal(
+            src.read(1, window=window), expected_src.read(1, window=window)
+        )
+
+
+def test_get_viirs_cog_ingests_once(tmp_path, monkeypatch):
+    url = "https://eogdata.mines.edu/nighttime_light/annual/v21/2020/VNL_test.average.dat.tif.gz"
+    monkeypatch.setattr(nightlights, "make_url", lambda year, **kwargs: url)
+    conversions = []
+    convert_to_cog = nightlights.convert_to_cog
+
+    def counting_convert_to_cog(input_raster_file, dest, **kwargs):
+        conversions.append(input_raster_file)
+        return convert_to_cog(input_raster_file, dest, blocksize=128, **kwargs)
+
+    monkeypatch.setattr(nightlights, "convert_to_cog", counting_convert_to_cog)
+    cache_dir = tmp_path / "cache"
+    (cache_dir / "global").mkdir(parents=True)
+    global_file = write_global_raster(
+        cache_dir / "global" / "VNL_test.average.dat.tif",
+        np.arange(200 * 300, dtype="float32").reshape(200, 300),
+    )
+
+    cog_file = nightlights.get_viirs_cog(2020, cache_dir=cache_dir)
+    assert nightlights.get_viirs_cog(2020, cache_dir=cache_dir) == cog_file
+    assert conversions == [global_file.as_posix()]
+    assert nightlights.load_cog_catalog(cache_dir) == {
+        "annual/v21/2020/average": dict(
+            file="VNL_test.average.dat.tif",
+            url=url,
+            year="2020",
+            viirs_data_type="average",
+            version="v21",
+            product="annual",
+            compress="deflate",
+        )
+    }
+
+    bounds = np.array([120.9, 14.4, 121.2, 14.8])
+    clip = nightlights.generate_clipped_raster(
+        2020, bounds, tmp_path / "clip.tif", cache_dir=cache_dir, use_cog=True
+    )
+    expected = nightlights.clip_raster(
+        global_file, tmp_path / "expected.tif", bounds, buffer=0.1
+    )
+    with rasterio.open(clip) as src, rasterio.open(expected) as expected_src:
+        assert src.transform == expected_src.transform
+        assert np.array_equal(src.read(), expected_src.read())
+
+
+def test_update_cog_catalog_keeps_concurrent_entries(tmp_path):
+    (tmp_path / "cog").mkdir()
+    keys = [f"annual/v21/{year}/average" for year in range(2012, 2022)]
+    with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+        list(
+            executor.map(
+                lambda key: nightlights._update_cog_catalog(
+                    tmp_path, key, dict(file=key)
+                ),
+                keys,
+            )
+        )
+    assert nightlights.load_cog_catalog(tmp_path) == {
+        key: dict(file=key) for key in keys
+    }
+    assert sorted(os.listdir(tmp_path / "cog")) == [
+        nightlights.COG_CATALOG_FILENAME,
+        f"{nightlights.COG_CATALOG_FILENAME}.lock",
+    ]
@@ -0,0 +1,548 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import shapely
+from geowrangler import grids
+from geowrangler.datasets.ookla import OoklaFile
+
+from src import ookla
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    "Local stand-in for the Ookla S3 bucket that supports range requests"
+
+    requested_paths = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requested_paths.append(self.path)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            content = f.read()
+
+        range_header = self.headers.get("Range")
+        if range_header is None:
+            self.send_response(200)
+            start = 0
+        else:
+            start = int(range_header.split("=")[1].split("-")[0])
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+
+@pytest.fixture
+def ookla_server(tmp_path, monkeypatch):
+    server_dir = tmp_path / "server"
+    ookla_files = {}
+    for quarter in ["1", "2"]:
+        filename = f"2020-0{quarter}-01_performance_fixed_tiles.parquet"
+        quarter_dir = (
+            server_dir
+            / "parquet/performance/type=fixed/year=2020"
+            / f"quarter={quarter}"
+        )
+        quarter_dir.mkdir(parents=True)
+        pd.DataFrame(
+            dict(quadkey=["1323", "1322"], avg_d_kbps=[1, 2], tests=[3, 4])
+        ).to_parquet(quarter_dir / filename)
+        ookla_files[OoklaFile("fixed", "2020", quarter)] = filename
+    monkeypatch.setattr(ookla, "list_ookla_files", lambda: ookla_files)
+
+    RangeRequestHandler.requested_paths = []
+    handler = partial(RangeRequestHandler, directory=str(server_dir))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", ookla_files
+    server.shutdown()
+
+
+def test_download_ookla_year_data_only_fetches_missing_or_corrupt(
+    tmp_path, ookla_server
+):
+    base_url, ookla_files = ookla_server
+    cache_dir = tmp_path / "cache"
+
+    type_year_cache_dir = ookla.download_ookla_year_data(
+        "fixed", 2020, cache_dir, base_url=base_url
+    )
+    assert len(RangeRequestHandler.requested_paths) == 2
+    assert sorted(os.listdir(type_year_cache_dir)) == sorted(
+        list(ookla_files.values()) + [ookla.OOKLA_DOWNLOAD_MANIFEST_FILENAME]
+    )
+
+    # Truncate one quarter, only that quarter should be downloaded again
+    corrupt_file = os.path.join(
+        type_year_cache_dir, ookla_files[OoklaFile("fixed", "2020", "2")]
+    )
+    with open(corrupt_file, "r+b") as f:
+        f.truncate(10)
+    RangeRequestHandler.requested_paths = []
+    ookla.download_ookla_year_data("fixed", 2020, cache_dir, base_url=base_url)
+    assert len(RangeRequestHandler.requested_paths) == 1
+    assert "quarter=2" in RangeRequestHandler.requested_paths[0]
+    assert len(pd.read_parquet(corrupt_file)) == 2
+
+
+def test_download_parquet_file_resumes_part_file(tmp_path, ookla_server):
+    base_url, ookla_files = ookla_server
+    filename = ookla_files[OoklaFile("fixed", "2020", "1")]
+    url = ookla.make_ookla_url("fixed", "2020", "1", filename, base_url=base_url)
+    dest = tmp_path / filename
+
+    with open(
+        tmp_path
+        / "server/parquet/performance/type=fixed/year=2020/quarter=1"
+        / filename,
+        "rb",
+    ) as f:
+        content = f.read()
+    with open(f"{dest}.part", "wb") as f:
+        f.write(content[:100])
+
+    size = ookla._download_parquet_file(url, dest)
+    assert size == len(content)
+    assert not os.path.exists(f"{dest}.part")
+    with open(dest, "rb") as f:
+        assert f.read() == content
+
+
+def test_download_parquet_file_restarts_stale_part_file(tmp_path, ookla_server):
+    base_url, ookla_files = ookla_server
+    filename = ookla_files[OoklaFile("fixed", "2020", "1")]
+    url = ookla.make_ookla_url("fixed", "2020", "1", filename, base_url=base_url)
+    dest = tmp_path / filename
+
+    with open(
+        tmp_path
+        / "server/parquet/performance/type=fixed/year=2020/quarter=1"
+        / filename,
+        "rb",
+    ) as f:
+        content = f.read()
+    # A .part file larger than the remote file, e.g. from an older version of it
+    with open(f"{dest}.part", "wb") as f:
+        f.write(content + b"stale")
+
+    RangeRequestHandler.requested_paths = []
+    size = ookla._download_parquet_file(url, dest)
+    assert size == len(content)
+    assert len(RangeRequestHandler.requested_paths) == 2
+    assert not os.path.exists(f"{dest}.part")
+    with open(dest, "rb") as f:
+        assert f.read() == content
+
+
+def test_ookla_aggregator_merge_matches_single_pass():
+    df = pd.DataFrame(
+        dict(
+            quadkey=["1323", "1322", "1323", "1323", "1322"],
+            avg_d_kbps=[100.0, 200.0, 300.0, 500.0, None],
+            tests=[1, 2, 3, 4, 5],
+        )
+    )
+    aggregations = [
+        dict(column="avg_d_kbps", func=["mean", "weighted_mean", "max", "p50"])
+    ]
+    single_pass = ookla.OoklaAggregator(aggregations).update(df).result()
+    merged = (
+        ookla.OoklaAggregator(aggregations)
+        .update(df.iloc[:2])
+        .merge(ookla.OoklaAggregator(aggregations).update(df.iloc[2:]))
+        .result()
+    )
+    pd.testing.assert_frame_equal(single_pass, merged)
+
+    result = single_pass.set_index("quadkey")
+    assert result.loc["1323", "mean_avg_d_kbps"] == 300
+    assert result.loc["1323", "weighted_mean_avg_d_kbps"] == 3000 / 8
+    assert result.loc["1322", "max_avg_d_kbps"] == 200
+    assert abs(result.loc["1323", "p50_avg_d_kbps"] / 300 - 1) <= 0.01
+
+
+def test_ookla_file_catalog_ttl_and_offline(tmp_path, ookla_server, monkeypatch):
+    base_url, ookla_files = ookla_server
+    cache_dir = tmp_path / "cache"
+    ookla.download_ookla_year_data(
+        "fixed",
+        2020,
+        cache_dir,
+        base_url=base_url,
+        catalog=ookla.OoklaFileCatalog(cache_dir),
+    )
+
+    # A fresh catalog is reused without listing the inventory again
+    def fail():
+        raise AssertionError("Ookla files should not be listed")
+
+    monkeypatch.setattr(ookla, "list_ookla_files", fail)
+    catalog = ookla.OoklaFileCatalog(cache_dir)
+    assert catalog.files == ookla_files
+    filename = ookla_files[OoklaFile("fixed", "2020", "2")]
+    assert catalog.get(filename) == OoklaFile("fixed", "2020", "2")
+
+    # Offline without a stored catalog, files are found in the cache dir
+    os.remove(catalog.catalog_path)
+    offline_catalog = ookla.OoklaFileCatalog(cache_dir, offline=True)
+    assert offline_catalog.files == ookla_files
+    RangeRequestHandler.requested_paths = []
+    ookla.download_ookla_year_data(
+        "fixed", 2021, cache_dir, base_url=base_url, catalog=offline_catalog
+    )
+    assert RangeRequestHandler.requested_paths == []
+
+
+def test_ookla_data_manager_loads_data_key_once(tmp_path, monkeypatch):
+    manager = ookla.OoklaDataManager(cache_dir=tmp_path)
+    aoi = gpd.GeoDataFrame(
+        geometry=[shapely.box(121.0, 14.6, 121.01, 14.61)], crs="epsg:4326"
+    )
+    processed_keys = []
+
+    def process_type_year_data(data_key, *args):
+        processed_keys.append(data_key)
+        time.sleep(0.2)
+        df = pd.DataFrame(dict(quadkey=["1323"], avg_d_kbps=[1.0]))
+        return manager._cache_processed_data(data_key, df, False, {})
+
+    monkeypatch.setattr(manager, "_process_type_year_data", process_type_year_data)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        dfs = list(
+            executor.map(
+                lambda _: manager.load_type_year_data(aoi, "fixed", 2020), range(8)
+            )
+        )
+    assert len(processed_keys) == 1
+    assert all(df.equals(dfs[0]) for df in dfs)
+
+
+@pytest.fixture
+def ookla_cache(tmp_path):
+    "Cache dir with synthetic fixed and mobile Ookla tiles around Metro Manila in 2020"
+    cache_dir = tmp_path / "cache"
+    region = gpd.GeoDataFrame(
+        geometry=[shapely.box(120.9, 14.4, 121.2, 14.8)], crs="epsg:4326"
+    )
+    quadkeys = grids.BingTileGridGenerator(16).generate_grid(region)["quadkey"]
+    rng = np.random.default_rng(0)
+    for type_, quarter, month in [
+        ("fixed", 1, "01"),
+        ("fixed", 2, "04"),
+        ("mobile", 1, "01"),
+    ]:
+        type_year_cache_dir = cache_dir / "ookla" / type_ / "2020"
+        type_year_cache_dir.mkdir(parents=True, exist_ok=True)
+        quarter_quadkeys = quadkeys.sample(frac=0.7, random_state=quarter)
+        pd.DataFrame(
+            dict(
+                quadkey=quarter_quadkeys.to_numpy(),
+                avg_d_kbps=rng.integers(1_000, 100_000, len(quarter_quadkeys)),
+                avg_u_kbps=rng.integers(1_000, 100_000, len(quarter_quadkeys)),
+                avg_lat_ms=rng.integers(1, 100, len(quarter_quadkeys)),
+                tests=rng.integers(1, 50, len(quarter_quadkeys)),
+                devices=rng.integers(1, 10, len(quarter_quadkeys)),
+            )
+        ).sort_values("quadkey").to_parquet(
+            type_year_cache_dir / f"2020-{month}-01_performance_{type_}_tiles.parquet",
+            index=False,
+            row_group_size=200,
+        )
+    return cache_dir
+
+
+def make_aoi(*boxes):
+    return gpd.GeoDataFrame(
+        geometry=[shapely.box(*bounds) for bounds in boxes], crs="epsg:4326"
+    )
+
+
+def filter_quadkey_prefixes(df, quadkey_prefixes):
+    "Reference filter of the rows whose quadkey starts with any of the prefixes"
+    return df[
+        df["quadkey"].map(lambda x: any(x.startswith(p) for p in quadkey_prefixes))
+    ].reset_index(drop=True)
+
+
+def test_scan_quadkey_parquet_file_matches_full_read(ookla_cache):
+    quarter_file = next((ookla_cache / "ookla" / "fixed" / "2020").glob("*.parquet"))
+    # Prefixes at a mix of zoom levels, one outside of the data
+    quadkey_prefixes = ["13230303131", "1323030313133023", "132303031312", "0"]
+    expected = filter_quadkey_prefixes(pd.read_parquet(quarter_file), quadkey_prefixes)
+    assert 0 < len(expected) < pq.ParquetFile(quarter_file).metadata.num_rows
+
+    scanned = ookla._scan_quadkey_parquet_file(
+        quarter_file, quadkey_prefixes, columns=ookla.OOKLA_COLUMNS
+    )
+    pd.testing.assert_frame_equal(scanned, expected[ookla.OOKLA_COLUMNS])
+    pd.testing.assert_frame_equal(
+        ookla._read_and_filter_quadkey_parquet_file(
+            quarter_file, quadkey_prefixes, batch_size=300
+        ),
+        expected,
+    )
+
+    # Both scan modes load the same rows for an aoi
+    aoi = make_aoi((121.0, 14.5, 121.05, 14.55))
+    scan_mode_dfs = []
+    for scan_mode in ["pushdown", "batch"]:
+        manager = ookla.OoklaDataManager(cache_dir=ookla_cache, offline=True)
+        manager.reinitialize_processed_cache()
+        scan_mode_dfs.append(
+            manager.load_type_year_data(aoi, "fixed", 2020, scan_mode=scan_mode)
+        )
+    assert len(scan_mode_dfs[0]) > 0
+    pd.testing.assert_frame_equal(*scan_mode_dfs)
+
+
+def test_legacy_processed_cache_is_migrated_to_parquet(tmp_path):
+    manager = ookla.OoklaDataManager(cache_dir=tmp_path, offline=True)
+    aoi = make_aoi((121.0, 14.5, 121.05, 14.55))
+    data_key = manager._make_data_key(aoi, "fixed", 2020, False, False, "quadkey")
+    legacy_df = pd.DataFrame(
+        dict(quadkey=["0132", "0133"], avg_d_kbps=[1.0, 2.0], quarter=[1, 2])
+    )
+    legacy_file_path = os.path.join(manager.processed_cache_dir, f"{data_key}.csv")
+    legacy_df.to_csv(legacy_file_path, index=False)
+
+    pd.testing.assert_frame_equal(
+        manager.load_type_year_data(aoi, "fixed", 2020), legacy_df
+    )
+    assert not os.path.exists(legacy_file_path)
+    manifest_entry = manager.load_manifest()[data_key]
+    assert manifest_entry["format"] == "parquet"
+    assert manifest_entry["num_rows"] == 2
+
+    # The migrated entry is read back from parquet by a new manager
+    new_manager = ookla.OoklaDataManager(cache_dir=tmp_path, offline=True)
+    pd.testing.assert_frame_equal(
+        new_manager.load_type_year_data(aoi, "fixed", 2020), legacy_df
+    )
+
+
+def test_data_frame_lru_cache_evicts_within_budget():
+    dfs = {
+        key: pd.DataFrame(dict(x=np.arange(1000) + i)) for i, key in enumerate("abc")
+    }
+    nbytes = int(dfs["a"].memory_usage(deep=True).sum())
+    cache = ookla.DataFrameLRUCache(max_bytes=2 * nbytes)
+    cache["a"] = dfs["a"]
+    cache["b"] = dfs["b"]
+    # Using a makes b the least recently used entry
+    assert cache.get("a") is dfs["a"]
+    cache["c"] = dfs["c"]
+    assert cache.keys() == ["a", "c"]
+    assert cache.resident_bytes == 2 * nbytes <= cache.max_bytes
+
+    # Dataframes over the whole budget are not cached
+    cache["big"] = pd.concat([dfs["a"]] * 3)
+    assert "big" not in cache
+    assert cache.stats() == dict(
+        hits=1,
+        misses=0,
+        evictions=1,
+        entries=2,
+        resident_bytes=2 * nbytes,
+        max_bytes=2 * nbytes,
+    )
+
+
+def test_ookla_data_manager_reloads_evicted_data(ookla_cache):
+    manager = ookla.OoklaDataManager(
+        cache_dir=ookla_cache, memory_budget_bytes=1, offline=True
+    )
+    aoi = make_aoi((121.0, 14.5, 121.05, 14.55))
+    df = manager.load_type_year_data(aoi, "fixed", 2020)
+    assert len(manager.data_cache) == 0
+    # Processed data over the memory budget is read back from the processed cache dir
+    pd.testing.assert_frame_equal(manager.load_type_year_data(aoi, "fixed", 2020), df)
+    assert manager.cache_stats()["resident_bytes"] == 0
+
+
+def test_byte_budget_limits_concurrent_reservations():
+    budget = ookla._ByteBudget(max_bytes=100)
+    running = []
+    running_totals = []
+    lock = threading.Lock()
+
+    def task(nbytes):
+        with budget.reserve(nbytes):
+            with lock:
+                running.append(nbytes)
+                running_totals.append(sum(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(nbytes)
+
+    # Reservations over the whole budget run one at a time
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(task, [40, 40, 40, 150]))
+    assert all(total <= 100 or total == 150 for total in running_totals)
+    assert budget.reserved_bytes == 0
+
+
+def test_load_many_matches_single_loads(ookla_cache):
+    aoi = make_aoi((121.0, 14.5, 121.05, 14.55), (121.1, 14.6, 121.12, 14.62))
+    manager = ookla.OoklaDataManager(cache_dir=ookla_cache, offline=True)
+    df = manager.load_many(
+        aoi, ["fixed", "mobile"], [2020], max_workers=4, scan_memory_budget_bytes=1
+    )
+    assert df.groupby("type")["quarter"].unique().map(sorted).to_dict() == dict(
+        fixed=[1, 2], mobile=[1]
+    )
+
+    single_manager = ookla.OoklaDataManager(cache_dir=ookla_cache, offline=True)
+    single_manager.reinitialize_processed_cache()
+    expected = pd.concat(
+        [
+            single_manager.load_type_year_data(aoi, type_, 2020).assign(
+                type=type_, year=2020
+            )
+            for type_ in ["fixed", "mobile"]
+        ],
+        ignore_index=True,
+    )
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_add_ookla_features_area_weights_match_area_zonal_stats(ookla_cache):
+    manager = ookla.OoklaDataManager(cache_dir=ookla_cache, offline=True)
+    aoi = make_aoi(
+        (121.0, 14.5, 121.05, 14.55),
+        (121.1, 14.6, 121.12, 14.62),
+        # No Ookla tiles
+        (122.0, 15.0, 122.02, 15.02),
+    )
+    features = ookla.add_ookla_features(aoi, "fixed", 2020, manager)
+    expected = ookla.add_ookla_features(
+        aoi, "fixed", 2020, manager, use_area_weights=False
+    )
+    feature_columns = [col for col in expected if col.startswith("fixed_")]
+    assert len(feature_columns) == len(ookla.OOKLA_YEARLY_AGGREGATIONS)
+    assert features.loc[2, feature_columns].isna().all()
+    pd.testing.assert_frame_equal(
+        features[feature_columns], expected[feature_columns], check_dtype=False
+    )
+
+
+def test_covered_aoi_is_filtered_from_cached_data(ookla_cache, monkeypatch):
+    manager = ookla.OoklaDataManager(cache_dir=ookla_cache, offline=True)
+    manager.load_type_year_data(make_aoi((121.0, 14.5, 121.1, 14.6)), "fixed", 2020)
+
+    aoi = make_aoi((121.02, 14.52, 121.04, 14.53), (121.06, 14.55, 121.07, 14.58))
+    # Scan the same raw files with a separate processed cache
+    fresh_manager = ookla.OoklaDataManager(
+        cache_dir=ookla_cache / "fresh", offline=True
+    )
+    monkeypatch.setattr(fresh_manager, "_get_quarter_files", manager._get_quarter_files)
+    expected = fresh_manager.load_type_year_data(aoi, "fixed", 2020)
+
+    def fail(*args):
+        raise AssertionError("Ookla files should not be scanned")
+
+    monkeypatch.setattr(manager, "_get_quarter_files", fail)
+    covered = manager.load_type_year_data(aoi, "fixed", 2020)
+    assert len(covered) > 0
+    pd.testing.assert_frame_equal(
+        covered.sort_values(["quarter", "quadkey"]).reset_index(drop=True),
+        expected.sort_values(["quarter", "quadkey"]).reset_index(drop=True),
+    )
+
+
+def test_update_panel_incremental_matches_full_rebuild(ookla_cache):
+    aoi = make_aoi((121.0, 14.5, 121.05, 14.55), (121.1, 14.6, 121.12, 14.62))
+    type_year_cache_dir = ookla_cache / "ookla" / "fixed" / "2020"
+    new_quarter_file = (
+        type_year_cache_dir / "2020-04-01_performance_fixed_tiles.parquet"
+    )
+    unpublished_file = ookla_cache / new_quarter_file.name
+    new_quarter_file.rename(unpublished_file)
+
+    manager = ookla.OoklaDataManager(cache_dir=ookla_cache, offline=True)
+    first_panel = manager.update_panel(aoi, "fixed", 2020)
+
+    # Ookla publishes the second quarter
+    unpublished_file.rename(new_quarter_file)
+    manager.catalog = ookla.OoklaFileCatalog(ookla_cache, offline=True)
+    incremental_panel = manager.update_panel(aoi, "fixed", 2020)
+    assert not incremental_panel.equals(first_panel)
+    checkpoint_dir = next((ookla_cache / "ookla" / "panel").glob("*/fixed/2020"))
+    assert [path.name for path in checkpoint_dir.glob("v*")] == ["v2"]
+
+    shutil.rmtree(ookla_cache / "ookla" / "panel")
+    full_panel = manager.update_panel(aoi, "fixed", 2020)
+    pd.testing.assert_frame_equal(incremental_panel, full_panel)
+
+    manager.reinitialize_processed_cache()
+    expected = ookla.add_ookla_features(aoi, "fixed", 2020, manager)
+    pd.testing.assert_frame_equal(
+        full_panel.drop(columns="year"),
+        expected.drop(columns="geometry"),
+        check_dtype=False,
+    )
+
+
+def test_regional_extract_serves_aois_within_region(ookla_cache):
+    catalog = ookla.OoklaFileCatalog(ookla_cache, offline=True)
+    region_dir = ookla.build_ookla_regional_extract(
+        "fixed",
+        2020,
+        cache_dir=ookla_cache,
+        region_name="manila",
+        region_bounds=(121.0, 14.5, 121.1, 14.6),
+        region_zoom_lvl=12,
+        catalog=catalog,
+        row_group_size=50,
+    )
+    extract = pd.read_parquet(
+        os.path.join(region_dir, "type=fixed", "year=2020", "quarter=1.parquet")
+    )
+    assert extract["quadkey"].is_monotonic_increasing
+
+    aoi = make_aoi((121.02, 14.52, 121.04, 14.53))
+    manager = ookla.OoklaDataManager(cache_dir=ookla_cache, offline=True)
+    aoi_quadkeys = manager._get_aoi_quadkeys(aoi, False, "quadkey")
+    quarter_files = manager._get_quarter_files("fixed", 2020, True, aoi_quadkeys)
+    assert [quarter for quarter, _ in quarter_files] == [1, 2]
+    assert all(path.startswith(region_dir) for _, path in quarter_files)
+    regional = manager.load_type_year_data(aoi, "fixed", 2020)
+
+    global_manager = ookla.OoklaDataManager(
+        cache_dir=ookla_cache, offline=True, use_regional_extracts=False
+    )
+    global_manager.reinitialize_processed_cache()
+    pd.testing.assert_frame_equal(
+        regional, global_manager.load_type_year_data(aoi, "fixed", 2020)
+    )
+
+    # Aois outside of the region are read from the global files
+    outside_aoi = make_aoi((121.15, 14.7, 121.17, 14.72))
+    outside_quarter_files = manager._get_quarter_files(
+        "fixed", 2020, True, manager._get_aoi_quadkeys(outside_aoi, False, "quadkey")
+    )
+    assert len(outside_quarter_files) == 2
+    assert not any(path.startswith(region_dir) for _, path in outside_quarter_files)
@@ -0,0 +1,62 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from geowrangler import raster_zonal_stats as rzs
+from rasterio.transform import from_origin
+
+from src.pixel_coverage import PixelCoverage, get_pixel_coverage
+
+
+def test_pixel_coverage_matches_raster_zonal_stats(tmp_path):
+    rng = np.random.default_rng(0)
+    values = rng.gamma(2, 3, (100, 120)).astype("float32")
+    values[rng.random(values.shape) < 0.05] = -999
+    transform = from_origin(120.0, 16.0, 0.01, 0.01)
+    raster_file = tmp_path / "raster.tif"
+    with rasterio.open(
+        raster_file,
+        "w",
+        driver="GTiff",
+        height=100,
+        width=120,
+        count=1,
+        dtype="float32",
+        crs="epsg:4326",
+        transform=transform,
+        nodata=-999,
+    ) as dst:
+        dst.write(values, 1)
+
+    aoi = gpd.GeoDataFrame(
+        geometry=[
+            shapely.Point(120.2 + 0.08 * i, 15.5 - 0.06 * i).buffer(0.03 + 0.01 * i)
+            for i in range(10)
+        ]
+        # partly and fully outside of the raster
+        + [shapely.box(119.9, 15.9, 120.05, 16.1), shapely.box(118, 15, 119, 16)],
+        crs="epsg:4326",
+    )
+    func = ["min", "max", "mean", "median", "std", "count"]
+    expected = rzs.create_raster_zonal_stats(
+        aoi.copy(),
+        raster_file.as_posix(),
+        aggregation=dict(func=func, column="avg_rad"),
+        extra_args=dict(band_num=1, nodata=-999),
+    )
+
+    coverage = get_pixel_coverage(aoi, transform, (100, 120), tmp_path / "coverage")
+    stats = coverage.raster_zonal_stats(raster_file, func, "avg_rad")
+    pd.testing.assert_frame_equal(
+        stats, expected[stats.columns], check_dtype=False, rtol=1e-5
+    )
+
+    # The persisted coverage is reused and gives the same stats on a new raster
+    new_values = values * 2
+    loaded = PixelCoverage.load(next((tmp_path / "coverage").glob("*.npz")))
+    pd.testing.assert_frame_equal(
+        loaded.zonal_stats(new_values, ["mean"], "avg_rad", nodata=-1998),
+        stats[["avg_rad_mean"]] * 2,
+        rtol=1e-5,
+    )
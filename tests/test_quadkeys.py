@@ -0,0 +1,78 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from geowrangler import grids
+
+from src.quadkeys import (
+    QuadkeyIndex,
+    ints_to_quadkeys,
+    quadkey_cover,
+    quadkeys_to_bounds,
+    quadkeys_to_ints,
+    quadkeys_to_polygons,
+)
+
+
+def test_quadkeys_int_roundtrip():
+    quadkeys = ["", "0", "0123", "132", "3333333333333333"]
+    zoom_lvls, tile_ids = quadkeys_to_ints(quadkeys)
+    assert zoom_lvls.tolist() == [0, 1, 4, 3, 16]
+    assert tile_ids.tolist() == [0, 0, 27, 30, 4**16 - 1]
+    assert ints_to_quadkeys(zoom_lvls, tile_ids) == quadkeys
+
+
+def test_quadkeys_invalid_digit():
+    with pytest.raises(ValueError):
+        quadkeys_to_ints(["0124"])
+
+
+def test_quadkey_index_mixed_zoom_contains():
+    quadkey_index = QuadkeyIndex(["13", "0123", "1302", "20", "21", "22", "23"])
+    quadkeys = ["1300000000000000", "0123", "012", "2", "1", "2000", "3"]
+    expected = [True, True, False, True, False, True, False]
+    assert quadkey_index.contains(quadkeys).tolist() == expected
+
+    expected = [key.startswith(("13", "0123", "2")) for key in quadkeys]
+    assert quadkey_index.contains(quadkeys).tolist() == expected
+
+
+def test_quadkey_index_overlaps():
+    quadkey_index = QuadkeyIndex(["0123", "13"])
+    assert quadkey_index.overlaps("0000", "0123")
+    assert quadkey_index.overlaps("0130", "13")
+    assert not quadkey_index.overlaps("0000", "0122")
+    assert not quadkey_index.overlaps("0130", "1233")
+    assert not QuadkeyIndex([]).overlaps("0", "3")
+    assert np.all(~QuadkeyIndex([]).contains(["0", "3"]))
+
+
+def test_quadkeys_to_bounds():
+    minx, miny, maxx, maxy = quadkeys_to_bounds(["0", "3", "132"])
+    assert np.allclose(minx, [-180, 0, 90])
+    assert np.allclose(maxx, [0, 180, 135])
+    assert np.allclose(maxy, [85.0511287798, 0, 40.9798980696])
+    assert np.allclose(miny, [0, -85.0511287798, 0])
+
+
+def test_quadkeys_to_polygons():
+    polygons = quadkeys_to_polygons(["1323", "1322"])
+    assert polygons.crs == "epsg:4326"
+    assert polygons.geom_type.tolist() == ["Polygon", "Polygon"]
+    assert np.isclose(polygons.iloc[0].bounds[0], 112.5)
+
+
+def test_quadkey_cover_matches_grid_generator():
+    aoi = gpd.GeoDataFrame(
+        geometry=[
+            shapely.Point(121.0, 14.6).buffer(0.05),
+            shapely.box(120.8, 14.4, 120.85, 14.45),
+        ],
+        crs="epsg:4326",
+    )
+    tiles = grids.BingTileGridGenerator(14, return_geometry=False).generate_grid(aoi)
+    cover = quadkey_cover(aoi, zoom_lvl=14)
+
+    assert QuadkeyIndex(cover).contains(tiles["quadkey"]).all()
+    assert sum(4 ** (14 - len(quadkey)) for quadkey in cover) == len(tiles)
+    assert len(cover) < len(tiles)